@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+Publish throughput of MQClient for QoS 0, 1 and 2 and several in-flight
+window sizes.
+
+By default the messages go to a stand-in broker started in this process,
+with a small acknowledgement delay to emulate the round trip. Use --host
+and --port to measure against a real broker such as a local mosquitto.
+
+usage:
+    python bench_inflight.py [--host 127.0.0.1 --port 1883] [--count 5000]
+                             [--ack-delay 0.001] [--windows 1,10,20,100]
+'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from mqclient import MQClient  # noqa: E402
+from fake_broker import FakeBroker  # noqa: E402
+
+TOPIC = "bench/inflight"
+PAYLOAD = b'{"controllers": []}' * 10
+
+
+def run(host, port, qos, window, count):
+    client = MQClient("bench-inflight-%d-%d" % (qos, window),
+                      broker_host=host, broker_port=port,
+                      max_queue_size=0, max_inflight=window)
+    acked = [0]
+
+    def on_ack(topic, userdata):
+        acked[0] += 1
+
+    client.pub_topic_cbs[TOPIC] = on_ack
+    client.connect()
+    while not client.is_ready():
+        client.mqtt_client.loop(0.01)
+
+    start = time.perf_counter()
+    for i in range(count):
+        client.publish(TOPIC, PAYLOAD, qos, userdata=i)
+    if qos == 0:
+        while client.want_write():
+            client.mqtt_client.loop(0.01)
+    else:
+        while acked[0] < count:
+            client.mqtt_client.loop(0.01)
+    elapsed = time.perf_counter() - start
+
+    client.disconnect()
+    return count / elapsed
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--ack-delay", type=float, default=0.001)
+    parser.add_argument("--windows", default="1,10,20,100")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.ERROR)
+
+    broker = None
+    host, port = args.host, args.port
+    if host is None:
+        broker = FakeBroker(ack_delay=args.ack_delay)
+        host, port = "127.0.0.1", broker.start()
+
+    windows = [int(w) for w in args.windows.split(",")]
+    print("%5s %8s %12s" % ("qos", "window", "msg/s"))
+    for qos in (0, 1, 2):
+        for window in windows:
+            rate = run(host, port, qos, window, args.count)
+            print("%5d %8d %12.0f" % (qos, window, rate))
+
+    if broker is not None:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
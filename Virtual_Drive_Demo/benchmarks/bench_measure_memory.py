@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''
+Memory per measure point of the measure store.
+
+Compares the former value list of the app, one dict per written measure
+{"ctrl_name", "mea_name", "value"}, with the typed columns of MeasureStore.
+Every measure is written once. The bytes are taken with tracemalloc,
+without the measures config both share. The columns alone are also
+given, MeasureStore.nbytes(), the rest of the store is its index.
+
+usage:
+    python bench_measure_memory.py [point_count ...]
+'''
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from measure_store import MeasureStore  # noqa: E402
+from gen_config import make_config, sample_value  # noqa: E402
+
+MEASURES_PER_CONTROLLER = 100
+
+
+def dict_values(measures):
+    values = list()
+    for i, mea in enumerate(measures):
+        values.append({"ctrl_name": mea["ctrlName"], "mea_name": mea["name"],
+                       "value": sample_value(mea["dataType"], i)})
+    return values
+
+
+def column_store(measures):
+    store = MeasureStore(measures)
+    store.write_many([(mea["ctrlName"], mea["name"], sample_value(mea["dataType"], i))
+                      for i, mea in enumerate(measures)])
+    return store
+
+
+def allocated(build, measures):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = build(measures)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return kept, size
+
+
+def main(argv=sys.argv):
+    counts = [int(c) for c in argv[1:]] or [1000, 10000, 100000]
+    print("%10s %14s %14s %14s" % ("points", "dicts(B/pt)", "store(B/pt)", "columns(B/pt)"))
+    for count in counts:
+        measures = make_config(max(1, count // MEASURES_PER_CONTROLLER), MEASURES_PER_CONTROLLER)["measures"]
+        _, dicts = allocated(dict_values, measures)
+        store, columns = allocated(column_store, measures)
+        print("%10d %14.1f %14.1f %14.1f" % (len(measures), dicts / len(measures), columns / len(measures),
+                                             store.nbytes() / len(measures)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''
+Tick time of the measure lookups as the measure count grows.
+
+Compares the former linear scans of App.measure_is_exist/find_measure_value
+with the indexed MeasureStore.
+
+usage:
+    python bench_measure_store.py [measure_count ...]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from measure_store import MeasureStore, default_value  # noqa: E402
+
+DATA_TYPES = ("WORD", "DWORD", "FLOAT", "DOUBLE", "STRING")
+MEASURES_PER_CONTROLLER = 100
+
+
+def make_measures(count):
+    measures = list()
+    for i in range(count):
+        measures.append({"name": "virtual_measure%d" % i,
+                         "ctrlName": "virtual_controller%d" % (i // MEASURES_PER_CONTROLLER),
+                         "dataType": DATA_TYPES[i % len(DATA_TYPES)]})
+    return measures
+
+
+def linear_tick(measures, values):
+    for mea in measures:
+        for info in values:
+            if info["ctrl_name"] == mea["ctrlName"] and info["mea_name"] == mea["name"]:
+                break
+        else:
+            default_value(mea["dataType"])
+
+
+def indexed_tick(measures, store):
+    for mea in measures:
+        store.get_value(mea["ctrlName"], mea["name"])
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main(argv=sys.argv):
+    counts = [int(c) for c in argv[1:]] or [100, 1000, 5000, 20000]
+    print("%10s %14s %14s" % ("measures", "linear(ms)", "indexed(ms)"))
+    for count in counts:
+        measures = make_measures(count)
+        # half of the measures written by DSA, as in a running gateway
+        values = [{"ctrl_name": m["ctrlName"], "mea_name": m["name"], "value": 1}
+                  for m in measures[::2]]
+        store = MeasureStore(measures)
+        for m in measures[::2]:
+            store.set_value(m["ctrlName"], m["name"], 1)
+
+        linear = measure(linear_tick, measures, values)
+        indexed = measure(indexed_tick, measures, store)
+        print("%10d %14.3f %14.3f" % (count, linear * 1000, indexed * 1000))
+
+
+if __name__ == '__main__':
+    main()
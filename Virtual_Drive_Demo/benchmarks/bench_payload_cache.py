@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+Encode time of the south read payload: json.dumps(publish_payload) on a
+freshly built tree against the PayloadCache, with 1% of the measures
+written between two ticks.
+
+usage:
+    python bench_payload_cache.py [measure_count ...]
+'''
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from measure_store import MeasureStore  # noqa: E402
+from payload_cache import PayloadCache  # noqa: E402
+from codec import get_codec  # noqa: E402
+
+DATA_TYPES = ("WORD", "DWORD", "FLOAT", "DOUBLE", "STRING")
+MEASURES_PER_CONTROLLER = 100
+TICKS = 5
+
+
+def make_config(count):
+    controllers = list()
+    ctrl_measures = dict()
+    measures = list()
+    for i in range(count):
+        ctrl_name = "virtual_controller%d" % (i // MEASURES_PER_CONTROLLER)
+        if ctrl_name not in ctrl_measures:
+            controllers.append({"protocol": "Virtual Controller", "name": ctrl_name})
+            ctrl_measures[ctrl_name] = list()
+        mea = {"name": "virtual_measure%d" % i, "ctrlName": ctrl_name,
+               "dataType": DATA_TYPES[i % len(DATA_TYPES)]}
+        measures.append(mea)
+        ctrl_measures[ctrl_name].append(mea)
+    return controllers, ctrl_measures, measures
+
+
+def build_payload(controllers, ctrl_measures, store, timestamp):
+    publish_payload = {"controllers": list()}
+    for ctrl in controllers:
+        measures = list()
+        for mea in ctrl_measures[ctrl["name"]]:
+            measure = store.find(ctrl["name"], mea["name"])
+            measures.append({"name": mea["name"], "health": measure.health,
+                             "timestamp": timestamp, "value": measure.value})
+        publish_payload["controllers"].append({"name": ctrl["name"], "version": "", "health": 1,
+                                               "timestamp": timestamp, "measures": measures})
+    return publish_payload
+
+
+def write_some(measures, store, cache, tick):
+    for mea in measures[tick::100]:
+        # the values are checked against the dataType
+        store.set_value(mea["ctrlName"], mea["name"], str(tick) if mea["dataType"] == "STRING" else tick)
+        if cache is not None:
+            cache.mark_dirty(mea["ctrlName"], mea["name"])
+
+
+def main(argv=sys.argv):
+    counts = [int(c) for c in argv[1:]] or [1000, 10000, 100000]
+    print("cache codec: %s" % get_codec().name)
+    print("%10s %16s %16s %10s" % ("measures", "json.dumps(ms)", "cache(ms)", "speedup"))
+    for count in counts:
+        controllers, ctrl_measures, measures = make_config(count)
+        store = MeasureStore(measures)
+        cache = PayloadCache(controllers, ctrl_measures, store)
+
+        dumps_time = 0
+        cache_time = 0
+        for tick in range(TICKS):
+            timestamp = int(time.time()) + tick
+            write_some(measures, store, cache, tick)
+
+            start = time.perf_counter()
+            expected = json.dumps(build_payload(controllers, ctrl_measures, store, timestamp))
+            dumps_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            payload = cache.encode(timestamp)
+            cache_time += time.perf_counter() - start
+
+            assert json.loads(payload) == json.loads(expected)
+
+        dumps_time /= TICKS
+        cache_time /= TICKS
+        print("%10d %16.3f %16.3f %9.1fx" % (count, dumps_time * 1000, cache_time * 1000,
+                                             dumps_time / cache_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''
+Tick time of the simulated signals as the point count grows.
+
+Every measure has a signal, the types and dataTypes in rotation. The
+SignalEngine step, which writes every value into the MeasureStore, is
+compared with the same signals computed one point at a time in Python
+and written with MeasureStore.write_many(). The payload encode of the
+tick, the PayloadCache re-encoding the moved values, is given beside.
+
+usage:
+    python bench_signals.py [point_count ...]
+'''
+
+import os
+import sys
+import math
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from measure_store import MeasureStore  # noqa: E402
+from payload_cache import PayloadCache  # noqa: E402
+from signals import SignalEngine, signal_params  # noqa: E402
+from gen_config import make_config  # noqa: E402
+
+SIGNALS = ({"type": "sine", "amplitude": 50, "offset": 100, "period": 30},
+           {"type": "ramp", "min": 0, "max": 1000, "period": 60},
+           {"type": "random_walk", "start": 50, "step": 2, "min": 0, "max": 100},
+           {"type": "step", "low": 0, "high": 1, "period": 10})
+DATA_TYPES = ("FLOAT", "DOUBLE", "WORD", "DINT")
+MEASURES_PER_CONTROLLER = 1000
+TICKS = 10
+
+
+def make_measures(count):
+    cfg = make_config(max(1, count // MEASURES_PER_CONTROLLER), MEASURES_PER_CONTROLLER)
+    for i, mea in enumerate(cfg["measures"]):
+        mea["dataType"] = DATA_TYPES[i % len(DATA_TYPES)]
+        mea["signal"] = SIGNALS[(i // len(DATA_TYPES)) % len(SIGNALS)]
+    return cfg
+
+
+def python_tick(measures, params, state, store, t):
+    '''The signals one point at a time'''
+    writes = list()
+    for mea, (kind, p), i in zip(measures, params, range(len(measures))):
+        if kind == "random_walk":
+            state[i] = min(p["max"], max(p["min"], state[i] + random.uniform(-1, 1) * p["step"]))
+            value = state[i]
+        else:
+            cycle = (t / p["period"] + p["phase"]) % 1.0
+            if kind == "ramp":
+                value = p["min"] + (p["max"] - p["min"]) * cycle
+            elif kind == "sine":
+                value = p["offset"] + p["amplitude"] * math.sin(2 * math.pi * cycle)
+            else:
+                value = p["high"] if cycle < p["duty"] else p["low"]
+        if mea["dataType"] in ("WORD", "DINT"):
+            value = round(value)
+        writes.append((mea["ctrlName"], mea["name"], value))
+    store.write_many(writes)
+
+
+def main(argv=sys.argv):
+    counts = [int(c) for c in argv[1:]] or [1000, 10000, 100000]
+    print("%10s %14s %14s %14s" % ("points", "python(ms)", "numpy(ms)", "encode(ms)"))
+    for count in counts:
+        cfg = make_measures(count)
+        measures = cfg["measures"]
+        ctrl_measures = dict()
+        for mea in measures:
+            ctrl_measures.setdefault(mea["ctrlName"], list()).append(mea)
+
+        store = MeasureStore(measures)
+        params = [signal_params(mea["signal"]) for mea in measures]
+        state = [p.get("start", 0) for _, p in params]
+        start = time.perf_counter()
+        for tick in range(TICKS):
+            python_tick(measures, params, state, store, time.time() + tick)
+        python = (time.perf_counter() - start) / TICKS
+
+        store = MeasureStore(measures)
+        cache = PayloadCache(cfg["controllers"], ctrl_measures, store)
+        engine = SignalEngine(store, [(store.handle(mea["ctrlName"], mea["name"]), mea["signal"])
+                                      for mea in measures])
+        vectorized = 0
+        encode = 0
+        for tick in range(TICKS):
+            start = time.perf_counter()
+            moved = engine.tick(time.time() + tick)
+            vectorized += time.perf_counter() - start
+            start = time.perf_counter()
+            cache.mark_handles_dirty(moved)
+            cache.encode(int(time.time()))
+            encode += time.perf_counter() - start
+        print("%10d %14.3f %14.3f %14.3f" % (count, python * 1000, vectorized / TICKS * 1000,
+                                             encode / TICKS * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+Startup time of the app as the config grows.
+
+Every run is a new process, as after a reboot: the import of main, the
+App built from the config and the first payload of every publish group.
+"cold" starts from the config file, without its snapshot, and saves one
+in app_ms, in the data directory of the app.
+"warm" loads the snapshot saved by the former run, see config_snapshot.
+The wall time of the process, with the interpreter startup, is given
+beside. The medians of the runs are printed.
+
+usage:
+    python bench_startup.py [--size 10x100 ...] [--runs 5] [--backend asyncio]
+'''
+
+import time
+START = time.perf_counter()
+
+import os  # noqa: E402
+import sys  # noqa: E402
+import json  # noqa: E402
+import argparse  # noqa: E402
+import tempfile  # noqa: E402
+import subprocess  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+
+from gen_config import make_config, write_config  # noqa: E402
+
+APP_NAME = "Virtual_Drive_Demo"
+DEFAULT_SIZES = ("10x100", "100x100", "1000x100")
+PHASES = ("import_ms", "app_ms", "payload_ms", "wall_ms")
+
+
+def parse_size(size):
+    controllers, measures = size.lower().split("x")
+    return int(controllers), int(measures)
+
+
+def run_child(config_file):
+    '''The phases of the startup of this process, printed as JSON'''
+    import logging
+    from main import App
+    imported = time.perf_counter()
+    logging.getLogger().setLevel(logging.WARNING)
+    app = App('inhand-bench', APP_NAME, config_file=config_file)
+    built = time.perf_counter()
+    timestamp = int(time.time())
+    for group in app.publish_groups:
+        group.generate_signals(timestamp)
+        group.cache.encode(timestamp)
+    done = time.perf_counter()
+    sys.stdout.write(json.dumps({"import_ms": (imported - START) * 1000,
+                                 "app_ms": (built - imported) * 1000,
+                                 "payload_ms": (done - built) * 1000}))
+    sys.stdout.flush()
+    # the teardown of the app is not part of the startup
+    os._exit(0)
+
+
+def remove_snapshots():
+    from parse_config import ConfigPars
+    from config_snapshot import SNAPSHOT_FILE
+    data_path = ConfigPars(APP_NAME).data_path
+    if os.path.isdir(data_path):
+        for name in os.listdir(data_path):
+            if name.startswith(SNAPSHOT_FILE):
+                os.remove(os.path.join(data_path, name))
+
+
+def run_once(config_file):
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", config_file])
+    result = json.loads(output.decode())
+    result["wall_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=sys.argv):
+    if len(argv) == 3 and argv[1] == "--child":
+        run_child(argv[2])
+        return
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", action="append", help="controllers x measures per controller, e.g. 10x100")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backend", default="asyncio")
+    args = parser.parse_args(argv[1:])
+
+    print("%10s %6s %12s %12s %12s %12s" % (("points", "start") + PHASES))
+    for size in args.size or DEFAULT_SIZES:
+        controllers, measures = parse_size(size)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.ini")
+            write_config(path, make_config(controllers, measures, backend=args.backend))
+            cold = list()
+            warm = list()
+            for _ in range(args.runs):
+                remove_snapshots()
+                cold.append(run_once(path))
+                warm.append(run_once(path))
+            for start, results in (("cold", cold), ("warm", warm)):
+                print("%10d %6s %12.1f %12.1f %12.1f %12.1f" % (
+                    (controllers * measures, start) + tuple(median([r[phase] for r in results]) for phase in PHASES)))
+
+
+if __name__ == '__main__':
+    main()
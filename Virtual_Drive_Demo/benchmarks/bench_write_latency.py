@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''
+Latency from MQClient publish() to the socket flush, with the write event
+following paho's want_write() and with the former one-shot write event.
+
+Bursts of large QoS 0 messages fill the socket buffer, so paho only sends
+part of them at once. The latency of a message is taken from publish()
+until paho wrote its last byte. With the one-shot write event the rest of
+a burst waited for the 1 second housekeeping timer.
+
+The client runs on an asyncio loop, MQClientLibevent shares the same write
+path. Use --host and --port to measure against a real broker.
+
+usage:
+    python bench_write_latency.py [--host 127.0.0.1 --port 1883] [--bursts 10]
+                                  [--burst-size 200] [--payload-size 65536]
+'''
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from mqclient_asyncio import MQClientAsyncio  # noqa: E402
+from fake_broker import FakeBroker  # noqa: E402
+
+TOPIC = "bench/latency"
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2)
+
+
+class OneShotWriteClient(MQClientAsyncio):
+    '''The former write handling: armed once per publish, not re-armed on a partial write'''
+
+    def publish(self, *args, **kwargs):
+        res = MQClientAsyncio.publish(self, *args, **kwargs)
+        if self.writeEvt is not None:
+            self.writeEvt.add()
+        return res
+
+    def _mq_do_write(self, evt, fd, what, userdata):
+        MQClientAsyncio._mq_do_write(self, evt, fd, what, userdata)
+        if self.writeEvt is not None:
+            self.writeEvt.delete()
+
+    def _update_write_interest(self):
+        pass
+
+
+def histogram(latencies):
+    counts = [0] * (len(BUCKETS) + 1)
+    for latency in latencies:
+        for i, bound in enumerate(BUCKETS):
+            if latency <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    return counts
+
+
+def percentile(latencies, p):
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def run(client_class, host, port, bursts, burst_size, payload_size):
+    loop = asyncio.new_event_loop()
+    client = client_class(loop, "bench-latency")
+    client.target_host = host
+    client.target_port = port
+    # the former client polled every second
+    client.keepalive = 4
+    client.pending_queue_size = burst_size
+    client.max_queue_size = 0
+    client.init_mqclient()
+    payload = b'x' * payload_size
+    latencies = list()
+
+    async def bench():
+        while not client.is_ready():
+            await asyncio.sleep(0.01)
+        for _ in range(bursts):
+            done = list()
+            for _ in range(burst_size):
+                start = time.perf_counter()
+                done.append(loop.create_future())
+                client.publish(TOPIC, payload, 0, on_ack=lambda acked, start=start, future=done[-1]:
+                               future.set_result(time.perf_counter() - start))
+            latencies.extend(await asyncio.gather(*done))
+            await asyncio.sleep(0.1)
+
+    client.connect()
+    loop.run_until_complete(bench())
+    client.disconnect()
+    loop.close()
+    return latencies
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--bursts", type=int, default=10)
+    parser.add_argument("--burst-size", type=int, default=200)
+    parser.add_argument("--payload-size", type=int, default=64 * 1024)
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.ERROR)
+
+    broker = None
+    host, port = args.host, args.port
+    if host is None:
+        broker = FakeBroker()
+        host, port = "127.0.0.1", broker.start()
+
+    print("%-12s %9s %9s %9s %9s  %s" % ("write event", "p50 ms", "p90 ms", "p99 ms", "max ms",
+                                         " ".join("<=%gs" % b for b in BUCKETS) + " >%gs" % BUCKETS[-1]))
+    for name, client_class in (("one-shot", OneShotWriteClient), ("want_write", MQClientAsyncio)):
+        latencies = run(client_class, host, port, args.bursts, args.burst_size, args.payload_size)
+        print("%-12s %9.1f %9.1f %9.1f %9.1f  %s" % (
+            name, percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000, max(latencies) * 1000,
+            " ".join("%d" % c for c in histogram(latencies))))
+
+    if broker is not None:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
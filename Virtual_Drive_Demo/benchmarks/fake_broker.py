@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+'''
+Stand-in MQTT 3.1.1 broker for the benchmarks.
+
+It accepts any client, acknowledges QoS 1 and QoS 2 publishes, answers
+pings and forwards every publish to the matching subscribers at QoS 0.
+ack_delay delays the acknowledgements without blocking the connection, to
+emulate the round trip to a remote broker.
+
+usage:
+    broker = FakeBroker(ack_delay=0.002)
+    port = broker.start()
+    ...
+    broker.stop()
+
+or standalone:
+    python fake_broker.py [port]
+'''
+
+import sys
+import struct
+import asyncio
+import threading
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def topic_matches(sub, topic):
+    sub_levels = sub.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(sub_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+def publish_packet(topic, payload):
+    topic = topic.encode("utf-8")
+    body = struct.pack("!H", len(topic)) + topic + payload
+    return bytes([PUBLISH << 4]) + encode_length(len(body)) + body
+
+
+class FakeBroker(object):
+    def __init__(self, host="127.0.0.1", port=0, ack_delay=0):
+        self.host = host
+        self.port = port
+        self.ack_delay = ack_delay
+        self.received = 0
+        self.received_bytes = 0
+        self._subs = dict()
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def start(self):
+        '''Serve in a background thread, returns the port listened on'''
+        self._thread = threading.Thread(target=self._run, name="fake-broker", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def serve_forever(self):
+        self._run()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._loop.close()
+
+    def _ack(self, writer, packet):
+        if self.ack_delay:
+            self._loop.call_later(self.ack_delay, self._write, writer, packet)
+        else:
+            writer.write(packet)
+
+    def _write(self, writer, packet):
+        if not writer.is_closing():
+            writer.write(packet)
+
+    async def _read_length(self, reader):
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            if not byte & 0x80:
+                return length
+            multiplier *= 128
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length = await self._read_length(reader)
+                body = await reader.readexactly(length) if length else b''
+                if not self._dispatch(header, body, writer):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # CancelledError when the broker stops with clients connected
+            pass
+        finally:
+            for writers in self._subs.values():
+                writers.discard(writer)
+            writer.close()
+
+    def _dispatch(self, header, body, writer):
+        packet_type = header >> 4
+        if packet_type == CONNECT:
+            writer.write(bytes([CONNACK << 4, 2, 0, 0]))
+        elif packet_type == PUBLISH:
+            qos = (header >> 1) & 0x03
+            topic_len = struct.unpack("!H", body[:2])[0]
+            topic = body[2:2 + topic_len].decode("utf-8")
+            pos = 2 + topic_len
+            if qos:
+                packet_id = body[pos:pos + 2]
+                pos += 2
+                ack = PUBACK if qos == 1 else PUBREC
+                self._ack(writer, bytes([ack << 4, 2]) + packet_id)
+            payload = body[pos:]
+            self.received += 1
+            self.received_bytes += len(payload)
+            for sub, writers in self._subs.items():
+                if writers and topic_matches(sub, topic):
+                    packet = publish_packet(topic, payload)
+                    for sub_writer in writers:
+                        sub_writer.write(packet)
+        elif packet_type == PUBREL:
+            self._ack(writer, bytes([PUBCOMP << 4, 2]) + body[:2])
+        elif packet_type == SUBSCRIBE:
+            packet_id = body[:2]
+            pos = 2
+            granted = bytearray()
+            while pos < len(body):
+                topic_len = struct.unpack("!H", body[pos:pos + 2])[0]
+                sub = body[pos + 2:pos + 2 + topic_len].decode("utf-8")
+                pos += 3 + topic_len
+                self._subs.setdefault(sub, set()).add(writer)
+                granted.append(0)
+            writer.write(bytes([SUBACK << 4]) + encode_length(2 + len(granted)) + packet_id + bytes(granted))
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = body[:2]
+            pos = 2
+            while pos < len(body):
+                topic_len = struct.unpack("!H", body[pos:pos + 2])[0]
+                sub = body[pos + 2:pos + 2 + topic_len].decode("utf-8")
+                pos += 2 + topic_len
+                self._subs.get(sub, set()).discard(writer)
+            writer.write(bytes([UNSUBACK << 4, 2]) + packet_id)
+        elif packet_type == PINGREQ:
+            writer.write(bytes([PINGRESP << 4, 0]))
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+
+if __name__ == '__main__':
+    broker = FakeBroker(port=int(sys.argv[1]) if len(sys.argv) > 1 else 1883)
+    broker.serve_forever()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+'''
+Synthetic config.ini of N controllers x M measures for the benchmarks.
+
+The measures rotate through the data types of the measure store, the
+"publish" options are passed through, e.g. --qos 1 --mode delta.
+
+usage:
+    python gen_config.py --controllers 10 --measures 100 [--period 1] [--qos 0]
+                         [--mode full] [--backend asyncio] [-o config.ini]
+'''
+
+import sys
+import json
+import argparse
+
+DATA_TYPES = ("BIT", "BYTE", "SINT", "WORD", "INT", "DWORD", "DINT", "FLOAT", "DOUBLE", "STRING")
+
+
+def sample_value(data_type, i):
+    '''A value of data_type that changes with i'''
+    if data_type == "STRING":
+        return "value%d" % i
+    if data_type in ("FLOAT", "DOUBLE"):
+        return i * 0.5
+    if data_type in ("BIT", "BYTE", "SINT"):
+        return i % 2
+    return i % 30000
+
+
+def make_config(controllers, measures, period=1, qos=0, mode="full", backend="asyncio", **publish):
+    '''measures is the count per controller, publish the other "publish" options'''
+    cfg = {"controllers": list(), "measures": list(), "backend": backend}
+    for c in range(controllers):
+        ctrl_name = "virtual_controller%d" % c
+        cfg["controllers"].append({"protocol": "Virtual Controller", "name": ctrl_name})
+        for m in range(measures):
+            cfg["measures"].append({"name": "virtual_measure%d" % m,
+                                    "ctrlName": ctrl_name,
+                                    "dataType": DATA_TYPES[(c + m) % len(DATA_TYPES)]})
+    publish.update({"period": period, "qos": qos, "mode": mode})
+    cfg["publish"] = publish
+    return cfg
+
+
+def write_config(path, cfg):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(cfg, f, indent=1)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--controllers", type=int, default=10)
+    parser.add_argument("--measures", type=int, default=100, help="measures per controller")
+    parser.add_argument("--period", type=float, default=1)
+    parser.add_argument("--qos", type=int, default=0)
+    parser.add_argument("--mode", default="full")
+    parser.add_argument("--backend", default="asyncio")
+    parser.add_argument("-o", "--output", default="config.ini")
+    args = parser.parse_args(argv[1:])
+    write_config(args.output, make_config(args.controllers, args.measures, args.period, args.qos,
+                                          args.mode, args.backend))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark suite of the app on synthetic configs and the fake broker.
+
+For every size, N controllers x M measures per controller, the App runs
+on an asyncio loop with a config from gen_config.py and measures:
+- tick: App.on_pub_timer_handler of every publish group, a share of the
+  measures written by DSA between two ticks
+- throughput: payloads and bytes per second received by the broker,
+  ticks published as fast as the socket takes them
+- write: round trip of a DSA write request to its response, while the
+  publish groups run on their period
+- rss: resident memory once the app is set up, at the end and its peak
+
+Each size runs in its own process so that the memory of one does not
+count in the next. The results are saved as JSON with the commit they
+were taken on, --compare prints the change from a former run.
+
+usage:
+    python run_suite.py [--size 10x100 ...] [--ticks 200] [--duration 5] [--writes 200]
+                        [--output results.json] [--compare former.json]
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import logging
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+
+from gen_config import make_config, write_config, sample_value  # noqa: E402
+
+APP_NAME = "Virtual_Drive_Demo"
+WRITE_REQUEST_TOPIC = "ds2/eventbus/south/write/%d"
+WRITE_RESPONSE_TOPIC = "ds2/eventbus/south/write/+/response"
+DEFAULT_SIZES = ("1x10", "10x100", "50x200")
+# Seconds a write request waits for its response
+WRITE_TIMEOUT = 5
+RESULTS_VERSION = 1
+
+
+def parse_size(size):
+    controllers, measures = size.lower().split("x")
+    return int(controllers), int(measures)
+
+
+def rss_kb():
+    '''The current and the peak resident memory of the process, in kB'''
+    rss = {"current": None, "peak": None}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss["current"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    rss["peak"] = int(line.split()[1])
+    except OSError:
+        import resource
+        rss["peak"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss
+
+
+def summary(samples):
+    '''Count, mean and percentiles of samples in seconds, in ms'''
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000
+
+    return {"count": len(samples),
+            "mean": sum(samples) / len(samples) * 1000,
+            "p50": percentile(50),
+            "p90": percentile(90),
+            "p99": percentile(99),
+            "max": samples[-1] * 1000}
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=BENCH_DIR,
+                                stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def bench_tick(app, ticks, write_share):
+    '''Seconds of every tick of every group'''
+    measures = app.config.cfg["measures"]
+    step = max(1, int(round(1 / write_share))) if write_share else 0
+    samples = list()
+    for tick in range(ticks):
+        if step:
+            for mea in measures[tick % step::step]:
+                app.upgrate_measure_value(mea["ctrlName"], mea["name"],
+                                          sample_value(mea["dataType"], tick))
+        for group in app.publish_groups:
+            start = time.perf_counter()
+            app.on_pub_timer_handler(None, group)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def bench_throughput(app, broker, duration):
+    paho = app.mq.mqclient.mqtt_client
+    received, received_bytes = broker.received, broker.received_bytes
+    sent = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for group in app.publish_groups:
+            app.on_pub_timer_handler(None, group)
+            sent += 1
+        # as fast as the socket takes them
+        while paho.want_write():
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+    deadline = time.perf_counter() + WRITE_TIMEOUT
+    while broker.received - received < sent and time.perf_counter() < deadline:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    messages = broker.received - received
+    return {"messages": messages,
+            "lost": sent - messages,
+            "messages_per_s": messages / elapsed,
+            "bytes_per_s": (broker.received_bytes - received_bytes) / elapsed}
+
+
+def write_requests(app, count, measures_per_write):
+    '''The payloads of count DSA write requests, cycling over the measures'''
+    measures = app.config.cfg["measures"]
+    requests = list()
+    for i in range(count):
+        ctrls = dict()
+        for j in range(measures_per_write):
+            mea = measures[(i * measures_per_write + j) % len(measures)]
+            ctrls.setdefault(mea["ctrlName"], list()).append({"name": mea["name"],
+                                                               "value": sample_value(mea["dataType"], i)})
+        payload = [{"name": name, "measures": meas} for name, meas in ctrls.items()]
+        requests.append(json.dumps({"payload": payload}))
+    return requests
+
+
+def bench_write(app, port, count, measures_per_write):
+    '''
+        The DSA side on a paho client of its own, one request at a time.
+        Returns the thread sending the requests and the result it fills:
+        the round trips in seconds and the requests not answered.
+    '''
+    import paho.mqtt.client as mqtt
+
+    responses = queue.Queue()
+    subscribed = threading.Event()
+    client = mqtt.Client("bench-dsa")
+    client.on_message = lambda c, userdata, msg: responses.put(time.perf_counter())
+    client.on_subscribe = lambda c, userdata, mid, granted_qos: subscribed.set()
+    client.connect("127.0.0.1", port)
+    client.subscribe(WRITE_RESPONSE_TOPIC)
+    client.loop_start()
+    subscribed.wait(WRITE_TIMEOUT)
+    result = {"rtts": list(), "timeouts": 0}
+
+    def run():
+        for i, payload in enumerate(write_requests(app, count, measures_per_write)):
+            start = time.perf_counter()
+            client.publish(WRITE_REQUEST_TOPIC % i, payload)
+            try:
+                result["rtts"].append(responses.get(timeout=WRITE_TIMEOUT) - start)
+            except queue.Empty:
+                result["timeouts"] += 1
+        client.loop_stop()
+        client.disconnect()
+
+    return threading.Thread(target=run, name="bench-dsa"), result
+
+
+def run_size(size, args):
+    '''The results of one size, in this process'''
+    from main import App, WRITE_DRIVER_TOPIC
+    from fake_broker import FakeBroker
+
+    logging.getLogger().setLevel(logging.WARNING)
+    controllers, measures = parse_size(size)
+    broker = FakeBroker()
+    broker_port = broker.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "config.ini")
+        write_config(path, make_config(controllers, measures, period=args.period, qos=args.qos,
+                                       mode=args.mode, backend="asyncio"))
+        app = App('inhand-bench', APP_NAME, config_file=path)
+    app.mq.target_port = broker_port
+    app.mq.init_mqclient()
+    app.mq.add_sub(WRITE_DRIVER_TOPIC, app.on_write_measure_value)
+    loop = app.base
+    results = {"rss_kb": {"setup": rss_kb()["current"]}}
+
+    results["tick_ms"] = summary(bench_tick(app, args.ticks, args.write_share))
+
+    async def connected():
+        # the ticks queued by bench_tick are sent first
+        app.mq.connect()
+        while not app.mq.is_ready() or app.mq.health()["pending"] or app.mq.mqclient.want_write():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+
+    loop.run_until_complete(connected())
+    results["throughput"] = loop.run_until_complete(bench_throughput(app, broker, args.duration))
+
+    thread, write = bench_write(app, broker_port, args.writes, args.write_measures)
+    app.scheduler.start()
+    thread.start()
+    loop.run_until_complete(loop.run_in_executor(None, thread.join))
+    app.scheduler.stop()
+    results["write_rtt_ms"] = summary(write["rtts"])
+    results["write_rtt_ms"]["timeouts"] = write["timeouts"]
+
+    rss = rss_kb()
+    results["rss_kb"]["end"] = rss["current"]
+    results["rss_kb"]["peak"] = rss["peak"]
+    app.mq.disconnect()
+    broker.stop()
+    return results
+
+
+def flatten(results, prefix=""):
+    '''dotted key -> the numbers of the results'''
+    flat = dict()
+    for key, value in results.items():
+        name = "%s.%s" % (prefix, key) if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(former, current):
+    old = flatten(former["results"])
+    new = flatten(current["results"])
+    print("%-40s %14s %14s %9s" % ("%s -> %s" % (former.get("commit"), current.get("commit")),
+                                   "former", "current", "change"))
+    for key in sorted(set(old) & set(new)):
+        change = "%+8.1f%%" % ((new[key] - old[key]) / old[key] * 100) if old[key] else "%9s" % "-"
+        print("%-40s %14.3f %14.3f %s" % (key, old[key], new[key], change))
+
+
+def print_results(report):
+    for size, results in report["results"].items():
+        tick = results["tick_ms"]
+        write = results["write_rtt_ms"]
+        throughput = results["throughput"]
+        print("%-8s tick p50 %.3fms p99 %.3fms | %.0f msg/s %.1f MB/s | write p50 %.2fms p99 %.2fms "
+              "timeouts %d | rss %s kB peak %s kB" % (
+                  size, tick.get("p50", 0), tick.get("p99", 0),
+                  throughput["messages_per_s"], throughput["bytes_per_s"] / 1e6,
+                  write.get("p50", 0), write.get("p99", 0), write["timeouts"],
+                  results["rss_kb"]["end"], results["rss_kb"]["peak"]))
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", action="append", help="controllers x measures per controller, e.g. 10x100")
+    parser.add_argument("--ticks", type=int, default=200)
+    parser.add_argument("--write-share", type=float, default=0.1,
+                        help="share of the measures written between two ticks")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of the throughput run")
+    parser.add_argument("--writes", type=int, default=200)
+    parser.add_argument("--write-measures", type=int, default=10, help="measures per write request")
+    parser.add_argument("--period", type=float, default=1)
+    parser.add_argument("--qos", type=int, default=0)
+    parser.add_argument("--mode", default="full")
+    parser.add_argument("--output", default="results.json")
+    parser.add_argument("--compare", help="former results to compare with")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+    sizes = args.size or list(DEFAULT_SIZES)
+
+    if args.child:
+        json.dump(run_size(sizes[0], args), sys.stdout)
+        return
+
+    report = {"version": RESULTS_VERSION,
+              "commit": git_commit(),
+              "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "child")},
+              "results": dict()}
+    report["params"]["size"] = sizes
+    for size in sizes:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child",
+                                          "--size", size] + child_options(args))
+        report["results"][size] = json.loads(output.decode())
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print_results(report)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+def child_options(args):
+    return ["--ticks", str(args.ticks), "--write-share", str(args.write_share),
+            "--duration", str(args.duration), "--writes", str(args.writes),
+            "--write-measures", str(args.write_measures), "--period", str(args.period),
+            "--qos", str(args.qos), "--mode", args.mode]
+
+
+if __name__ == '__main__':
+    main()
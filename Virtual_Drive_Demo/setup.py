@@ -5,6 +5,7 @@ version: APP版本
 packages： APP源代码路径
 package_dir： APP源代码路径
 install_requires： 安装依赖
+extras_require： 可选依赖，signals为模拟信号所需的numpy
 entry_points： 程序执行的入口
 '''
 from setuptools import setup, find_packages
@@ -19,6 +20,7 @@ setup(name='Virtual_Drive_Demo',
       package_dir={'': 'src'},
       zip_safe=False,
       install_requires=[],
+      extras_require={'signals': ['numpy']},
       entry_points="""
       [console_scripts]
       appname = Application:main
@@ -0,0 +1,67 @@
+# -*- coding:utf-8 -*-
+'''
+pylibevent style Timer and Event on an asyncio loop.
+
+With them the parts of the app written against a libevent Base, such as
+the MQ client, the scheduler and the offload pools, run on an asyncio loop
+given in place of the Base. Their callbacks get the same arguments as
+with pylibevent.
+'''
+
+from events import EV_READ, EV_WRITE, EV_PERSIST
+
+
+class AsyncioTimer(object):
+    def __init__(self, loop, callback, userdata=None):
+        self.loop = loop
+        self.callback = callback
+        self.userdata = userdata
+        self._handle = None
+
+    def add(self, timeout):
+        self.delete()
+        self._handle = self.loop.call_later(timeout, self._fire)
+
+    def delete(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _fire(self):
+        self._handle = None
+        self.callback(self, self.userdata)
+
+
+class AsyncioEvent(object):
+    '''An EV_READ and/or EV_WRITE event on fd, the timeouts are not supported'''
+
+    def __init__(self, loop, fd, what, callback, userdata=None):
+        self.loop = loop
+        self.fd = fd
+        self.what = what
+        self.callback = callback
+        self.userdata = userdata
+        self._added = False
+
+    def add(self, timeout=None):
+        if self._added:
+            return
+        self._added = True
+        if self.what & EV_READ:
+            self.loop.add_reader(self.fd, self._fire, EV_READ)
+        if self.what & EV_WRITE:
+            self.loop.add_writer(self.fd, self._fire, EV_WRITE)
+
+    def delete(self):
+        if not self._added:
+            return
+        self._added = False
+        if self.what & EV_READ:
+            self.loop.remove_reader(self.fd)
+        if self.what & EV_WRITE:
+            self.loop.remove_writer(self.fd)
+
+    def _fire(self, what):
+        if not self.what & EV_PERSIST:
+            self.delete()
+        self.callback(self, self.fd, what, self.userdata)
@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+'''
+Publish fan-out to several brokers.
+
+A BrokerPool holds one MQ client per broker: the primary one, e.g. the
+local DSA broker, and the brokers added to it. A payload is encoded once
+and the same bytes are handed to every broker taking its topic. Each
+broker has its own connection, pending queue, store and connection state,
+so a slow or down broker does not hold back the others.
+
+The pool has the surface of the MQ client, the subscriptions are made on
+the primary broker only.
+'''
+
+import collections
+from topic_trie import TopicTrie
+from mqclient import MqttSetting
+
+PRIMARY_BROKER = "primary"
+
+
+class BrokerPool(object):
+    def __init__(self, primary, codec=None):
+        '''primary is an MQClientLibevent or MQClientAsyncio, set up but not initialized'''
+        self.primary = primary
+        self.codec = codec or primary.codec
+        self.base = primary.base
+        self.timer_factory = primary.timer_factory
+        self.event_factory = primary.event_factory
+        self.brokers = collections.OrderedDict()
+        self.brokers[PRIMARY_BROKER] = primary
+        # name -> TopicTrie of the topics published to the broker, all without
+        self._topics = dict()
+
+    def add_broker(self, name, host, port, topics=None, username=None, passwd=None, store_path=None):
+        '''
+            The client of the broker is set up like the primary one, its
+            client id is the one of the primary and the index of the broker,
+            a broker drops a client when another one takes its id.
+            topics are the topic filters published to it, all of them without.
+        '''
+        if name in self.brokers:
+            raise ValueError("Duplicated broker: %s" % name)
+        for client in self.brokers.values():
+            if (client.target_host, client.target_port) == (host, port):
+                raise ValueError("Broker %s:%s is already in the pool" % (host, port))
+        primary = self.primary
+        client_id = "%s-%d" % (primary.client_id, len(self.brokers))
+        client = primary.__class__(primary.base, client_id, codec=self.codec)
+        client.target_host = host
+        client.target_port = port
+        client.target_username = username
+        client.target_passwd = passwd
+        for setting in ("keepalive", "clean_session", "max_queue_size", "protocol", "max_inflight",
+                        "pending_queue_size", "pending_policy", "drain_batch", "store_max_size",
+                        "store_rate", "connect_timeout"):
+            setattr(client, setting, getattr(primary, setting))
+        client.ordered_topics = set(primary.ordered_topics)
+        client.store_path = store_path
+        self.brokers[name] = client
+        if topics is not None:
+            trie = TopicTrie()
+            for topic in topics:
+                trie.add(topic, name)
+            self._topics[name] = trie
+        return client
+
+    def init_mqclient(self):
+        for client in self.brokers.values():
+            client.init_mqclient()
+
+    def connect(self):
+        for client in self.brokers.values():
+            client.connect()
+
+    def disconnect(self):
+        for client in self.brokers.values():
+            client.disconnect()
+
+    def add_sub(self, topic, callback, qos=MqttSetting.MQTT_QOS_LEVEL, **kwargs):
+        return self.primary.add_sub(topic, callback, qos, **kwargs)
+
+    def del_sub(self, topic, callback=None):
+        self.primary.del_sub(topic, callback)
+
+    def is_ready(self):
+        return self.primary.is_ready()
+
+    def publish(self, topic, payload, qos=MqttSetting.MQTT_QOS_LEVEL, userdata=None, coalesce_key=None,
+                on_ack=None):
+        '''
+            userdata and on_ack go with the message of the primary broker.
+            Returns False if the primary broker dropped the message.
+        '''
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, (bytes, bytearray)):
+            payload = self.codec.dumps(payload)
+        res = self.primary.publish(topic, payload, qos, userdata=userdata, coalesce_key=coalesce_key,
+                                   on_ack=on_ack)
+        for name, client in self.brokers.items():
+            if client is self.primary:
+                continue
+            trie = self._topics.get(name)
+            if trie is None or trie.match(topic):
+                client.publish(topic, payload, qos, coalesce_key=coalesce_key)
+        return res
+
+    def health(self):
+        '''The connection state and the queues of every broker'''
+        health = list()
+        for name, client in self.brokers.items():
+            broker = client.health()
+            broker["name"] = name
+            health.append(broker)
+        return health
@@ -0,0 +1,120 @@
+# -*- coding:utf-8 -*-
+'''
+Payload codecs of the MQ client.
+Every codec encodes to bytes and decodes from bytes (or str), so payloads
+go to and come from paho without a str round trip.
+The fastest JSON library installed is picked: orjson, ujson, then the
+standard json module. MessagePack and CBOR are available for local-bus
+topics when msgpack or cbor2 is installed.
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class CodecNotAvailableError(ValueError):
+    pass
+
+
+class StdJsonCodec(object):
+    name = "json"
+    is_json = True
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(object):
+    name = "orjson"
+    is_json = True
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(object):
+    name = "ujson"
+    is_json = True
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+    is_json = False
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class CborCodec(object):
+    name = "cbor"
+    is_json = False
+
+    def dumps(self, obj):
+        return cbor2.dumps(obj)
+
+    def loads(self, data):
+        return cbor2.loads(data)
+
+
+# name -> (codec class, the module it needs)
+CODECS = {
+    "json": (StdJsonCodec, json),
+    "orjson": (OrjsonCodec, orjson),
+    "ujson": (UjsonCodec, ujson),
+    "msgpack": (MsgpackCodec, msgpack),
+    "cbor": (CborCodec, cbor2),
+}
+
+# Tried in order when no codec is named
+JSON_CODEC_PREFERENCE = ("orjson", "ujson", "json")
+
+
+def get_codec(name=None):
+    '''
+        get_codec() returns the fastest JSON codec installed,
+        get_codec("msgpack") a specific one
+    '''
+    if name is None:
+        for json_name in JSON_CODEC_PREFERENCE:
+            if CODECS[json_name][1] is not None:
+                return CODECS[json_name][0]()
+    if name not in CODECS:
+        raise CodecNotAvailableError("Unknown codec: %s" % name)
+    codec_class, module = CODECS[name]
+    if module is None:
+        raise CodecNotAvailableError("Codec %s is not installed" % name)
+    return codec_class()
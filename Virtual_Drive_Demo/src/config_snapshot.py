@@ -0,0 +1,147 @@
+# -*- coding:utf-8 -*-
+'''
+Precompiled snapshot of the config of the app.
+
+Parsing a big config, building the measure store and encoding the payload
+fragments of the publish groups takes most of the startup. Once built,
+their state is saved as plain dicts, lists, bytes and numbers in the data
+directory of the app, and the next start loads them at once instead. A
+snapshot is used only while its key is the same: the mtime and size of
+the config file, the shard and the owners of the controllers, the codec
+and the modules that parse the config or whose state it keeps. Otherwise
+the app starts from the config file and writes a new snapshot.
+
+The file is a header, the marshalled key then the marshalled state,
+written to a temporary file first and moved in place. The marshal format
+is only kept within a version of Python, so the header holds the bytecode
+magic number of the interpreter and the marshal version, checked before
+anything is unmarshalled, and the sizes of the key and the state: a file
+of another interpreter or a truncated one is ignored and the config file
+is parsed again. Unlike pickle, marshal builds plain data only, and the
+data directory is not the one of the config the user edits. "snapshot":
+false in the config saves none and removes the former one.
+'''
+
+import os
+import gc
+import sys
+import struct
+import marshal
+import logging
+import importlib.util
+
+SNAPSHOT_VERSION = 3
+SNAPSHOT_FILE = "config.snapshot"
+SNAPSHOT_MAGIC = b"VDSNAP"
+# magic, version, bytecode magic number, marshal version, key size, state size
+SNAPSHOT_HEADER = struct.Struct("!6sH4sHIQ")
+# parse_config and the modules it imports, then the modules whose state is
+# kept in the snapshot
+SNAPSHOT_MODULES = ("parse_config", "config_snapshot", "pubqueue", "logsink", "metrics",
+                    "mobiuspi_lib.config", "measure_store", "payload_cache", "codec")
+
+
+def snapshot_path(directory, shard=0, shards=1):
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    if shards > 1:
+        path = "%s-%d" % (path, shard)
+    return path
+
+
+def file_stamp(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def module_stamp(name):
+    '''The stamp of the source of module name, imported or not'''
+    module = sys.modules.get(name)
+    filename = getattr(module, "__file__", None)
+    if filename is None:
+        spec = importlib.util.find_spec(name)
+        filename = spec.origin if spec is not None else None
+    if filename is None:
+        raise OSError("No source for module %s" % name)
+    return (name,) + file_stamp(filename)
+
+
+class ConfigSnapshot(object):
+    def __init__(self, filename, directory, shard=0, shards=1, codec_name=None, owners=None):
+        '''
+            The snapshot of the config file filename, saved in directory, for
+            worker shard of shards whose controllers are split by owners
+        '''
+        self.filename = filename
+        self.path = snapshot_path(directory, shard, shards)
+        try:
+            sources = tuple(module_stamp(name) for name in SNAPSHOT_MODULES)
+            self.key = (SNAPSHOT_VERSION, sys.version_info[:2], os.path.abspath(filename),
+                        file_stamp(filename), shard, shards, codec_name, sources,
+                        tuple(sorted(owners.items())) if owners else None)
+        except (OSError, ImportError, ValueError):
+            self.key = None
+
+    def header(self, key_size, state_size):
+        return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, importlib.util.MAGIC_NUMBER,
+                                    marshal.version, key_size, state_size)
+
+    def load(self):
+        '''The state saved with the same key, None if there is none'''
+        if self.key is None or not os.path.exists(self.path):
+            return None
+        # the collector would walk the objects loaded so far again and again
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            # marshal reads a file object in small pieces, the bytes at once
+            with open(self.path, "rb") as f:
+                data = memoryview(f.read())
+            if len(data) < SNAPSHOT_HEADER.size:
+                logging.warning("Config snapshot %s is truncated" % self.path)
+                return None
+            header = bytes(data[:SNAPSHOT_HEADER.size])
+            key_size, state_size = SNAPSHOT_HEADER.unpack(header)[-2:]
+            if header != self.header(key_size, state_size):
+                logging.info("Config snapshot %s is of another version, ignored" % self.path)
+                return None
+            start = SNAPSHOT_HEADER.size + key_size
+            if len(data) != start + state_size:
+                logging.warning("Config snapshot %s is truncated" % self.path)
+                return None
+            if marshal.loads(data[SNAPSHOT_HEADER.size:start]) != self.key:
+                return None
+            return marshal.loads(data[start:])
+        except Exception as e:
+            logging.warning("Load config snapshot %s failed: %s" % (self.path, e.__str__()))
+            return None
+        finally:
+            if enabled:
+                gc.enable()
+
+    def save(self, state):
+        '''state holds dicts, lists, tuples, bytes, strings and numbers only'''
+        if self.key is None:
+            return False
+        tmp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            key = marshal.dumps(self.key)
+            data = marshal.dumps(state)
+            with open(tmp, "wb") as f:
+                f.write(self.header(len(key), len(data)))
+                f.write(key)
+                f.write(data)
+            os.replace(tmp, self.path)
+        except (OSError, ValueError) as e:
+            logging.warning("Save config snapshot %s failed: %s" % (self.path, e.__str__()))
+            return False
+        return True
+
+    def remove(self):
+        '''Remove the saved snapshot, if any'''
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning("Remove config snapshot %s failed: %s" % (self.path, e.__str__()))
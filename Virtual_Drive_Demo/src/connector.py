@@ -0,0 +1,135 @@
+# -*- coding:utf-8 -*-
+'''
+Non-blocking connect of the MQ client to the broker.
+
+A ConnectAttempt connects a non-blocking TCP socket and waits on a write
+event for the result, so the loop keeps running while the broker is down
+or unreachable. A host name is resolved off the loop by the resolver given,
+a numeric address right away. Every address of the host is tried in turn.
+
+Backoff spaces the attempts exponentially up to a maximum, with jitter so
+that the gateways restarted by the same outage do not reconnect at once.
+'''
+
+import os
+import errno
+import random
+import socket
+from events import EV_WRITE, LibeventEvent
+
+CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class Backoff(object):
+    def __init__(self, initial=1, maximum=60, factor=2, jitter=0.5):
+        '''jitter is the part of the delay taken off at random'''
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def next(self):
+        '''The delay before the next attempt'''
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        if delay < self.maximum:
+            self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+
+def is_numeric_host(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (OSError, ValueError):
+            pass
+    return False
+
+
+def resolve(host, port):
+    '''The TCP addresses of host, it blocks on a host name'''
+    return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+
+class ConnectAttempt(object):
+    def __init__(self, base, on_connected, on_failed, event_factory=LibeventEvent):
+        '''
+            on_connected(sock) gets the connected socket,
+            on_failed(reason) is called if no address could be connected
+        '''
+        self.base = base
+        self.on_connected = on_connected
+        self.on_failed = on_failed
+        self.event_factory = event_factory
+        self.sock = None
+        self.cancelled = False
+        self._addresses = list()
+        self._evt = None
+
+    def start(self, host, port, resolver=None):
+        '''
+            resolver(host, port, on_result, on_error) resolves a host name
+            off the loop, calling back on_result(host, addresses) or
+            on_error(host, error) on the loop
+        '''
+        if is_numeric_host(host) or resolver is None:
+            try:
+                addresses = resolve(host, port)
+            except socket.gaierror as e:
+                self.on_failed(e.__str__())
+                return
+            self._on_resolved(host, addresses)
+        else:
+            resolver(host, port, self._on_resolved, self._on_resolve_error)
+
+    def cancel(self):
+        self.cancelled = True
+        self._close()
+
+    def _on_resolved(self, host, addresses):
+        if self.cancelled:
+            return
+        self._addresses = list(addresses)
+        self._connect_next("no address")
+
+    def _on_resolve_error(self, host, error):
+        if not self.cancelled:
+            self.on_failed("resolve %s: %s" % (host, error.__str__()))
+
+    def _connect_next(self, reason):
+        while self._addresses:
+            family, socktype, proto, _, address = self._addresses.pop(0)
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(False)
+            err = sock.connect_ex(address)
+            if err in CONNECT_IN_PROGRESS:
+                self.sock = sock
+                self._evt = self.event_factory(self.base, sock.fileno(), EV_WRITE, self._on_writable)
+                self._evt.add()
+                return
+            sock.close()
+            reason = os.strerror(err)
+        self.on_failed(reason)
+
+    def _on_writable(self, evt, fd, what, userdata):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._close()
+            self._connect_next(os.strerror(err))
+            return
+        sock = self.sock
+        self._evt = None
+        self.sock = None
+        self.on_connected(sock)
+
+    def _close(self):
+        if self._evt is not None:
+            self._evt.delete()
+            self._evt = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,29 @@
+# -*- coding:utf-8 -*-
+'''
+Event flags and the libevent factories of the loop backends.
+
+The flags are the ones of libevent, the asyncio backend takes the same. The
+factories import pylibevent on their first call, so the app runs on the
+asyncio backend without it.
+'''
+
+# The flags of libevent
+EV_TIMEOUT = 0x01
+EV_READ = 0x02
+EV_WRITE = 0x04
+EV_PERSIST = 0x10
+
+
+def LibeventBase(*args, **kwargs):
+    import libevent
+    return libevent.Base(*args, **kwargs)
+
+
+def LibeventTimer(*args, **kwargs):
+    import libevent
+    return libevent.Timer(*args, **kwargs)
+
+
+def LibeventEvent(*args, **kwargs):
+    import libevent
+    return libevent.Event(*args, **kwargs)
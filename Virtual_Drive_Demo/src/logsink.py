@@ -0,0 +1,148 @@
+# -*- coding:utf-8 -*-
+'''
+Logging off the event loop.
+
+start_log_thread() moves the handlers of the root logger behind a bounded
+queue, a background thread formats and writes the records, so neither the
+formatting nor a slow flash stalls the loop. Only the traceback of an
+exception is formatted by the caller, while it is still at hand. When the
+queue is full the record is dropped and counted rather than blocking.
+
+Payloads are logged through PAYLOAD_LOG: the record is only made when its
+level is enabled, one in "every" is kept, and only the payloads of the
+records kept are formatted, truncated to max_length:
+
+    logsink.PAYLOAD_LOG("Publish message:%s", payload)
+'''
+
+import os
+import copy
+import queue
+import atexit
+import logging
+import logging.handlers
+import metrics
+
+# Records waiting for the log thread
+DEFAULT_QUEUE_SIZE = 10000
+# Characters of a payload written to the log
+DEFAULT_MAX_LENGTH = 512
+
+_listener = None
+
+
+class Truncated(object):
+    '''A payload formatted only if its record is handled'''
+    __slots__ = ("payload", "max_length")
+
+    def __init__(self, payload, max_length=DEFAULT_MAX_LENGTH):
+        self.payload = payload
+        self.max_length = max_length
+
+    def __str__(self):
+        payload = self.payload
+        size = len(payload) if isinstance(payload, (str, bytes, bytearray)) else None
+        if size is not None and self.max_length and size > self.max_length:
+            payload = payload[:self.max_length]
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode("utf-8", "replace")
+        text = str(payload)
+        if size is not None and self.max_length and size > self.max_length:
+            text = "%s...(%d bytes)" % (text, size)
+        return text
+
+
+class PayloadLog(object):
+    def __init__(self, level=logging.DEBUG, every=1, max_length=DEFAULT_MAX_LENGTH, logger=None):
+        self.logger = logger or logging.getLogger()
+        self.count = 0
+        self.configure(level, every, max_length)
+
+    def configure(self, level=logging.DEBUG, every=1, max_length=DEFAULT_MAX_LENGTH):
+        '''every n keeps one record in n, max_length 0 does not truncate'''
+        if every < 1:
+            raise ValueError("every should be at least 1")
+        self.level = level
+        self.every = every
+        self.max_length = max_length
+
+    def __call__(self, msg, *payloads):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        self.count += 1
+        if self.every > 1 and self.count % self.every != 1:
+            return
+        self.logger.log(self.level, msg, *[Truncated(payload, self.max_length) for payload in payloads],
+                        stacklevel=2)
+
+
+PAYLOAD_LOG = PayloadLog()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.LOG_DROPPED.inc()
+
+    def prepare(self, record):
+        '''A copy of record, its msg and args are left to the log thread'''
+        record = copy.copy(record)
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = (self.formatter or logging.Formatter()).formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def start_log_thread(queue_size=DEFAULT_QUEUE_SIZE):
+    '''
+        Write the records of the root logger from a background thread,
+        the current handlers of the root logger are moved to it
+    '''
+    global _listener
+    if _listener is not None:
+        return _listener
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    for h in handlers:
+        root.removeHandler(h)
+    root.addHandler(handler)
+    _listener = logging.handlers.QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_log_thread)
+
+    def after_fork():
+        # the thread is not forked, a child writes its records itself
+        global _listener
+        if handler not in root.handlers:
+            return
+        root.removeHandler(handler)
+        for h in handlers:
+            root.addHandler(h)
+        _listener = None
+
+    os.register_at_fork(after_in_child=after_fork)
+    return _listener
+
+
+def stop_log_thread():
+    '''Write the records left and put the handlers back on the root logger'''
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        if isinstance(h, DroppingQueueHandler):
+            root.removeHandler(h)
+    for h in _listener.handlers:
+        root.addHandler(h)
+    _listener = None
@@ -6,13 +6,21 @@ Created on 2022/3/8
 @author: Inhand
 '''
 
+import os
 import sys
 import time
-import json
 import logging
-import libevent
-from parse_config import ConfigPars
+from parse_config import ConfigPars, ConfigWatcher, PUBLISH_MODE_DELTA, BACKEND_ASYNCIO
+from measure_store import MeasureStore
+from payload_cache import PayloadCache
+from codec import get_codec
+from scheduler import Scheduler
+from events import LibeventBase
 from mqclient import MQClientLibevent
+import metrics
+import logsink
+# Imported when the config needs them, they slow down the startup: asyncio
+# for its backend, signals for NumPy, broker_pool and supervisor
 
 
 debug_format = '[%(asctime)s] [%(levelname)s] [%(filename)s %(lineno)d]: %(message)s'
@@ -24,38 +32,372 @@ READ_DRIVER_TOPIC = "ds2/eventbus/south/read/"
 WRITE_DRIVER_TOPIC = "ds2/eventbus/south/write/+"
 # The topic of the response after DSA modifies the measuring value 
 EVENT_BUS_SOUTH_WRITE_RESP = "ds2/eventbus/south/write/{requestServiceId}/response"
+# Seconds between two reports of the publish jitter, missed deadlines and brokers
+SCHEDULER_REPORT_PERIOD = 300
+
+
+def create_mq(config, client_id, codec):
+    '''The MQ client of the backend in config, on a new event loop'''
+    if config.backend == BACKEND_ASYNCIO:
+        import asyncio
+        from mqclient_asyncio import MQClientAsyncio
+        return MQClientAsyncio(asyncio.new_event_loop(), client_id, codec=codec)
+    return MQClientLibevent(LibeventBase(), client_id, codec=codec)
+
+
+def run_loop(config, base):
+    if config.backend == BACKEND_ASYNCIO:
+        base.run_forever()
+    else:
+        base.loop()
+
+
+def setup_logging(config):
+    logging.getLogger().setLevel(config.log_level)
+    logsink.PAYLOAD_LOG.configure(config.log_payload_level, config.log_payload_every,
+                                  config.log_payload_max_length)
+    logsink.start_log_thread(config.log_queue_size)
+
+
+def write_response_topic(topic):
+    serviceId = topic.split("/")[-1]
+    return EVENT_BUS_SOUTH_WRITE_RESP.format(requestServiceId=serviceId)
+
+
+def decode_write_request(topic, payload):
+    '''
+        The part of a write request handled off the loop when the "write"
+        executor is set, it must not touch the App
+    '''
+    logsink.PAYLOAD_LOG("receive topic: %s , payload: %s", topic, payload)
+    if isinstance(payload, (str, bytes)):
+        payload = get_codec().loads(payload)
+    return payload
+
+
+class PublishGroup(object):
+    '''The controllers and measures published together on one period'''
+
+    def __init__(self, group, measures, codec, fragments=None):
+        '''fragments are the PayloadCache fragments of the group saved in the config snapshot'''
+        self.name = group["name"]
+        self.period = group["period"]
+        self.controllers = group["controllers"]
+        self.ctrl_measures = group["ctrl_measures"]
+        self.measures = measures
+        self.cache = PayloadCache(self.controllers, self.ctrl_measures, measures, codec=codec,
+                                  fragments=fragments)
+        self.handles = self.cache.handles()
+        self.last_snapshot = 0
+        # the measures with a simulated signal, generated on every tick
+        self.signals = None
+        self.build_signals()
+
+    def build_signals(self):
+        self.signals = None
+        signals = [(self.measures.handle(ctrl_name, mea["name"]), mea["signal"])
+                   for ctrl_name, mea_list in self.ctrl_measures.items()
+                   for mea in mea_list if "signal" in mea]
+        if signals:
+            from signals import SignalEngine
+            self.signals = SignalEngine(self.measures, signals)
+
+    def same_config(self, group):
+        '''Whether the publish group config group is the one of this group'''
+        return self.period == group["period"] and self.controllers == group["controllers"] and \
+            self.ctrl_measures == group["ctrl_measures"]
+
+    def changed_controllers(self, group):
+        '''The controllers of group whose measures are not the ones of this group'''
+        return [ctrl["name"] for ctrl in group["controllers"]
+                if self.ctrl_measures.get(ctrl["name"]) != group["ctrl_measures"][ctrl["name"]]]
+
+    def update(self, group, changed):
+        '''Take the config of group, changed are the controllers to encode again'''
+        self.period = group["period"]
+        self.controllers = self.cache.controllers = group["controllers"]
+        self.ctrl_measures = self.cache.ctrl_measures = group["ctrl_measures"]
+        self.cache.rebuild(changed)
+        self.handles = self.cache.handles()
+        if self.signals is not None or any("signal" in mea for ctrl_name in changed
+                                           for mea in self.ctrl_measures[ctrl_name]):
+            self.build_signals()
+        # the next publish is a full snapshot
+        self.last_snapshot = 0
+
+    def generate_signals(self, t):
+        if self.signals is not None:
+            self.cache.mark_handles_dirty(self.signals.tick(t))
+
+    def mark_published(self, handles=None):
+        '''The measures of handles, all the ones of the group by default, are up to date on the broker'''
+        mark_published = self.measures.mark_published
+        for handle in self.handles if handles is None else handles:
+            mark_published(handle)
 
 
 class App(object):
-    def __init__(self, vendor_name, app_name):
-        self.config = ConfigPars(app_name)
-        self.config.load_config_file()
-        self.base = libevent.Base()
-        self.libeventmq = MQClientLibevent(self.base, vendor_name)
-        self.pub_timer = libevent.Timer(
-                         self.base, self.on_pub_timer_handler, userdata=None)
-        self.gl_measure_values = list()
+    def __init__(self, vendor_name, app_name, shard=0, shards=1, config_file=None, config=None, owners=None):
+        '''
+            With shards, the app is the worker of the controllers of shard,
+            owners are the workers of the controllers given by the supervisor.
+            config_file replaces the config of the app, e.g. in the benchmarks.
+            config is its ConfigPars loaded already with load(), by main().
+        '''
+        # DSA requests and responses are JSON, the read topic may use a binary codec
+        self.json_codec = get_codec()
+        if config is None:
+            config = ConfigPars(app_name)
+            if config_file is not None:
+                config.filename = config_file
+            config.load(shard, shards, self.json_codec.name, owners)
+        self.config = config
+        self.shard = shard
+        self.shards = shards
+        # the store and the payload fragments are built once, then loaded from the snapshot
+        snapshot, self.config.snapshot_state = self.config.snapshot_state, None
+        if snapshot is None or "measures" not in snapshot:
+            snapshot = None
+            self.measures = MeasureStore(self.config.cfg["measures"])
+        else:
+            self.measures = MeasureStore()
+            self.measures.restore(snapshot["measures"])
+        self.codec = get_codec(self.config.publish_codec) if self.config.publish_codec else self.json_codec
+        client_id = vendor_name if shards == 1 else "%s-%d" % (vendor_name, shard)
+        self.mq = create_mq(self.config, client_id, self.json_codec)
+        # The event loop is a libevent Base or an asyncio loop
+        self.base = self.mq.base
+        self.scheduler = Scheduler(self.base, timer_factory=self.mq.timer_factory)
+        self.supervisor_channel = None
+        self.mq.pending_queue_size = self.config.publish_queue_size
+        self.mq.pending_policy = self.config.publish_overflow
+        self.mq.max_inflight = self.config.publish_max_inflight
+        if self.config.store_forward.get("path"):
+            self.mq.store_path = self.config.store_forward["path"]
+            self.mq.store_max_size = self.config.store_forward.get("max_size", self.mq.store_max_size)
+            self.mq.store_rate = self.config.store_forward.get("rate", self.mq.store_rate)
+        if self.config.publish_mode == PUBLISH_MODE_DELTA:
+            # deltas must reach DSA in order, through the in-flight window
+            # and the store, full snapshots can overtake each other
+            self.mq.ordered_topics.add(READ_DRIVER_TOPIC)
+        # the metrics stay on the local broker
+        self.local_mq = self.mq
+        if self.config.brokers:
+            from broker_pool import BrokerPool
+            # the same payloads go to the other brokers, encoded once
+            self.mq = BrokerPool(self.mq)
+            for broker in self.config.brokers:
+                self.mq.add_broker(broker["name"], broker["host"], broker["port"],
+                                   topics=broker["topics"], username=broker["username"],
+                                   passwd=broker["password"], store_path=broker["store_path"])
+        self.publish_groups = list()
+        # (ctrl_name, mea_name) -> the PublishGroup publishing it
+        self.measure_groups = dict()
+        # group name -> its scheduler job
+        self.group_jobs = dict()
+        self.build_publish_groups(snapshot["fragments"] if snapshot is not None else None)
+        if snapshot is None:
+            self.config.save_snapshot(measures=self.measures.state(),
+                                      fragments={group.name: group.cache.fragments()
+                                                 for group in self.publish_groups})
+        self.config_watcher = None
+        # the workers reload when the supervisor sends them the new owners
+        if self.config.reload_interval and shards == 1:
+            self.config_watcher = ConfigWatcher(self.config.filename)
+            self.scheduler.add_job("config-reload", self.config.reload_interval, self.check_config)
+        if self.config.metrics_enabled:
+            metrics.enable()
+            metrics.PUBLISH_QUEUE_DEPTH.function = self.publish_queue_depth
+            self.scheduler.add_job("metrics", self.config.metrics_period, self.export_metrics)
+
+    def build_publish_groups(self, fragments=None):
+        '''fragments are the PayloadCache fragments of the groups by name, from the snapshot'''
+        for group in self.config.publish_groups:
+            publish_group = self.add_publish_group(group, fragments.get(group["name"]) if fragments else None)
+            self.group_jobs[publish_group.name] = self.scheduler.add_job(
+                publish_group.name, publish_group.period, self.on_pub_timer_handler, publish_group,
+                spread=True)
+        self.scheduler.add_job("scheduler-report", SCHEDULER_REPORT_PERIOD, self.report)
+
+    def add_publish_group(self, group, fragments=None):
+        publish_group = PublishGroup(group, self.measures, self.json_codec, fragments)
+        self.map_measures(publish_group, publish_group.ctrl_measures)
+        self.publish_groups.append(publish_group)
+        return publish_group
+
+    def map_measures(self, publish_group, ctrl_names):
+        for ctrl_name in ctrl_names:
+            for mea in publish_group.ctrl_measures.get(ctrl_name, ()):
+                self.measure_groups[(ctrl_name, mea["name"])] = publish_group
+
+    def unmap_measures(self, publish_group, ctrl_names):
+        for ctrl_name in ctrl_names:
+            for mea in publish_group.ctrl_measures.get(ctrl_name, ()):
+                if self.measure_groups.get((ctrl_name, mea["name"])) is publish_group:
+                    del self.measure_groups[(ctrl_name, mea["name"])]
+
+    def check_config(self, job, userdata):
+        if self.config_watcher.changed():
+            self.reload_config()
+
+    def reload_config(self, owners=None):
+        '''
+            Apply the changed controllers, measures and groups of the config
+            file. The unchanged measures keep their value, only the payload
+            fragments of the changed controllers are encoded again and the
+            publish groups keep their deadlines. Returns the ConfigDiff, None
+            if the file is invalid. owners are the ones of a worker.
+        '''
+        start = time.perf_counter()
+        try:
+            diff = self.config.reload(self.shard, self.shards, owners)
+        except (ValueError, KeyError) as e:
+            logging.error("Reload config failed, the former one is kept: %s" % e.__str__())
+            return None
+        for section in diff.restart_sections:
+            logging.warning("Config section %s changed, restart the app to apply it" % section)
+        self.measures.remove_measures([(mea["ctrlName"], mea["name"]) for mea in diff.removed_measures])
+        self.measures.update_measures(diff.changed_measures)
+        self.measures.add_measures(diff.added_measures)
+
+        former = {group.name: group for group in self.publish_groups}
+        updated = 0
+        for group in self.config.publish_groups:
+            publish_group = former.pop(group["name"], None)
+            if publish_group is None:
+                publish_group = self.add_publish_group(group)
+                self.group_jobs[publish_group.name] = self.scheduler.add_job(
+                    publish_group.name, publish_group.period, self.on_pub_timer_handler, publish_group,
+                    spread=True)
+                updated += 1
+                continue
+            if publish_group.same_config(group):
+                continue
+            # the controllers that left the group are unmapped with the changed ones
+            changed = publish_group.changed_controllers(group)
+            gone = [ctrl_name for ctrl_name in publish_group.ctrl_measures if ctrl_name not in group["ctrl_measures"]]
+            self.unmap_measures(publish_group, changed + gone)
+            period = publish_group.period
+            publish_group.update(group, changed)
+            self.map_measures(publish_group, changed)
+            updated += 1
+            if publish_group.period != period:
+                self.scheduler.remove_job(self.group_jobs[publish_group.name])
+                self.group_jobs[publish_group.name] = self.scheduler.add_job(
+                    publish_group.name, publish_group.period, self.on_pub_timer_handler, publish_group,
+                    spread=True)
+        for publish_group in former.values():
+            self.unmap_measures(publish_group, publish_group.ctrl_measures)
+            self.publish_groups.remove(publish_group)
+            self.scheduler.remove_job(self.group_jobs.pop(publish_group.name))
+        logging.info("Config reloaded in %.1fms: %s, %d publish group(s) updated" % (
+            (time.perf_counter() - start) * 1000, diff.summary(), updated))
+        return diff
+
+    def report(self, job, userdata):
+        self.scheduler.report()
+        if self.mq is not self.local_mq:
+            for broker in self.mq.health():
+                logging.info("Broker %(name)s %(host)s:%(port)s: %(state)s, pending %(pending)d, "
+                             "dropped %(dropped)d, stored %(stored)d" % broker)
+
+    def publish_queue_depth(self):
+        if self.mq is not self.local_mq:
+            return sum(broker["pending"] for broker in self.mq.health())
+        return self.mq.health()["pending"]
+
+    def export_metrics(self, job, userdata):
+        snapshot = metrics.REGISTRY.snapshot()
+        snapshot["timestamp"] = int(round(time.time()))
+        # only the latest snapshot is kept while the broker is not ready
+        self.local_mq.publish(self.config.metrics_topic, snapshot, qos=0, coalesce_key="metrics")
+        if self.config.metrics_prometheus_file:
+            try:
+                metrics.REGISTRY.write_prometheus(self.config.metrics_prometheus_file)
+            except OSError as e:
+                logging.warning("Write metrics to %s failed: %s" % (self.config.metrics_prometheus_file,
+                                                                   e.__str__()))
 
     # Define upload data and trigger periodically  
     def on_pub_timer_handler(self, evt, userdata):
+        group = userdata
+        timed = metrics.REGISTRY.enabled
+        if timed:
+            start = time.perf_counter()
+        now = time.time()
+        group.generate_signals(now)
+        timestamp = int(round(now))
+        # While the broker is not ready only the latest snapshot of a group
+        # is kept. In delta mode every payload is queued, in order.
+        coalesce_key = None
+        # In delta mode the measures of the payload, marked published once
+        # the message is accepted
+        published = None
+
+        # In delta mode only the changed measures are published, except for
+        # the periodic full snapshot
+        delta = self.config.publish_mode == PUBLISH_MODE_DELTA and \
+            timestamp - group.last_snapshot < self.config.snapshot_interval
+        if delta:
+            published = list()
+            publish_payload = self.build_payload(group, timestamp, delta=True, published=published)
+            if not publish_payload["controllers"]:
+                return
+            if timed:
+                encode_start = time.perf_counter()
+            payload = self.codec.dumps(publish_payload)
+        else:
+            group.last_snapshot = timestamp
+            if self.codec.is_json:
+                if timed:
+                    encode_start = time.perf_counter()
+                payload = group.cache.encode(timestamp)
+            else:
+                publish_payload = self.build_payload(group, timestamp)
+                if timed:
+                    encode_start = time.perf_counter()
+                payload = self.codec.dumps(publish_payload)
+            if self.config.publish_mode == PUBLISH_MODE_DELTA:
+                published = group.handles
+            else:
+                coalesce_key = group.name
+        if timed:
+            metrics.ENCODE_SECONDS.observe(time.perf_counter() - encode_start)
+
+        logsink.PAYLOAD_LOG("Publish message:%s", payload)
+        accepted = self.mq.publish(READ_DRIVER_TOPIC, payload, qos=self.config.publish_qos,
+                                   coalesce_key=coalesce_key)
+        # the measures of a dropped message stay changed for the next delta
+        if accepted and published is not None:
+            group.mark_published(published)
+        if timed:
+            metrics.TICK_SECONDS.observe(time.perf_counter() - start)
+            metrics.PAYLOAD_BYTES.observe(len(payload))
+            metrics.PUBLISHES.inc()
+
+    def build_payload(self, group, timestamp, delta=False, published=None):
+        '''The handles of the measures in the payload are appended to the list published'''
+        store = self.measures
         controllers = list()
         publish_payload = dict()
-        timestamp = int(round(time.time()))
-
-        if not self.libeventmq.is_ready():
-            return
 
-        for ctrl in self.config.cfg["controllers"]:
+        for ctrl in group.controllers:
             measures = list()
             table_dict = dict()
-            for mea in self.config.cfg["measures"]:
-                if mea["ctrlName"] == ctrl["name"]:
-                    table_dict = {}
-                    table_dict["name"] = mea["name"]
-                    table_dict["health"] = 1
-                    table_dict["timestamp"] = timestamp
-                    table_dict["value"] = self.get_measure_value(ctrl["name"], mea)
-                    measures.append(table_dict)
+            for mea in group.ctrl_measures[ctrl["name"]]:
+                handle = store.handle(ctrl["name"], mea["name"])
+                if delta and not store.is_changed(handle):
+                    continue
+                table_dict = {}
+                table_dict["name"] = mea["name"]
+                table_dict["health"] = store.health(handle)
+                table_dict["timestamp"] = timestamp
+                table_dict["value"] = store.value(handle)
+                measures.append(table_dict)
+                if published is not None:
+                    published.append(handle)
+            if delta and not measures:
+                continue
             table_dict = {}
             table_dict["name"] = ctrl["name"]
             table_dict["version"] = ""
@@ -64,76 +406,150 @@ class App(object):
             table_dict["measures"] = measures
             controllers.append(table_dict)
         publish_payload["controllers"] = controllers
-
-        logging.info("Publish message:%s" % publish_payload)
-        self.libeventmq.publish(READ_DRIVER_TOPIC, json.dumps(publish_payload))
-        self.pub_timer.add(5)
+        return publish_payload
 
     def on_write_measure_value(self, topic, payload):
-        logging.info("receive topic: %s , payload: %s" % (topic, payload))
-        if isinstance(payload, (str, bytes)):
-            payload = json.loads(payload)
+        received = time.perf_counter() if metrics.REGISTRY.enabled else None
+        self.on_write_request(topic, decode_write_request(topic, payload), received)
+
+    def on_write_request(self, topic, request, received=None):
+        '''received is the perf_counter() time the request was received at'''
+        if received is None and metrics.REGISTRY.enabled:
+            received = time.perf_counter()
+        response = self.bulk_upgrate_measure_values(request)
+        self.mq.publish(write_response_topic(topic), response)
+        if received is not None:
+            metrics.WRITE_REQUEST_SECONDS.observe(time.perf_counter() - received)
+
+    def serve_supervisor(self, sock):
+        '''Answer the write requests routed by the supervisor on sock'''
+        from supervisor import MessageChannel
+        self.supervisor_channel = MessageChannel(sock, self.base, self.mq.event_factory,
+                                                 self.on_supervisor_message, self.on_supervisor_closed)
+
+    def on_supervisor_closed(self):
+        logging.error("Supervisor gone, exit")
+        os._exit(1)
+
+    def on_supervisor_message(self, message):
+        if message[0] == "write":
+            if metrics.REGISTRY.enabled:
+                received = time.perf_counter()
+            response = self.bulk_upgrate_measure_values({"payload": message[2]})
+            self.supervisor_channel.send(("write", message[1], response["payload"]))
+            if metrics.REGISTRY.enabled:
+                metrics.WRITE_REQUEST_SECONDS.observe(time.perf_counter() - received)
+        elif message[0] == "reload":
+            self.reload_config(message[1])
 
-        for ctrl in payload["payload"]:
+    def bulk_upgrate_measure_values(self, request):
+        '''
+            Write all the measures of a DSA write request at once and return
+            the response payload, the request itself is left untouched
+        '''
+        writes = list()
+        for ctrl in request["payload"]:
             for measure in ctrl["measures"]:
-                err_code, params = self.upgrate_measure_value(ctrl["name"], measure["name"], measure["value"])
+                writes.append((ctrl["name"], measure["name"], measure["value"]))
+        handles = self.measures.write_many(writes)
 
-                measure["error_code"] = err_code
-                measure["error_reason"] = params
-                del measure["value"]
+        results = iter(handles)
+        response_ctrls = list()
+        for ctrl in request["payload"]:
+            response_measures = list()
+            for measure in ctrl["measures"]:
+                handle = next(results)
+                table_dict = {k: v for k, v in measure.items() if k != "value"}
+                if handle is None:
+                    table_dict["error_code"] = 1
+                    table_dict["error_reason"] = "Failed"
+                else:
+                    self.mark_dirty(ctrl["name"], measure["name"])
+                    table_dict["error_code"] = 0
+                    table_dict["error_reason"] = "Success"
+                response_measures.append(table_dict)
+            table_dict = {k: v for k, v in ctrl.items() if k != "measures"}
+            table_dict["measures"] = response_measures
+            response_ctrls.append(table_dict)
 
-        serviceId = topic.split("/")[-1]
-        self.libeventmq.publish(EVENT_BUS_SOUTH_WRITE_RESP.format(requestServiceId=serviceId), json.dumps(payload))
+        response = dict(request)
+        response["payload"] = response_ctrls
+        return response
 
     def run(self):
-        self.pub_timer.add(5)
-        self.base.loop()
+        self.scheduler.start()
+        run_loop(self.config, self.base)
 
     def measure_is_exist(self, con_name, mea_name):
-        for meas in self.config.cfg["measures"]:
-            if meas["ctrlName"] == con_name and meas["name"] == mea_name:
-                return True
-
-        return False
+        return self.measures.exist(con_name, mea_name)
 
     def find_measure_value(self, con_name, mea_name):
-        for info in self.gl_measure_values:
-            if info["ctrl_name"] == con_name and info["mea_name"] == mea_name:
-                return info
-
-        return None
+        return self.measures.find(con_name, mea_name)
 
     def upgrate_measure_value(self, con_name, mea_name, value):
-        if not self.measure_is_exist(con_name, mea_name):
+        if not self.measures.set_value(con_name, mea_name, value):
             return 1, "Failed"
-
-        measure = self.find_measure_value(con_name, mea_name)
-        if measure:
-            measure['value'] = value
-        else:
-            self.gl_measure_values.append({"ctrl_name": con_name, "mea_name": mea_name, "value": value})
+        self.mark_dirty(con_name, mea_name)
 
         return 0, "Success"
 
+    def mark_dirty(self, con_name, mea_name):
+        group = self.measure_groups.get((con_name, mea_name))
+        if group is not None:
+            group.cache.mark_dirty(con_name, mea_name)
+
     # If the measuring point value is not modified, the default value will be uploaded 
     def get_measure_value(self, con_name, mea):
-        measure = self.find_measure_value(con_name, mea['name'])
-        if measure:
-            return measure["value"]
-        else:
-            if mea["dataType"] == "STRING":
-                return 'ABCD'
-            elif mea["dataType"] in ["FLOAT", "DOUBLE"]:
-                return 100.0
-            else:
-                return 100
+        return self.measures.get_value(con_name, mea['name'])
+
+
+def run_worker(shard, shards, sock, owners):
+    '''A worker process of the supervisor, owning the controllers of shard in owners'''
+    app = App('inhand', 'Virtual_Drive_Demo', shard, shards, owners=owners)
+    setup_logging(app.config)
+    app.mq.init_mqclient()
+    app.serve_supervisor(sock)
+    app.mq.connect()
+    app.run()
+
+
+def run_supervisor(config):
+    from supervisor import Supervisor
+    json_codec = get_codec()
+    mq = create_mq(config, 'inhand-supervisor', json_codec)
+    supervisor = Supervisor(config, mq, run_worker,
+                            lambda topic, response: mq.publish(write_response_topic(topic), response),
+                            json_codec)
+    mq.init_mqclient()
+    mq.add_sub(WRITE_DRIVER_TOPIC, supervisor.on_write_request)
+    supervisor.start()
+    mq.connect()
+    try:
+        run_loop(config, mq.base)
+    finally:
+        supervisor.stop()
 
 
 def main(argv=sys.argv):
-    app = App('inhand', 'Virtual_Drive_Demo')
-    app.libeventmq.init_mqclient()
-    app.libeventmq.add_sub(WRITE_DRIVER_TOPIC, app.on_write_measure_value)
-    app.libeventmq.connect()
+    config = ConfigPars('Virtual_Drive_Demo')
+    config.load(codec_name=get_codec().name)
+    setup_logging(config)
+    if config.workers > 1:
+        if config.snapshot_state is None:
+            config.save_snapshot()
+        run_supervisor(config)
+        return
+
+    app = App('inhand', 'Virtual_Drive_Demo', config=config)
+    app.mq.init_mqclient()
+    if app.config.write_executor:
+        app.mq.add_sub(WRITE_DRIVER_TOPIC, decode_write_request,
+                       executor=app.config.write_executor,
+                       on_result=app.on_write_request,
+                       max_pending=app.config.write_max_pending)
+    else:
+        app.mq.add_sub(WRITE_DRIVER_TOPIC, app.on_write_measure_value)
+    app.mq.connect()
     app.run()
 
 
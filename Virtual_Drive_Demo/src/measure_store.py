@@ -0,0 +1,476 @@
+# -*- coding:utf-8 -*-
+'''
+Indexed measure store of the virtual driver.
+The store is built once from config.cfg["measures"] and gives O(1) access
+to every measure by (ctrlName, name).
+
+The measures are kept in columns, one per dataType: the values in an
+array of the type, e.g. 2 bytes for a WORD, with the health, the time of
+the last write and the last published value and health beside them, and
+bitmaps of the measures changed since their last publish. A write is
+checked against the dataType of the measure.
+
+A measure is addressed by its handle, the row in its column and the
+column, see handle(). find() gives a Measure object on the handle.
+
+The measures can be added, removed and changed while the app runs, see
+add_measures(): the other measures keep their handle and value, the rows
+of the removed ones are reused. state() gives the store as plain data,
+restore() takes it back.
+'''
+
+import sys
+import math
+import time
+from array import array
+
+STRING_DEFAULT_VALUE = 'ABCD'
+FLOAT_DEFAULT_VALUE = 100.0
+INTEGER_DEFAULT_VALUE = 100
+BOOL_DEFAULT_VALUE = 0
+
+FLOAT_DATA_TYPES = ("FLOAT", "DOUBLE")
+BOOL_DATA_TYPES = ("BIT", "BOOL")
+STRING_DATA_TYPES = ("STRING",)
+
+# The array typecode of the values of a dataType. The values of the other
+# dataTypes are kept as Python objects, a STRING must be a str. A FLOAT is
+# kept as a double, so the value written is the one published.
+TYPECODES = {"BIT": "B", "BOOL": "B", "BYTE": "B", "SINT": "b",
+             "WORD": "H", "INT": "h", "DWORD": "I", "DINT": "i",
+             "ULONG": "Q", "LONG": "q", "FLOAT": "d", "DOUBLE": "d"}
+FLOAT32_MAX = 3.4028234663852886e+38
+# The range of the dataTypes narrower than their typecode
+VALUE_RANGES = {"BIT": (0, 1), "BOOL": (0, 1), "FLOAT": (-FLOAT32_MAX, FLOAT32_MAX)}
+
+# A handle is row << COLUMN_BITS | column
+COLUMN_BITS = 4
+COLUMN_MASK = (1 << COLUMN_BITS) - 1
+
+
+def default_value(data_type):
+    '''The value uploaded while the measure has not been written yet'''
+    if data_type == "STRING":
+        return STRING_DEFAULT_VALUE
+    elif data_type in FLOAT_DATA_TYPES:
+        return FLOAT_DEFAULT_VALUE
+    elif data_type in BOOL_DATA_TYPES:
+        return BOOL_DEFAULT_VALUE
+    else:
+        return INTEGER_DEFAULT_VALUE
+
+
+def column_type(data_type):
+    '''The dataType of the column of data_type, None for the unknown ones'''
+    if data_type in TYPECODES or data_type in STRING_DATA_TYPES:
+        return data_type
+    return None
+
+
+class Column(object):
+    '''The measures of one dataType, a field of them per array'''
+
+    def __init__(self, data_type):
+        self.data_type = data_type
+        self.typecode = TYPECODES.get(data_type)
+        if self.typecode is None:
+            self.values = list()
+            self.pub_values = list()
+        else:
+            self.values = array(self.typecode)
+            self.pub_values = array(self.typecode)
+        self.health = bytearray()
+        self.pub_health = bytearray()
+        # seconds since the epoch of the last write, 0 if never written
+        self.timestamps = array("I")
+        # one bit per measure
+        self.changed = bytearray()
+        self.published = bytearray()
+        # row -> deadband, of the measures with one
+        self.deadbands = dict()
+        # the rows of the removed measures, reused first
+        self.free = list()
+
+    def __len__(self):
+        return len(self.health)
+
+    def append(self, value, deadband=0):
+        '''A new measure, in a free row if any. Returns its row'''
+        if self.free:
+            row = self.free[-1]
+            self.values[row] = value
+            self.free.pop()
+            self.pub_values[row] = value
+            self.health[row] = 1
+            self.pub_health[row] = 0
+            self.timestamps[row] = 0
+            self.published[row >> 3] &= ~(1 << (row & 7))
+        else:
+            row = len(self.health)
+            self.values.append(value)
+            self.pub_values.append(value)
+            self.health.append(1)
+            self.pub_health.append(0)
+            self.timestamps.append(0)
+            if not row & 7:
+                self.changed.append(0)
+                self.published.append(0)
+        # never published
+        self.changed[row >> 3] |= 1 << (row & 7)
+        if deadband:
+            self.deadbands[row] = deadband
+        return row
+
+    def remove(self, row):
+        '''The row is free, its fields are reset when it is reused'''
+        byte, bit = row >> 3, 1 << (row & 7)
+        self.changed[byte] &= ~bit
+        self.published[byte] &= ~bit
+        self.deadbands.pop(row, None)
+        if self.typecode is None:
+            self.values[row] = self.pub_values[row] = None
+        self.free.append(row)
+
+    def set_deadband(self, row, deadband):
+        if deadband:
+            self.deadbands[row] = deadband
+        else:
+            self.deadbands.pop(row, None)
+        self.update_changed(row)
+
+    def convert(self, value):
+        '''
+            value as stored in the column. Raises TypeError if it is not of
+            the dataType, ValueError if it is a NaN or an infinity, which
+            JSON has no number for, and OverflowError if it is out of its
+            range.
+        '''
+        typecode = self.typecode
+        if typecode is None:
+            if self.data_type in STRING_DATA_TYPES and not isinstance(value, str):
+                raise TypeError("%s expects a string, not %r" % (self.data_type, value))
+            return value
+        if typecode == "d":
+            if not isinstance(value, (int, float)):
+                raise TypeError("%s expects a number, not %r" % (self.data_type, value))
+            value = float(value)
+            if not math.isfinite(value):
+                raise ValueError("%s expects a finite number, not %r" % (self.data_type, value))
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        elif not isinstance(value, int):
+            raise TypeError("%s expects an integer, not %r" % (self.data_type, value))
+        bounds = VALUE_RANGES.get(self.data_type)
+        if bounds is not None and not bounds[0] <= value <= bounds[1]:
+            raise OverflowError("%r is out of the range of %s" % (value, self.data_type))
+        return value
+
+    def write(self, row, value, timestamp):
+        '''value is converted already, the array checks its range'''
+        self.values[row] = value
+        self.timestamps[row] = timestamp
+        self.update_changed(row)
+
+    def set_health(self, row, health):
+        self.health[row] = health
+        self.update_changed(row)
+
+    def update_changed(self, row):
+        '''Whether the value or health moved away from the last published one'''
+        byte, bit = row >> 3, 1 << (row & 7)
+        if not self.published[byte] & bit or self.health[row] != self.pub_health[row]:
+            changed = True
+        else:
+            value = self.values[row]
+            pub_value = self.pub_values[row]
+            deadband = self.deadbands.get(row) if self.deadbands else None
+            changed = value != pub_value
+            if deadband and changed:
+                try:
+                    changed = abs(value - pub_value) > deadband
+                except TypeError:
+                    pass
+        if changed:
+            self.changed[byte] |= bit
+        else:
+            self.changed[byte] &= ~bit
+
+    def is_changed(self, row):
+        return bool(self.changed[row >> 3] & (1 << (row & 7)))
+
+    def mark_published(self, row):
+        byte, bit = row >> 3, 1 << (row & 7)
+        self.pub_values[row] = self.values[row]
+        self.pub_health[row] = self.health[row]
+        self.published[byte] |= bit
+        self.changed[byte] &= ~bit
+
+    def nbytes(self):
+        '''Bytes of the fields, with the Python objects of an untyped column'''
+        size = len(self.health) * 2 + len(self.timestamps) * self.timestamps.itemsize + \
+            len(self.changed) + len(self.published)
+        if self.typecode is None:
+            objects = dict()
+            for value in list(self.values) + list(self.pub_values):
+                objects[id(value)] = sys.getsizeof(value)
+            size += sum(objects.values()) + sys.getsizeof(self.values) + sys.getsizeof(self.pub_values)
+        else:
+            size += len(self.values) * self.values.itemsize * 2
+        return size
+
+    def state(self):
+        '''The fields as plain data, see restore()'''
+        if self.typecode is None:
+            values, pub_values = list(self.values), list(self.pub_values)
+        else:
+            values, pub_values = self.values.tobytes(), self.pub_values.tobytes()
+        return {"data_type": self.data_type, "values": values, "pub_values": pub_values,
+                "health": bytes(self.health), "pub_health": bytes(self.pub_health),
+                "timestamps": self.timestamps.tobytes(), "changed": bytes(self.changed),
+                "published": bytes(self.published), "deadbands": dict(self.deadbands),
+                "free": list(self.free)}
+
+    def restore(self, state):
+        if self.typecode is None:
+            self.values = list(state["values"])
+            self.pub_values = list(state["pub_values"])
+        else:
+            self.values = array(self.typecode, state["values"])
+            self.pub_values = array(self.typecode, state["pub_values"])
+        self.health = bytearray(state["health"])
+        self.pub_health = bytearray(state["pub_health"])
+        self.timestamps = array("I", state["timestamps"])
+        self.changed = bytearray(state["changed"])
+        self.published = bytearray(state["published"])
+        self.deadbands = dict(state["deadbands"])
+        self.free = list(state["free"])
+
+
+class Measure(object):
+    '''One measure of a MeasureStore, read and written in its column'''
+    __slots__ = ("store", "handle", "ctrl_name", "name")
+
+    def __init__(self, store, handle, ctrl_name, name):
+        self.store = store
+        self.handle = handle
+        self.ctrl_name = ctrl_name
+        self.name = name
+
+    @property
+    def data_type(self):
+        return self.store.column(self.handle).data_type
+
+    @property
+    def value(self):
+        return self.store.value(self.handle)
+
+    @property
+    def health(self):
+        return self.store.health(self.handle)
+
+    @property
+    def timestamp(self):
+        return self.store.timestamp(self.handle)
+
+    def is_changed(self):
+        '''Whether the value or health moved away from the last published one'''
+        return self.store.is_changed(self.handle)
+
+    def mark_published(self):
+        self.store.mark_published(self.handle)
+
+
+class MeasureStore(object):
+    def __init__(self, measures=None):
+        # ctrlName -> name -> handle
+        self._index = dict()
+        self._columns = list()
+        # column dataType -> column id
+        self._column_ids = dict()
+        self._count = 0
+        if measures:
+            self.load(measures)
+
+    def load(self, measures):
+        '''Build the (ctrlName, name) index and the columns from the measures config'''
+        self._index = dict()
+        self._columns = list()
+        self._column_ids = dict()
+        self._count = 0
+        self.add_measures(measures)
+
+    def state(self):
+        '''The index and the columns as plain data, e.g. to save them with the config'''
+        return {"index": self._index, "count": self._count,
+                "columns": [column.state() for column in self._columns]}
+
+    def restore(self, state):
+        self._index = state["index"]
+        self._count = state["count"]
+        self._columns = list()
+        self._column_ids = dict()
+        for column_state in state["columns"]:
+            column = Column(column_state["data_type"])
+            column.restore(column_state)
+            self._column_ids[column.data_type] = len(self._columns)
+            self._columns.append(column)
+
+    def _column_id(self, data_type):
+        key = column_type(data_type)
+        column_id = self._column_ids.get(key)
+        if column_id is None:
+            if len(self._columns) > COLUMN_MASK:
+                raise ValueError("Too many dataTypes in the measure store")
+            column_id = self._column_ids[key] = len(self._columns)
+            self._columns.append(Column(key))
+        return column_id
+
+    def _add(self, mea, value=None):
+        '''value is the one to keep, the default of the dataType if it does not fit'''
+        data_type = mea.get("dataType")
+        column_id = self._column_id(data_type)
+        column = self._columns[column_id]
+        deadband = mea.get("deadband", 0)
+        row = None
+        if value is not None:
+            try:
+                row = column.append(column.convert(value), deadband)
+            except (TypeError, ValueError, OverflowError):
+                pass
+        if row is None:
+            row = column.append(column.convert(default_value(data_type)), deadband)
+        names = self._index.setdefault(mea["ctrlName"], dict())
+        if mea["name"] not in names:
+            self._count += 1
+        names[mea["name"]] = handle = row << COLUMN_BITS | column_id
+        return handle
+
+    def add_measures(self, measures):
+        '''Add the measures of the config, with the default value of their dataType'''
+        for mea in measures:
+            self._add(mea)
+
+    def remove_measures(self, keys):
+        '''keys is a list of (ctrl_name, mea_name), the unknown ones are skipped'''
+        for ctrl_name, mea_name in keys:
+            names = self._index.get(ctrl_name)
+            if names is None or mea_name not in names:
+                continue
+            handle = names.pop(mea_name)
+            if not names:
+                del self._index[ctrl_name]
+            self._columns[handle & COLUMN_MASK].remove(handle >> COLUMN_BITS)
+            self._count -= 1
+
+    def update_measures(self, measures):
+        '''
+            Apply the changed config of existing measures, they keep their
+            value and health. A measure moving to another dataType gets a
+            new handle, and the default value if the former one is not of
+            the new type.
+        '''
+        for mea in measures:
+            handle = self.handle(mea["ctrlName"], mea["name"])
+            if handle is None:
+                self._add(mea)
+                continue
+            column = self._columns[handle & COLUMN_MASK]
+            row = handle >> COLUMN_BITS
+            if column.data_type == column_type(mea.get("dataType")):
+                column.set_deadband(row, mea.get("deadband", 0))
+                continue
+            value, health, timestamp = column.values[row], column.health[row], column.timestamps[row]
+            self.remove_measures([(mea["ctrlName"], mea["name"])])
+            handle = self._add(mea, value)
+            column = self._columns[handle & COLUMN_MASK]
+            column.health[handle >> COLUMN_BITS] = health
+            column.timestamps[handle >> COLUMN_BITS] = timestamp
+
+    def write_many(self, writes):
+        '''
+            writes is a list of (ctrl_name, mea_name, value). All of them are
+            checked against the index and the dataType first, then the
+            valid ones are written together. Returns the handle written, or
+            None for an unknown measure or a value not of its dataType, in
+            the order of writes
+        '''
+        handles = list()
+        values = list()
+        for ctrl_name, mea_name, value in writes:
+            handle = self.handle(ctrl_name, mea_name)
+            if handle is not None:
+                try:
+                    value = self._columns[handle & COLUMN_MASK].convert(value)
+                except (TypeError, ValueError, OverflowError):
+                    handle = None
+            handles.append(handle)
+            values.append(value)
+        timestamp = int(time.time())
+        for i, handle in enumerate(handles):
+            if handle is None:
+                continue
+            try:
+                self._columns[handle & COLUMN_MASK].write(handle >> COLUMN_BITS, values[i], timestamp)
+            except (TypeError, ValueError, OverflowError):
+                handles[i] = None
+        return handles
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return self.handle(*key) is not None
+
+    def handle(self, ctrl_name, mea_name):
+        names = self._index.get(ctrl_name)
+        if names is None:
+            return None
+        return names.get(mea_name)
+
+    def column(self, handle):
+        return self._columns[handle & COLUMN_MASK]
+
+    def exist(self, ctrl_name, mea_name):
+        return self.handle(ctrl_name, mea_name) is not None
+
+    def find(self, ctrl_name, mea_name):
+        handle = self.handle(ctrl_name, mea_name)
+        if handle is None:
+            return None
+        return Measure(self, handle, ctrl_name, mea_name)
+
+    def get_value(self, ctrl_name, mea_name):
+        handle = self.handle(ctrl_name, mea_name)
+        if handle is None:
+            return None
+        return self._columns[handle & COLUMN_MASK].values[handle >> COLUMN_BITS]
+
+    def set_value(self, ctrl_name, mea_name, value):
+        '''False for an unknown measure or a value not of its dataType'''
+        return self.write_many([(ctrl_name, mea_name, value)])[0] is not None
+
+    def set_health(self, ctrl_name, mea_name, health):
+        handle = self.handle(ctrl_name, mea_name)
+        if handle is None:
+            return False
+        self._columns[handle & COLUMN_MASK].set_health(handle >> COLUMN_BITS, health)
+        return True
+
+    def value(self, handle):
+        return self._columns[handle & COLUMN_MASK].values[handle >> COLUMN_BITS]
+
+    def health(self, handle):
+        return self._columns[handle & COLUMN_MASK].health[handle >> COLUMN_BITS]
+
+    def timestamp(self, handle):
+        return self._columns[handle & COLUMN_MASK].timestamps[handle >> COLUMN_BITS]
+
+    def is_changed(self, handle):
+        return self._columns[handle & COLUMN_MASK].is_changed(handle >> COLUMN_BITS)
+
+    def mark_published(self, handle):
+        self._columns[handle & COLUMN_MASK].mark_published(handle >> COLUMN_BITS)
+
+    def nbytes(self):
+        '''Bytes of the columns, without the index'''
+        return sum(column.nbytes() for column in self._columns)
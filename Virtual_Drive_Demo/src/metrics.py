@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+'''
+Counters and histograms of the app.
+
+The instruments are module globals of one registry, REGISTRY, disabled
+until enable() is called. The hot paths test REGISTRY.enabled before they
+take any time or size, so a disabled registry costs one attribute lookup:
+
+    if metrics.REGISTRY.enabled:
+        start = time.perf_counter()
+    ...
+    if metrics.REGISTRY.enabled:
+        metrics.TICK_SECONDS.observe(time.perf_counter() - start)
+
+snapshot() is a dict to publish on the metrics topic, prometheus() the
+Prometheus text exposition format, written to a file for the node
+exporter textfile collector by write_prometheus().
+'''
+
+import os
+import bisect
+import collections
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Counter(object):
+    __slots__ = ("name", "help", "value")
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, None, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    '''A value set by the app, or read from function when exported'''
+    __slots__ = ("name", "help", "value", "function")
+    type = "gauge"
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self):
+        return [(self.name, None, self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+
+class Histogram(object):
+    __slots__ = ("name", "help", "buckets", "counts", "sum", "count")
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # the last one counts the values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = list()
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append((self.name + "_bucket", 'le="%s"' % format_value(bound), cumulative))
+        samples.append((self.name + "_bucket", 'le="+Inf"', self.count))
+        samples.append((self.name + "_sum", None, self.sum))
+        samples.append((self.name + "_count", None, self.count))
+        return samples
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "buckets": dict(zip([format_value(b) for b in self.buckets] + ["+Inf"], self.counts))}
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    def __init__(self):
+        self.enabled = False
+        self._metrics = collections.OrderedDict()
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("Duplicated metric: %s" % metric.name)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help, function=None):
+        return self._add(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=SECONDS_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def prometheus(self):
+        lines = list()
+        for metric in self._metrics.values():
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                if labels:
+                    lines.append("%s{%s} %s" % (name, labels, format_value(value)))
+                else:
+                    lines.append("%s %s" % (name, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        '''Replace path at once, the collector never reads half a file'''
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+
+def enable():
+    REGISTRY.enabled = True
+
+
+def disable():
+    REGISTRY.enabled = False
+
+
+TICK_SECONDS = REGISTRY.histogram(
+    "vdd_tick_seconds", "Time to build, encode and queue the payload of a publish group")
+ENCODE_SECONDS = REGISTRY.histogram(
+    "vdd_encode_seconds", "Time to encode the payload of a publish group")
+PAYLOAD_BYTES = REGISTRY.histogram(
+    "vdd_payload_bytes", "Size of the payloads of the publish groups", BYTES_BUCKETS)
+DISPATCH_SECONDS = REGISTRY.histogram(
+    "vdd_dispatch_seconds", "Time to run the callbacks of a received message")
+WRITE_REQUEST_SECONDS = REGISTRY.histogram(
+    "vdd_write_request_seconds",
+    "Time to apply a write request and queue its response, with its decode when done on the loop")
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "vdd_loop_lag_seconds", "Delay of the scheduled jobs past their deadline")
+PUBLISH_QUEUE_DEPTH = REGISTRY.gauge(
+    "vdd_publish_queue_depth", "Messages waiting for the brokers")
+PUBLISHES = REGISTRY.counter(
+    "vdd_publishes_total", "Payloads of the publish groups queued")
+CONNECTS = REGISTRY.counter(
+    "vdd_connects_total", "MQTT connections established")
+RECONNECTS = REGISTRY.counter(
+    "vdd_reconnects_total", "Reconnects scheduled after a failed attempt or a lost connection")
+LOG_DROPPED = REGISTRY.counter(
+    "vdd_log_dropped_total", "Log records dropped with the log queue full")
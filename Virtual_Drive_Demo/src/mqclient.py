@@ -3,14 +3,32 @@ import os
 import ssl
 import time
 import socket
+import collections
 from socket import gaierror
 import logging as logger
 import paho.mqtt.client as mqtt
-import libevent
+from events import EV_READ, EV_WRITE, EV_PERSIST, LibeventTimer, LibeventEvent
+from codec import get_codec
+from pubqueue import PublishQueue, OVERFLOW_DROP_OLDEST
+from store_forward import SegmentLog
+from topic_trie import TopicTrie
+from workers import OffloadPool, DEFAULT_MAX_PENDING
+from connector import Backoff, ConnectAttempt, resolve
+import metrics
+import logsink
 
 MQ_NOT_READY = 0
 MQ_READY = 1
 
+# States of the connection of MQClientLibevent
+CONN_DISCONNECTED = "disconnected"
+CONN_CONNECTING = "connecting"
+CONN_CONNECTED = "connected"
+CONN_BACKOFF = "backoff"
+
+# Seconds between two batches drained from the store after a reconnect
+STORE_DRAIN_INTERVAL = 0.1
+
 
 def get_port():
     MQTT_BROKER_PORT = 1883
@@ -42,13 +60,40 @@ class LocalPublishError(ValueError):
     pass
 
 
+class PahoClient(mqtt.Client):
+    '''paho client which can start on a socket connected beforehand'''
+
+    def __init__(self, *args, **kwargs):
+        mqtt.Client.__init__(self, *args, **kwargs)
+        self.connected_socket = None
+
+    def _create_socket_connection(self):
+        sock, self.connected_socket = self.connected_socket, None
+        if sock is None:
+            return mqtt.Client._create_socket_connection(self)
+        return sock
+
+    def abort(self):
+        '''Close the socket without DISCONNECT'''
+        self._sock_close()
+
+
 class MQClient(object):
     def __init__(self, client_id,
                  broker_host='127.0.0.1', broker_port=get_port(),
                  username=None, passwd=None, keepalive=60,
                  tls=False, capath=None, max_queue_size=1024,
                  clean_session=None, userdata=None, protocol=mqtt.MQTTv311,
-                 after_connect=None, on_connected=None, on_disconnected=None):
+                 after_connect=None, on_connected=None, on_disconnected=None,
+                 max_inflight=1, ordered_topics=None, auto_reconnect=True):
+        '''
+            max_inflight is the number of QoS>0 messages waiting for their
+            acknowledgement at once, 1 keeps every message in order.
+            With a wider window, the QoS>0 messages of ordered_topics are
+            still sent one after the other, per topic.
+            Without auto_reconnect a lost connection is only reported to
+            on_disconnected, the caller reconnects.
+        '''
         self.client_id = client_id
         self.broker_host = broker_host
         self.broker_port = broker_port
@@ -60,29 +105,50 @@ class MQClient(object):
         self.clean_session = clean_session
         self.userdata = userdata
         self.protocol = protocol
-
-        self.mqtt_client = mqtt.Client(self.client_id, clean_session=self.clean_session,
-                                       userdata=self.userdata,
-                                       protocol=self.protocol)
-        self.mqtt_client.on_connect = self._on_connect
-        self.mqtt_client.on_disconnect = self._on_disconnect
-        # self.mqtt_client.on_subscribe = self._on_subscribe
-        self.mqtt_client.on_publish = self._on_publish
-        self.mqtt_client.on_message = self._on_message
         self.max_queue_size = max_queue_size
-        self.mqtt_client.max_queued_messages_set(self.max_queue_size)
-        self.mqtt_client.max_inflight_messages_set(1)  # force in-order
+        self.max_inflight = max_inflight
+        self.ordered_topics = set(ordered_topics or ())
+        self.auto_reconnect = auto_reconnect
+        # topic -> mid of its message in flight, mid -> topic, and topic ->
+        # the messages waiting for it
+        self._ordered_inflight = dict()
+        self._ordered_mids = dict()
+        self._ordered_backlog = dict()
+
+        self.mqtt_client = self._create_mqtt_client()
         self._on_connected = on_connected
         self._on_disconnected = on_disconnected
         self._after_connect = after_connect
         self._state = MQ_NOT_READY
+        self.queue_overflow = False
         self.subs = dict()
+        self.dispatcher = TopicTrie()
         self.pub_acks = dict()
         self.pub_topic_cbs = dict()
-
-    def connect(self):
-        '''This function should be called once after MQClient object is created'''
+        # mid -> on_ack(acked) of the messages given to publish() with one
+        self.ack_callbacks = dict()
+
+    def _create_mqtt_client(self):
+        mqtt_client = PahoClient(self.client_id, clean_session=self.clean_session,
+                                  userdata=self.userdata,
+                                  protocol=self.protocol)
+        mqtt_client.on_connect = self._on_connect
+        mqtt_client.on_disconnect = self._on_disconnect
+        # mqtt_client.on_subscribe = self._on_subscribe
+        mqtt_client.on_publish = self._on_publish
+        mqtt_client.on_message = self._on_message
+        mqtt_client.max_queued_messages_set(self.max_queue_size)
+        mqtt_client.max_inflight_messages_set(self.max_inflight)
+        return mqtt_client
+
+    def connect(self, sock=None):
+        '''
+            This function should be called once after MQClient object is created.
+            sock is a socket already connected to the broker, e.g. without
+            blocking, otherwise paho connects one.
+        '''
         try:
+            self.mqtt_client.connected_socket = sock
             if self.username and self.passwd:
                 self.mqtt_client.username_pw_set(self.username, self.passwd)
             if self.tls is True and self.capath:
@@ -100,22 +166,19 @@ class MQClient(object):
             if self._after_connect is not None:
                 self._after_connect(self.mqtt_client)
         except gaierror as e:
-            time.sleep(5)
+            # the caller retries later, see MQClientLibevent for a backoff
+            logger.error('reconnect. %s (host: %s)' % (e.__str__(), self.broker_host))
             raise e
         except ValueError as e:
             logger.warn('reconnect -> connect. %s' % e.__str__())
             self.connect()
         except socket.error as se:
             logger.warn('reconnect -> connect. %s' % se.__str__())
-            self.mqtt_client = mqtt.Client(self.client_id, clean_session=self.clean_session,
-                                           userdata=self.userdata,
-                                           protocol=self.protocol)
-            self.mqtt_client.on_connect = self._on_connect
-            self.mqtt_client.on_disconnect = self._on_disconnect
-            self.mqtt_client.on_publish = self._on_publish
-            self.mqtt_client.on_message = self._on_message
-            self.mqtt_client.max_queued_messages_set(self.max_queue_size)
-            self.mqtt_client.max_inflight_messages_set(1)  # force in-order
+            self.mqtt_client = self._create_mqtt_client()
+            # the messages in flight are gone with the former client
+            self._ordered_inflight.clear()
+            self._ordered_mids.clear()
+            self._fail_acks()
             self.connect()
         except Exception as e:
             logger.error('reconnect. %s (host: %s, port: %s)' % (e.__str__(), self.broker_host, self.broker_port))
@@ -123,6 +186,17 @@ class MQClient(object):
     def disconnect(self):
         return self.mqtt_client.disconnect()
 
+    def abort(self):
+        '''Drop the connection without DISCONNECT, e.g. when the broker does not answer'''
+        self.mqtt_client.abort()
+        self._state = MQ_NOT_READY
+
+    def _fail_acks(self):
+        callbacks = list(self.ack_callbacks.values())
+        self.ack_callbacks.clear()
+        for on_ack in callbacks:
+            on_ack(False)
+
     def loop(self):
         '''This function could be called in a while True loop'''
         try:
@@ -150,6 +224,10 @@ class MQClient(object):
         if self.mqtt_client.want_write():
             self.mqtt_client.loop_write()
 
+    def want_write(self):
+        '''Whether some packets are still waiting for the socket'''
+        return self.mqtt_client.want_write()
+
     def socket(self):
         return self.mqtt_client.socket()
 
@@ -162,34 +240,64 @@ class MQClient(object):
     def add_sub(self, topic, callback, qos=MqttSetting.MQTT_QOS_LEVEL):
         '''
             This function should be call after MQClient object is created
-            callback is a function(payload)
+            callback is a function(topic, payload). Several callbacks may be
+            added to a topic, and every subscription matching a message fires.
         '''
         d = dict()
         d['callback'] = callback
         d['qos'] = qos
         self.subs[topic] = d
+        self.dispatcher.add(topic, callback)
         if self._state == MQ_READY:
             qos = self.subs[topic]['qos']
             logger.debug('key %s, value %s' % (topic, qos))
             self.mqtt_client.subscribe(topic, qos)
 
-    def del_sub(self, topic):
+    def del_sub(self, topic, callback=None):
+        '''Remove a callback of topic, or all of them without callback'''
         if topic in self.subs:
+            if self.dispatcher.remove(topic, callback):
+                return
             del self.subs[topic]
             if self._state == MQ_READY:
                 self.mqtt_client.unsubscribe(topic)
 
-    def publish(self, topic, payload, qos=MqttSetting.MQTT_QOS_LEVEL, userdata=None):
+    def publish(self, topic, payload, qos=MqttSetting.MQTT_QOS_LEVEL, userdata=None, on_ack=None):
+        '''
+            Returns False if the message is neither queued by paho nor held
+            behind the message in flight of its ordered topic, queue_overflow
+            tells if it is because a queue is full. It never waits for the
+            queue to drain, the caller should retry later.
+            on_ack(True) is called once the broker acknowledged a QoS>0
+            message, or a QoS 0 one is written to the socket, on_ack(False)
+            if it is lost with the connection.
+        '''
+        self.queue_overflow = False
+        if qos > 0 and topic in self.ordered_topics:
+            backlog = self._ordered_backlog.setdefault(topic, collections.deque())
+            if topic in self._ordered_inflight or backlog:
+                if self.max_queue_size and len(backlog) >= self.max_queue_size:
+                    self.queue_overflow = True
+                    return False
+                backlog.append((payload, qos, userdata, on_ack))
+                return True
+        return self._publish(topic, payload, qos, userdata, on_ack)
+
+    def _publish_next_ordered(self, topic):
+        backlog = self._ordered_backlog.get(topic)
+        if backlog and topic not in self._ordered_inflight:
+            payload, qos, userdata, on_ack = backlog[0]
+            if self._publish(topic, payload, qos, userdata, on_ack):
+                backlog.popleft()
+
+    def _publish(self, topic, payload, qos, userdata, on_ack=None):
         if self.get_state() == MQ_READY:
             try:
                 mqttc_msg_info = self.mqtt_client.publish(topic, payload, qos)
                 if mqttc_msg_info.rc is mqtt.MQTT_ERR_QUEUE_SIZE:
                     logger.info("publish return warning: %d(%s)" % (
                                 mqttc_msg_info.rc, 'local queue overflow'))
-                    for _ in range(0, mqtt.MQTT_ERR_QUEUE_SIZE):
-                        if self.loop() > 0:
-                            raise socket.error("Unknown exception...")
-                        # self.mqtt_client.loop_write()
+                    self.queue_overflow = True
                 elif (mqttc_msg_info.rc is not mqtt.MQTT_ERR_SUCCESS) \
                         and (mqttc_msg_info.rc is not mqtt.MQTT_ERR_NO_CONN):
                     logger.error("publish() return error: %d(%s)" % (
@@ -205,20 +313,32 @@ class MQClient(object):
                         d['topic'] = topic
                         d['userdata'] = userdata
                         self.pub_acks[mqttc_msg_info.mid] = d
+                    if qos > 0 and topic in self.ordered_topics:
+                        self._ordered_inflight[topic] = mqttc_msg_info.mid
+                        self._ordered_mids[mqttc_msg_info.mid] = topic
+                    if on_ack is not None:
+                        if qos == 0 and mqttc_msg_info.rc is mqtt.MQTT_ERR_NO_CONN:
+                            # paho drops QoS 0 messages without connection
+                            on_ack(False)
+                        elif mqttc_msg_info.is_published():
+                            # a QoS 0 message written within publish()
+                            on_ack(True)
+                        else:
+                            self.ack_callbacks[mqttc_msg_info.mid] = on_ack
                     # schedule loop write when msg is queued. If fail, wait for
                     # loop_misc() to retry
                     # self.mqtt_client.loop_write()  # this function will block process if qos =0
                     return True
             except socket.error as err:
                 logger.error(
-                    "publish() exception: %s topic %s  payload %s" %
-                    (err.__str__(), topic, payload))
+                    "publish() exception: %s topic %s  payload %s",
+                    err.__str__(), topic, logsink.Truncated(payload))
                 self._on_disconnect(self.mqtt_client, None,
                                     mqtt.MQTT_ERR_NO_CONN)
             except Exception as e:
                 logger.error(
-                    "publish() exception: %s topic %s  payload %s" %
-                    (e.__str__(), topic, payload))
+                    "publish() exception: %s topic %s  payload %s",
+                    e.__str__(), topic, logsink.Truncated(payload))
         return False
 
     def _subscribe_topics(self):
@@ -232,13 +352,16 @@ class MQClient(object):
         if rc == mqtt.CONNACK_ACCEPTED:
             self._state = MQ_READY
             self._subscribe_topics()
+            for topic in list(self._ordered_backlog.keys()):
+                self._publish_next_ordered(topic)
             if self._on_connected is not None:
                 self._on_connected(client)
         elif rc == mqtt.CONNACK_REFUSED_SERVER_UNAVAILABLE:
             if self._state == MQ_READY:
                 if self._on_disconnected is not None:
                     self._on_disconnected(client)
-                self.reconnect()
+                if self.auto_reconnect:
+                    self.reconnect()
         else:
             if self._state == MQ_READY:
                 if self._on_disconnected is not None:
@@ -256,12 +379,20 @@ class MQClient(object):
             self._state = MQ_NOT_READY
             if self._on_disconnected is not None:
                 self._on_disconnected(client)
-            self.reconnect()
+            if self.auto_reconnect:
+                self.reconnect()
 
     def _on_subscribe(self, client, userdata, mid, granted_qos):
         pass
 
     def _on_publish(self, client, userdata, mid):
+        on_ack = self.ack_callbacks.pop(mid, None)
+        if on_ack is not None:
+            on_ack(True)
+        topic = self._ordered_mids.pop(mid, None)
+        if topic is not None:
+            del self._ordered_inflight[topic]
+            self._publish_next_ordered(topic)
         if mid in self.pub_acks.keys():
             topic = self.pub_acks[mid]['topic']
             # print('on_publish topic %s, mid %d' % (topic, mid))
@@ -273,26 +404,29 @@ class MQClient(object):
             del self.pub_acks[mid]
 
     def _on_message(self, client, userdata, msg):
-        found = False
         # logger.info('MQ Client receives message, topic %s ...' %
         #                   msg.topic)
-        for sub in self.subs.keys():
-            if mqtt.topic_matches_sub(sub, msg.topic):
-                found = True
-                callback = self.subs[sub]['callback']
-                if callback is not None:
-                    try:
-                        callback(msg.topic, msg.payload)
-                    except Exception as e:
-                        logger.warn('%s' % e.__str__())
-                break
-        if not found:
-            pass
+        if metrics.REGISTRY.enabled:
+            start = time.perf_counter()
+        for callback in self.dispatcher.match(msg.topic):
+            if callback is not None:
+                try:
+                    callback(msg.topic, msg.payload)
+                except Exception as e:
+                    logger.warn('%s' % e.__str__())
+        if metrics.REGISTRY.enabled:
+            metrics.DISPATCH_SECONDS.observe(time.perf_counter() - start)
 
 
 class MQClientLibevent(object):
-    def __init__(self, base, client_id):
+    # Make the timers and the socket events on base
+    timer_factory = LibeventTimer
+    event_factory = LibeventEvent
+
+    def __init__(self, base, client_id, codec=None):
         self.base = base
+        # Encodes the payloads which are not bytes or str yet
+        self.codec = codec or get_codec()
         self.mqclient = None
         self.readEvt = None
         self.writeEvt = None
@@ -305,11 +439,45 @@ class MQClientLibevent(object):
         self.clean_session = None
         self.max_queue_size = 1024
         self.protocol = mqtt.MQTTv311
+        self.max_inflight = 1
+        self.ordered_topics = set()
+        # Messages waiting while the broker is not ready or the socket is busy
+        self.pending_queue_size = 1024
+        self.pending_policy = OVERFLOW_DROP_OLDEST
+        self.pending = None
+        # Max pending messages handed to paho per loop callback
+        self.drain_batch = 100
+        # The last drain stopped on drain_batch, not on a busy socket or queue
+        self._drain_again = False
+        # Disk log of the messages published while the broker is down,
+        # disabled without store_path. It is drained at store_rate messages
+        # per second after a reconnect, behind the live messages.
+        self.store_path = None
+        self.store_max_size = 64 * 1024 * 1024
+        self.store_rate = 100
+        self.store = None
+        self._store_draining = False
+        # Workers of the subscriptions added with an executor
+        self.offload_threads = 4
+        self.offload_processes = 2
+        self.offload_pools = dict()
+        # The broker is connected without blocking the loop, and retried
+        # with backoff. connect_timeout bounds the TCP connect and the MQTT
+        # handshake together.
+        self.connect_timeout = 10
+        self.backoff = Backoff(initial=1, maximum=60)
+        self.conn_state = CONN_DISCONNECTED
+        self.state_callbacks = list()
+        self._attempt = None
 
         self.timer = 1
 
-        self.mq_timer = libevent.Timer(
+        self.mq_timer = self.timer_factory(
             self.base, self._mq_timer_handler, userdata=None)
+        self.store_timer = self.timer_factory(
+            self.base, self._store_timer_handler, userdata=None)
+        self.connect_timer = self.timer_factory(
+            self.base, self._connect_timer_handler, userdata=None)
 
     def init_mqclient(self):
         self.mqclient = MQClient(
@@ -322,78 +490,263 @@ class MQClientLibevent(object):
             max_queue_size=self.max_queue_size,
             clean_session=self.clean_session,
             protocol=self.protocol,
+            max_inflight=self.max_inflight,
+            ordered_topics=self.ordered_topics,
+            auto_reconnect=False,
             after_connect=self._after_connect,
+            on_connected=self._on_connected,
             on_disconnected=self._on_disconnected)
-
-    def linkCheckout(self):
-        try:
-            s = socket.socket()
-            s.settimeout(1)
-            status = s.connect_ex((self.target_host, self.target_port))
-            s.close()
-            if status == 0:
-                logger.debug("Network Connection OK.")
-                return True
-        except Exception as e:
-            logger.debug("Link checkout except: %s" % e)
-        logger.warn("Network connection failed. host: %s, port: %s" % (self.target_host, self.target_port))
-        return False
+        self.pending = PublishQueue(self.pending_queue_size, self.pending_policy)
+        if self.store_path:
+            self.store = SegmentLog(self.store_path, self.store_max_size)
 
     def loop(self):
         self.mqclient.loop()
 
     def connect(self):
-        if self.linkCheckout():
-            self.mqclient.connect()
+        '''Start connecting, the connection is then kept up until disconnect()'''
+        self.backoff.reset()
+        self._start_connect()
         self.mq_timer.add(self.timer)
 
     def disconnect(self):
         self.mq_timer.delete()
+        self.connect_timer.delete()
+        self._cancel_attempt()
+        self._set_conn_state(CONN_DISCONNECTED)
         self.mqclient.disconnect()
 
-    def add_sub(self, topic, callback, qos=MqttSetting.MQTT_QOS_LEVEL):
+    def add_state_callback(self, callback):
+        '''callback(state) is called on every change of conn_state'''
+        self.state_callbacks.append(callback)
+
+    def _set_conn_state(self, state):
+        if state == self.conn_state:
+            return
+        logger.info("MQ connection %s -> %s" % (self.conn_state, state))
+        self.conn_state = state
+        for callback in self.state_callbacks:
+            try:
+                callback(state)
+            except Exception as e:
+                logger.warn('%s' % e.__str__())
+
+    def _start_connect(self):
+        self._set_conn_state(CONN_CONNECTING)
+        self.connect_timer.add(self.connect_timeout)
+        self._attempt = ConnectAttempt(self.base, self._on_socket_connected, self._on_connect_failed,
+                                       self.event_factory)
+        self._attempt.start(self.target_host, self.target_port, self._resolve)
+
+    def _resolve(self, host, port, on_result, on_error):
+        self._offload_pool("thread").handler(resolve, on_result, 1, on_error)(host, port)
+
+    def _cancel_attempt(self):
+        if self._attempt is not None:
+            self._attempt.cancel()
+            self._attempt = None
+
+    def _on_socket_connected(self, sock):
+        # the MQTT handshake is left, under the same connect_timeout
+        self._attempt = None
+        self.mqclient.connect(sock)
+
+    def _on_connect_failed(self, reason):
+        self._attempt = None
+        logger.warn("Network connection failed. host: %s, port: %s, %s" % (
+            self.target_host, self.target_port, reason))
+        self._retry_later()
+
+    def _retry_later(self):
+        metrics.RECONNECTS.inc()
+        delay = self.backoff.next()
+        self._set_conn_state(CONN_BACKOFF)
+        logger.info("Reconnect in %.1fs" % delay)
+        self.connect_timer.add(delay)
+
+    def _connect_timer_handler(self, evt, userdata):
+        if self.conn_state == CONN_BACKOFF:
+            self._start_connect()
+        elif self.conn_state == CONN_CONNECTING:
+            logger.warn("Connection to %s:%s timed out" % (self.target_host, self.target_port))
+            self._cancel_attempt()
+            self._delete_events()
+            self.mqclient.abort()
+            self._retry_later()
+
+    def _on_connected(self, client):
+        self.connect_timer.delete()
+        self.backoff.reset()
+        metrics.CONNECTS.inc()
+        self._set_conn_state(CONN_CONNECTED)
+
+    def add_sub(self, topic, callback, qos=MqttSetting.MQTT_QOS_LEVEL,
+                executor=None, on_result=None, max_pending=DEFAULT_MAX_PENDING):
+        '''
+            With executor "thread" or "process", callback(topic, payload)
+            runs off the loop and on_result(topic, result) is called on the
+            loop thread with what it returns. A process callback and its
+            result must be picklable. At most max_pending messages wait for
+            the callback, the next ones are dropped.
+            Returns the callback subscribed, to give to del_sub.
+        '''
+        if executor is not None:
+            callback = self._offload_pool(executor).handler(callback, on_result, max_pending)
         self.mqclient.add_sub(topic, callback, qos)
+        return callback
+
+    def _offload_pool(self, executor):
+        if executor not in self.offload_pools:
+            # concurrent.futures is imported only by the apps offloading
+            if executor == "thread":
+                from concurrent.futures import ThreadPoolExecutor
+                pool = ThreadPoolExecutor(self.offload_threads)
+            elif executor == "process":
+                from concurrent.futures import ProcessPoolExecutor
+                pool = ProcessPoolExecutor(self.offload_processes)
+            else:
+                raise ValueError("Unknown executor: %s" % executor)
+            self.offload_pools[executor] = OffloadPool(self.base, pool, self.event_factory)
+        return self.offload_pools[executor]
 
-    def del_sub(self, topic):
-        self.mqclient.del_sub(topic)
+    def del_sub(self, topic, callback=None):
+        self.mqclient.del_sub(topic, callback)
 
-    def publish(self, topic, payload, qos=MqttSetting.MQTT_QOS_LEVEL, userdata=None):
-        res = self.mqclient.publish(topic, payload, qos, userdata=userdata)
-        if res:
-            self.writeEvt.add()
+    def publish(self, topic, payload, qos=MqttSetting.MQTT_QOS_LEVEL, userdata=None, coalesce_key=None,
+                on_ack=None):
+        '''
+            The message is queued while the broker is not ready or the socket
+            is busy, and sent in order once it can be. A pending message with
+            the same coalesce_key is replaced by this one. While the store
+            holds messages, the ones of ordered_topics are stored behind
+            them rather than sent ahead.
+            on_ack(acked) is called as by MQClient.publish, and with False
+            if the message is dropped or kept in the store.
+            Returns False if the message is dropped.
+        '''
+        if not isinstance(payload, (bytes, bytearray, str)):
+            payload = self.codec.dumps(payload)
+        if self.store is not None and self.store and topic in self.ordered_topics:
+            return self._store_message(topic, payload, qos, on_ack)
+        if not self.pending and self.is_ready() and not self.mqclient.want_write():
+            if self.mqclient.publish(topic, payload, qos, userdata=userdata, on_ack=on_ack):
+                self._update_write_interest()
+                return True
+            if not self.mqclient.queue_overflow and self.is_ready():
+                if on_ack is not None:
+                    on_ack(False)
+                return False
+        if self.store is not None and not self.is_ready():
+            return self._store_message(topic, payload, qos, on_ack)
+        res = self.pending.put(topic, payload, qos, userdata, coalesce_key, on_ack)
+        self._update_write_interest()
         return res
 
+    def _store_message(self, topic, payload, qos, on_ack=None):
+        self.store.append(topic, payload, qos)
+        self._arm_store_drain()
+        if on_ack is not None:
+            on_ack(False)
+        return True
+
+    def _drain_pending(self):
+        sent = 0
+        while self.pending and sent < self.drain_batch:
+            if not self.is_ready() or self.mqclient.want_write():
+                break
+            msg = self.pending.peek()
+            if not self.mqclient.publish(msg.topic, msg.payload, msg.qos, userdata=msg.userdata,
+                                         on_ack=msg.on_ack):
+                if self.mqclient.queue_overflow or not self.is_ready():
+                    break
+                # paho refused it for good
+                self.pending.pop().drop()
+                continue
+            self.pending.pop()
+            sent += 1
+        self._drain_again = sent >= self.drain_batch and bool(self.pending)
+        if sent:
+            self._update_write_interest()
+
+    def _update_write_interest(self):
+        '''
+            The write event stays armed as long as paho has data to send or
+            the pending messages were cut by drain_batch. Otherwise they are
+            drained on the acks making room in paho's queue.
+        '''
+        if self.writeEvt is None:
+            return
+        if self.mqclient.want_write() or self._drain_again:
+            self.writeEvt.add()
+        else:
+            self.writeEvt.delete()
+
     def is_ready(self):
         return self.mqclient.is_ready()
 
+    def health(self):
+        return {"host": self.target_host,
+                "port": self.target_port,
+                "state": self.conn_state,
+                "pending": len(self.pending) if self.pending is not None else 0,
+                "dropped": self.pending.dropped if self.pending is not None else 0,
+                "stored": len(self.store) if self.store is not None else 0}
+
+    def _arm_store_drain(self):
+        if not self._store_draining and self.readEvt is not None:
+            self._store_draining = True
+            self.store_timer.add(STORE_DRAIN_INTERVAL)
+
+    def _store_timer_handler(self, evt, userdata):
+        if not self.store or self.readEvt is None:
+            # empty or disconnected, _after_connect or publish re-arms it
+            self._store_draining = False
+            return
+        if self.is_ready():
+            last = None
+            for msg in self.store.peek(max(1, int(self.store_rate * STORE_DRAIN_INTERVAL))):
+                # the live messages go first
+                if self.pending or self.mqclient.want_write():
+                    break
+                if not self.mqclient.publish(msg.topic, msg.payload, msg.qos):
+                    if self.mqclient.queue_overflow or not self.is_ready():
+                        break
+                    logger.warn("drop stored message of topic %s refused by paho" % msg.topic)
+                last = msg
+            if last is not None:
+                self.store.commit(last)
+                self._update_write_interest()
+        self.store_timer.add(STORE_DRAIN_INTERVAL)
+
     def _mq_timer_handler(self, evt, userdata):
         timestamp = time.time()
         try:
             if self.readEvt is not None:
                 self.mqclient.loop_misc()
                 self.mqclient.loop_write()
-            elif self.linkCheckout():
-                self.mqclient.reconnect()
-            else:
-                self.timer = 15
+                self._drain_pending()
+                self._update_write_interest()
         except Exception as e:
             logger.error('%s' % e.__str__())
         use_time = time.time() - timestamp
         self.mq_timer.add(abs(use_time) + self.timer)
 
     def _mq_do_read(self, evt, fd, what, userdata):
-        # TODO: For QoS>0, will loop_read() handle and send the protocol
-        # packages? Or it only push the protocol packages to the queue and
-        # wait the loop_write() to acturly send them?
+        # For QoS>0 loop_read() queues the protocol packets (PUBACK, PUBREL,
+        # ...), paho writes what the socket takes and the write event
+        # sends the rest
         self.mqclient.loop_read()
         if self.readEvt is not None:
             self.readEvt.add()
+            if self.pending:
+                self._drain_pending()
+            self._update_write_interest()
 
     def _mq_do_write(self, evt, fd, what, userdata):
         self.mqclient.loop_write()
-        # TODO: This writeEvt will only be called one time,
-        # is that a good thing?
-        # self.writeEvt.add()
+        if self.pending:
+            self._drain_pending()
+        self._update_write_interest()
 
     def _after_connect(self, client):
         if self.mqclient.socket() is not None:
@@ -401,21 +754,28 @@ class MQClientLibevent(object):
                 self.readEvt.delete()
             if self.writeEvt is not None:
                 self.writeEvt.delete()
-            self.readEvt = libevent.Event(
+            self.readEvt = self.event_factory(
                 self.base, client.socket().fileno(),
-                libevent.EV_READ | libevent.EV_PERSIST, self._mq_do_read)
-            self.writeEvt = libevent.Event(
+                EV_READ | EV_PERSIST, self._mq_do_read)
+            self.writeEvt = self.event_factory(
                 self.base, client.socket().fileno(),
-                libevent.EV_WRITE, self._mq_do_write)
+                EV_WRITE | EV_PERSIST, self._mq_do_write)
             logger.debug('add MQ read & write event')
             self.readEvt.add()
-            self.writeEvt.add()
-            self.timer = 1
+            self._update_write_interest()
+            if self.store:
+                self._arm_store_drain()
 
     def _on_disconnected(self, client):
+        self._delete_events()
+        if self.conn_state in (CONN_CONNECTING, CONN_CONNECTED):
+            self._retry_later()
+
+    def _delete_events(self):
         logger.warn('delete MQ read & write event')
-        self.readEvt.delete()
-        self.writeEvt.delete()
+        if self.readEvt is not None:
+            self.readEvt.delete()
+        if self.writeEvt is not None:
+            self.writeEvt.delete()
         self.readEvt = None
         self.writeEvt = None
-        # self.mq_timer.delete()
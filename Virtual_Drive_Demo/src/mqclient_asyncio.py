@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+'''
+MQ client on an asyncio loop.
+
+MQClientAsyncio is MQClientLibevent with an asyncio loop in place of the
+libevent Base, the socket is watched with loop.add_reader() and
+add_writer(). Once connected, paho's keepalive is checked on deadlines
+KEEPALIVE_CHECKS times per keepalive period rather than on a poll timer.
+publish_acked() returns a future of the broker acknowledgement, to await
+in the coroutines of an asyncio driver.
+'''
+
+import logging as logger
+from mqclient import MQClientLibevent, MqttSetting
+from asyncio_events import AsyncioTimer, AsyncioEvent
+
+# paho pings the broker when nothing was sent for a keepalive period, so
+# it is checked often enough to ping before the broker gives up
+KEEPALIVE_CHECKS = 4
+
+
+class MQClientAsyncio(MQClientLibevent):
+    timer_factory = AsyncioTimer
+    event_factory = AsyncioEvent
+
+    def __init__(self, loop, client_id, codec=None):
+        MQClientLibevent.__init__(self, loop, client_id, codec=codec)
+        self.aio_loop = loop
+        self._keepalive_deadline = None
+
+    def publish_acked(self, topic, payload, qos=MqttSetting.MQTT_QOS_LEVEL, userdata=None, coalesce_key=None):
+        '''
+            publish() returning a future of the acknowledgement. It is True
+            once the broker acknowledged the message, or a QoS 0 one is
+            written to the socket, and False if the message is dropped,
+            kept in the store or lost with the connection.
+        '''
+        future = self.aio_loop.create_future()
+
+        def on_ack(acked):
+            if not future.done():
+                future.set_result(acked)
+
+        self.publish(topic, payload, qos, userdata=userdata, coalesce_key=coalesce_key, on_ack=on_ack)
+        return future
+
+    def _mq_timer_handler(self, evt, userdata):
+        if self.readEvt is None:
+            # not connected, retry as MQClientLibevent does
+            MQClientLibevent._mq_timer_handler(self, evt, userdata)
+            return
+        try:
+            self.mqclient.loop_misc()
+            self.mqclient.loop_write()
+            self._drain_pending()
+            self._update_write_interest()
+        except Exception as e:
+            logger.error('%s' % e.__str__())
+        if self.readEvt is None:
+            self.mq_timer.add(self.timer)
+        else:
+            self._arm_keepalive()
+
+    def _arm_keepalive(self):
+        step = self.keepalive / KEEPALIVE_CHECKS
+        now = self.aio_loop.time()
+        if self._keepalive_deadline is None or self._keepalive_deadline + step <= now:
+            self._keepalive_deadline = now + step
+        else:
+            self._keepalive_deadline += step
+        self.mq_timer.add(self._keepalive_deadline - now)
@@ -4,19 +4,265 @@ import os
 import json
 import logging
 from mobiuspi_lib.config import Config as AppConfig
+from pubqueue import OVERFLOW_DROP_OLDEST, OVERFLOW_POLICIES
+from config_snapshot import ConfigSnapshot
+import logsink
+
+# Publish every measure on every tick
+PUBLISH_MODE_FULL = "full"
+# Publish only the measures changed since the last publish (report by exception)
+PUBLISH_MODE_DELTA = "delta"
+# Seconds between two full snapshots in delta mode
+DEFAULT_SNAPSHOT_INTERVAL = 300
+# Seconds between two publishes of the measures without their own period
+DEFAULT_PUBLISH_PERIOD = 5
+DEFAULT_PUBLISH_GROUP = "default"
+# Messages kept while the broker is not ready
+DEFAULT_PUBLISH_QUEUE_SIZE = 1024
+# Event loops the app runs on
+BACKEND_LIBEVENT = "libevent"
+BACKEND_ASYNCIO = "asyncio"
+BACKENDS = (BACKEND_LIBEVENT, BACKEND_ASYNCIO)
+# Executors of the write requests, None handles them on the loop
+WRITE_EXECUTORS = (None, "thread", "process")
+# Write requests waiting for the executor
+DEFAULT_WRITE_MAX_PENDING = 100
+# The topic of the metrics of the app, on the local broker
+DEFAULT_METRICS_TOPIC = "app/Virtual_Drive_Demo/metrics"
+# Seconds between two exports of the metrics
+DEFAULT_METRICS_PERIOD = 60
+# The published and received payloads are logged at this level
+DEFAULT_LOG_PAYLOAD_LEVEL = "debug"
+# Seconds between two checks of the config file for changes, 0 never: the
+# config is read once at start unless "reload_interval" is set
+DEFAULT_RELOAD_INTERVAL = 0
+# The sections applied by a reload, a change of the others needs a restart
+RELOAD_SECTIONS = ("controllers", "measures", "groups")
+# The attributes of ConfigPars not kept in its snapshot
+SNAPSHOT_EXCLUDED = ("app_config", "snapshot", "snapshot_state")
+
+
+def log_level(name):
+    level = logging.getLevelName(str(name).upper())
+    if not isinstance(level, int):
+        raise ValueError("Unknown log level: %s" % name)
+    return level
+
+
+def controller_shards(cfg, shards, former=None):
+    '''
+        controller name -> the worker owning it. The controllers of former,
+        the owners before a reload, keep their worker. Each other controller
+        goes to the worker with the fewest measures so far, in config order,
+        so the split is the same in every process.
+    '''
+    counts = dict()
+    for mea in cfg.get("measures", list()):
+        counts[mea["ctrlName"]] = counts.get(mea["ctrlName"], 0) + 1
+    controllers = cfg.get("controllers", list())
+    loads = [0] * shards
+    owners = dict()
+    if former:
+        for ctrl in controllers:
+            shard = former.get(ctrl["name"])
+            if shard is not None and shard < shards:
+                owners[ctrl["name"]] = shard
+                loads[shard] += max(1, counts.get(ctrl["name"], 0))
+    for ctrl in controllers:
+        if ctrl["name"] in owners:
+            continue
+        shard = loads.index(min(loads))
+        owners[ctrl["name"]] = shard
+        loads[shard] += max(1, counts.get(ctrl["name"], 0))
+    return owners
+
+
+class ConfigDiff(object):
+    '''The controllers and measures added, removed and changed by a reload'''
+
+    def __init__(self):
+        # the config dicts of the new config, the removed ones of the former
+        self.added_controllers = list()
+        self.removed_controllers = list()
+        self.changed_controllers = list()
+        self.added_measures = list()
+        self.removed_measures = list()
+        self.changed_measures = list()
+        # the other sections that changed
+        self.restart_sections = list()
+
+    def __bool__(self):
+        return any((self.added_controllers, self.removed_controllers, self.changed_controllers,
+                    self.added_measures, self.removed_measures, self.changed_measures,
+                    self.restart_sections))
+
+    def summary(self):
+        return "controllers +%d -%d ~%d, measures +%d -%d ~%d" % (
+            len(self.added_controllers), len(self.removed_controllers), len(self.changed_controllers),
+            len(self.added_measures), len(self.removed_measures), len(self.changed_measures))
+
+
+def diff_by_key(old, new, key):
+    '''The added, removed and changed items of the lists old and new'''
+    old_items = {key(item): item for item in old}
+    added = list()
+    changed = list()
+    for item in new:
+        former = old_items.pop(key(item), None)
+        if former is None:
+            added.append(item)
+        elif former != item:
+            changed.append(item)
+    return added, list(old_items.values()), changed
+
+
+def measures_by_controller(measures):
+    ctrl_measures = dict()
+    for mea in measures:
+        ctrl_measures.setdefault(mea["ctrlName"], list()).append(mea)
+    return ctrl_measures
+
+
+def diff_config(old, new):
+    '''The ConfigDiff of the ConfigPars old and new'''
+    diff = ConfigDiff()
+    diff.added_controllers, diff.removed_controllers, diff.changed_controllers = diff_by_key(
+        old.cfg.get("controllers", list()), new.cfg.get("controllers", list()), lambda ctrl: ctrl["name"])
+    if old.cfg.get("measures") != new.cfg.get("measures"):
+        # the measures of a controller are compared one by one only if its list changed
+        old_measures = dict(old.measures_by_ctrl)
+        for ctrl_name, mea_list in new.measures_by_ctrl.items():
+            former = old_measures.pop(ctrl_name, list())
+            if former == mea_list:
+                continue
+            added, removed, changed = diff_by_key(former, mea_list, lambda mea: mea["name"])
+            diff.added_measures.extend(added)
+            diff.removed_measures.extend(removed)
+            diff.changed_measures.extend(changed)
+        for mea_list in old_measures.values():
+            diff.removed_measures.extend(mea_list)
+    for section in sorted(set(old.cfg) | set(new.cfg)):
+        if section in RELOAD_SECTIONS or old.cfg.get(section) == new.cfg.get(section):
+            continue
+        if section == "publish":
+            # the period of the default group is applied
+            old_publish = {k: v for k, v in old.cfg.get(section, dict()).items() if k != "period"}
+            new_publish = {k: v for k, v in new.cfg.get(section, dict()).items() if k != "period"}
+            if old_publish == new_publish:
+                continue
+        diff.restart_sections.append(section)
+    return diff
+
+
+class ConfigWatcher(object):
+    '''Tells whether a file changed since the last check, by its mtime and size'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stamp = self._stamp()
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def changed(self):
+        stamp = self._stamp()
+        if stamp is None or stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
 
 
 class ConfigPars:
     def __init__(self, APP_NAME):
         self.cfg = dict()
+        self.backend = BACKEND_LIBEVENT
+        self.workers = 1
+        self.reload_interval = DEFAULT_RELOAD_INTERVAL
+        # the ConfigSnapshot of the file, and what was loaded from it
+        self.snapshot_enabled = True
+        self.snapshot = None
+        self.snapshot_state = None
+        self.ctrl_measures = dict()
+        # every measure by controller name, with the ones of unknown controllers
+        self.measures_by_ctrl = dict()
+        self.publish_mode = PUBLISH_MODE_FULL
+        self.snapshot_interval = DEFAULT_SNAPSHOT_INTERVAL
+        self.publish_codec = None
+        self.publish_period = DEFAULT_PUBLISH_PERIOD
+        self.publish_groups = list()
+        self.publish_queue_size = DEFAULT_PUBLISH_QUEUE_SIZE
+        self.publish_overflow = OVERFLOW_DROP_OLDEST
+        self.publish_qos = 0
+        self.publish_max_inflight = 1
+        self.store_forward = dict()
+        self.write_executor = None
+        self.write_max_pending = DEFAULT_WRITE_MAX_PENDING
+        self.brokers = list()
+        self.metrics_enabled = False
+        self.metrics_period = DEFAULT_METRICS_PERIOD
+        self.metrics_topic = DEFAULT_METRICS_TOPIC
+        self.metrics_prometheus_file = None
+        self.log_level = logging.INFO
+        self.log_queue_size = logsink.DEFAULT_QUEUE_SIZE
+        self.log_payload_level = log_level(DEFAULT_LOG_PAYLOAD_LEVEL)
+        self.log_payload_every = 1
+        self.log_payload_max_length = logsink.DEFAULT_MAX_LENGTH
         self.app_name = APP_NAME
         self.app_config = AppConfig(app_name=APP_NAME)
         self.app_base_path = self.app_config.app_base_path
         self.filename = self.app_base_path + '/cfg/' + self.app_name + '/' + self.app_name + '.cfg'
+        # the private data of the app, e.g. the config snapshot
+        self.data_path = self.app_base_path + '/data/' + self.app_name
 
-    def load_config_file(self):
+    def resolve_filename(self):
+        '''The config of the app, the config.ini of its package by default'''
         if not os.path.exists(self.filename):
             self.filename = self.app_base_path + "/app/" + self.app_name + "/config.ini"
+        return self.filename
+
+    def load(self, shard=0, shards=1, codec_name=None, owners=None):
+        '''
+            load_config_file() from the snapshot of the file when it is up
+            to date. The snapshot state, with the state of the objects built
+            from the config saved by save_snapshot(), is kept in
+            snapshot_state, None if the file was parsed.
+        '''
+        self.snapshot = ConfigSnapshot(self.resolve_filename(), self.data_path, shard, shards, codec_name,
+                                       owners)
+        state = self.snapshot.load()
+        if state is None:
+            self.load_config_file(shard, shards, owners)
+            self.snapshot_state = None
+            return
+        logging.info("Load config snapshot: %s" % self.snapshot.path)
+        self.__dict__.update(state["config"])
+        self.snapshot_state = state
+
+    def save_snapshot(self, **built):
+        '''
+            Save the config with the state of the objects built from it,
+            unless "snapshot" is false: the former snapshot is removed then
+        '''
+        if self.snapshot is None:
+            return False
+        if not self.snapshot_enabled:
+            self.snapshot.remove()
+            return False
+        state = dict(built)
+        state["config"] = {k: v for k, v in vars(self).items() if k not in SNAPSHOT_EXCLUDED}
+        return self.snapshot.save(state)
+
+    def load_config_file(self, shard=0, shards=1, owners=None):
+        '''
+            With shards, only the controllers of worker shard are kept.
+            owners are the workers of the controllers given by the
+            supervisor, see controller_shards().
+        '''
+        self.resolve_filename()
 
         logging.info("Load config file: %s" % self.filename)
         try:
@@ -24,3 +270,224 @@ class ConfigPars:
                 self.cfg = json.load(f)
         except Exception:
             raise ValueError("Load config failed")
+        # "backend": "asyncio" runs the app on an asyncio loop
+        backend = self.cfg.get("backend", BACKEND_LIBEVENT)
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend: %s" % backend)
+        self.backend = backend
+        # "workers": 4 splits the controllers across 4 processes
+        self.workers = int(self.cfg.get("workers", 1))
+        if self.workers < 1:
+            raise ValueError("workers should be at least 1")
+        # "reload_interval": 5 checks the file every 5 seconds and applies the
+        # changes of the controllers, measures and groups, 0 never, the default
+        self.reload_interval = self.cfg.get("reload_interval", DEFAULT_RELOAD_INTERVAL)
+        # "snapshot": false does not save the parsed config nor start from
+        # it, see ConfigSnapshot
+        self.snapshot_enabled = bool(self.cfg.get("snapshot", True))
+        if shards > 1:
+            self.select_shard(shard, shards, owners)
+        self.group_measures()
+        self.load_publish_config()
+        self.load_write_config()
+        self.load_broker_config()
+        self.load_metrics_config()
+        self.load_log_config()
+        self.group_publish()
+        if shards > 1:
+            # every worker keeps its own store and exports its own metrics
+            if self.store_forward.get("path"):
+                self.store_forward["path"] = "%s-%d" % (self.store_forward["path"], shard)
+            self.metrics_topic = "%s/%d" % (self.metrics_topic, shard)
+            if self.metrics_prometheus_file:
+                self.metrics_prometheus_file = "%s-%d" % (self.metrics_prometheus_file, shard)
+            for broker in self.brokers:
+                if broker["store_path"]:
+                    broker["store_path"] = "%s-%d" % (broker["store_path"], shard)
+
+    def reload(self, shard=0, shards=1, owners=None):
+        '''
+            Load the file again into a new ConfigPars and take its
+            controllers, measures and publish groups. Returns the ConfigDiff,
+            the other sections are left as loaded at start.
+        '''
+        config = ConfigPars(self.app_name)
+        config.filename = self.filename
+        config.load_config_file(shard, shards, owners)
+        diff = diff_config(self, config)
+        cfg = dict(self.cfg)
+        for section in RELOAD_SECTIONS:
+            if section in config.cfg:
+                cfg[section] = config.cfg[section]
+            else:
+                cfg.pop(section, None)
+        self.cfg = cfg
+        self.ctrl_measures = config.ctrl_measures
+        self.measures_by_ctrl = config.measures_by_ctrl
+        self.publish_period = config.publish_period
+        self.publish_groups = config.publish_groups
+        return diff
+
+    def select_shard(self, shard, shards, owners=None):
+        owners = controller_shards(self.cfg, shards, owners)
+        self.cfg["controllers"] = [ctrl for ctrl in self.cfg.get("controllers", list())
+                                   if owners[ctrl["name"]] == shard]
+        self.cfg["measures"] = [mea for mea in self.cfg.get("measures", list())
+                                if owners.get(mea["ctrlName"]) == shard]
+
+    def group_measures(self):
+        '''Group the measures by controller name, keeping the config order'''
+        self.measures_by_ctrl = measures_by_controller(self.cfg.get("measures", list()))
+        ctrl_measures = dict()
+        for ctrl in self.cfg.get("controllers", list()):
+            ctrl_measures[ctrl["name"]] = self.measures_by_ctrl.get(ctrl["name"], list())
+        self.ctrl_measures = ctrl_measures
+
+    def load_publish_config(self):
+        '''
+            Optional "publish" section of the config, e.g.
+            "publish": {"mode": "delta", "snapshot_interval": 300, "codec": "msgpack", "period": 5,
+                        "queue_size": 1024, "overflow": "drop_oldest", "qos": 1, "max_inflight": 20}
+            Without "codec" the fastest JSON codec installed is used.
+            "overflow" is "drop_oldest" or "drop_newest".
+            "max_inflight" is the MQTT in-flight window, in delta mode the
+            payloads stay in order whatever its size.
+            "store_forward" keeps the messages on disk while the broker is down.
+        '''
+        publish = self.cfg.get("publish", dict())
+        mode = publish.get("mode", PUBLISH_MODE_FULL)
+        if mode not in (PUBLISH_MODE_FULL, PUBLISH_MODE_DELTA):
+            raise ValueError("Unknown publish mode: %s" % mode)
+        self.publish_mode = mode
+        self.snapshot_interval = int(publish.get("snapshot_interval", DEFAULT_SNAPSHOT_INTERVAL))
+        self.publish_codec = publish.get("codec")
+        self.publish_period = publish.get("period", DEFAULT_PUBLISH_PERIOD)
+        self.publish_queue_size = int(publish.get("queue_size", DEFAULT_PUBLISH_QUEUE_SIZE))
+        overflow = publish.get("overflow", OVERFLOW_DROP_OLDEST)
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown publish overflow policy: %s" % overflow)
+        self.publish_overflow = overflow
+        self.publish_qos = int(publish.get("qos", 0))
+        self.publish_max_inflight = int(publish.get("max_inflight", 1))
+        # {"path": "/var/user/data/vdd_store", "max_size": 67108864, "rate": 100}
+        self.store_forward = publish.get("store_forward", dict())
+
+    def load_write_config(self):
+        '''
+            Optional "write" section of the config, e.g.
+            "write": {"executor": "thread", "max_pending": 100}
+            "executor" decodes the write requests on a "thread" or "process"
+            pool instead of the loop, at most "max_pending" wait for it.
+        '''
+        write = self.cfg.get("write", dict())
+        executor = write.get("executor")
+        if executor not in WRITE_EXECUTORS:
+            raise ValueError("Unknown write executor: %s" % executor)
+        self.write_executor = executor
+        self.write_max_pending = int(write.get("max_pending", DEFAULT_WRITE_MAX_PENDING))
+
+    def load_broker_config(self):
+        '''
+            Optional "brokers" the data is published to besides the local
+            DSA broker, e.g.
+            "brokers": [{"name": "edge", "host": "10.0.0.2", "port": 1883,
+                         "username": "...", "password": "...",
+                         "topics": ["ds2/eventbus/south/read/"],
+                         "store_forward": {"path": "/var/user/data/vdd_store_edge"}}]
+            Without "topics" every message is published to the broker.
+        '''
+        brokers = list()
+        names = set()
+        for broker in self.cfg.get("brokers", list()):
+            if not broker.get("name") or not broker.get("host"):
+                raise ValueError("A broker needs a name and a host: %s" % broker)
+            if broker["name"] in names:
+                raise ValueError("Duplicated broker: %s" % broker["name"])
+            names.add(broker["name"])
+            brokers.append({"name": broker["name"],
+                            "host": broker["host"],
+                            "port": int(broker.get("port", 1883)),
+                            "username": broker.get("username"),
+                            "password": broker.get("password"),
+                            "topics": broker.get("topics"),
+                            "store_path": broker.get("store_forward", dict()).get("path")})
+        self.brokers = brokers
+
+    def load_metrics_config(self):
+        '''
+            Optional "metrics" section of the config, e.g.
+            "metrics": {"enabled": true, "period": 60, "topic": "app/Virtual_Drive_Demo/metrics",
+                        "prometheus_file": "/var/user/data/vdd.prom"}
+            Every period the metrics are published on the topic of the local
+            broker and, with "prometheus_file", written to it in the
+            Prometheus text format.
+        '''
+        metrics = self.cfg.get("metrics", dict())
+        self.metrics_enabled = bool(metrics.get("enabled", False))
+        self.metrics_period = metrics.get("period", DEFAULT_METRICS_PERIOD)
+        self.metrics_topic = metrics.get("topic", DEFAULT_METRICS_TOPIC)
+        self.metrics_prometheus_file = metrics.get("prometheus_file")
+
+    def load_log_config(self):
+        '''
+            Optional "log" section of the config, e.g.
+            "log": {"level": "info", "queue_size": 10000,
+                    "payload": {"level": "debug", "every": 10, "max_length": 512}}
+            The records are written by a background thread, at most
+            "queue_size" wait for it. "payload" is the logging of the
+            published and received payloads: one in "every" is logged,
+            truncated to "max_length" characters, 0 to log it whole.
+        '''
+        log = self.cfg.get("log", dict())
+        self.log_level = log_level(log.get("level", "info"))
+        self.log_queue_size = int(log.get("queue_size", logsink.DEFAULT_QUEUE_SIZE))
+        payload = log.get("payload", dict())
+        self.log_payload_level = log_level(payload.get("level", DEFAULT_LOG_PAYLOAD_LEVEL))
+        self.log_payload_every = int(payload.get("every", 1))
+        if self.log_payload_every < 1:
+            raise ValueError("The payload log every should be at least 1")
+        self.log_payload_max_length = int(payload.get("max_length", logsink.DEFAULT_MAX_LENGTH))
+
+    def group_publish(self):
+        '''
+            Split the measures into publish groups, each published on its own
+            period:
+            - measures with a "group" use the period of that entry of the
+              top-level "groups": [{"name": "fast", "period": 1}]
+            - the other measures of a controller with a "period" are
+              published together on that period
+            - everything else is in the default group, on publish.period
+        '''
+        periods = dict()
+        for group in self.cfg.get("groups", list()):
+            periods[group["name"]] = group["period"]
+
+        publish_groups = dict()
+        for ctrl in self.cfg.get("controllers", list()):
+            if "period" in ctrl:
+                ctrl_group = ("controller:%s" % ctrl["name"], ctrl["period"])
+            else:
+                ctrl_group = (DEFAULT_PUBLISH_GROUP, self.publish_period)
+            mea_groups = list()
+            for mea in self.ctrl_measures[ctrl["name"]]:
+                if "group" not in mea:
+                    mea_groups.append((ctrl_group, mea))
+                elif mea["group"] in periods:
+                    mea_groups.append((("group:%s" % mea["group"], periods[mea["group"]]), mea))
+                else:
+                    raise ValueError("Unknown measure group: %s" % mea["group"])
+            # a controller without measures is still published
+            if not mea_groups:
+                mea_groups.append((ctrl_group, None))
+
+            for (name, period), mea in mea_groups:
+                if name not in publish_groups:
+                    publish_groups[name] = {"name": name, "period": period,
+                                            "controllers": list(), "ctrl_measures": dict()}
+                group = publish_groups[name]
+                if ctrl["name"] not in group["ctrl_measures"]:
+                    group["controllers"].append(ctrl)
+                    group["ctrl_measures"][ctrl["name"]] = list()
+                if mea is not None:
+                    group["ctrl_measures"][ctrl["name"]].append(mea)
+        self.publish_groups = list(publish_groups.values())
@@ -0,0 +1,197 @@
+# -*- coding:utf-8 -*-
+'''
+Serialization cache of the south read payload.
+
+The payload is kept as pre-encoded JSON fragments, one "slot" per controller
+and per measure. Each slot is split around its timestamp, so a tick only
+joins the cached segments with the encoded timestamp, and a write only
+re-encodes the fragments of the measures it changed.
+The output is an equivalent JSON document to the one the codec gives for
+the whole payload: the same keys in the same order with the values encoded
+by the codec, but the separators are always the ones of the json module.
+'''
+
+from codec import get_codec
+
+PAYLOAD_HEAD = b'{"controllers": ['
+PAYLOAD_TAIL = b']}'
+PAYLOAD_EMPTY = b'{"controllers": []}'
+
+
+def encode_controller_head(codec, name):
+    return b'{"name": ' + codec.dumps(name) + b', "version": "", "health": 1, "timestamp": '
+
+
+def encode_measure_head(codec, name, health):
+    return b'{"name": ' + codec.dumps(name) + b', "health": ' + codec.dumps(health) + b', "timestamp": '
+
+
+def encode_measure_value(codec, value):
+    return b', "value": ' + codec.dumps(value) + b'}'
+
+
+class PayloadCache(object):
+    def __init__(self, controllers, ctrl_measures, measures, codec=None, fragments=None):
+        '''
+            controllers is config.cfg["controllers"], ctrl_measures the
+            grouping of ConfigPars and measures the MeasureStore.
+            codec must be a JSON codec, the fastest one installed by default.
+            fragments are the ones of fragments() of the same config and
+            store, they are taken instead of encoding the payload again.
+        '''
+        self.controllers = controllers
+        self.ctrl_measures = ctrl_measures
+        self.measures = measures
+        self.codec = codec or get_codec()
+        if not self.codec.is_json:
+            raise ValueError("PayloadCache needs a JSON codec, not %s" % self.codec.name)
+        # controller name -> its first slot and the one after its last
+        self._spans = dict()
+        self._handle_slots = dict()
+        # the measure handle and name of every slot, None for a controller
+        self._handles = list()
+        self._names = list()
+        self._heads = list()
+        self._glues = list()
+        self._tails = list()
+        self._segments = list()
+        self._dirty = set()
+        if fragments is None:
+            self.rebuild()
+        else:
+            self.restore(fragments)
+
+    def rebuild(self, ctrl_names=None):
+        '''
+            Encode the fragments again, should be called when the config
+            changes. With ctrl_names, only the fragments of these controllers
+            are encoded, the other controllers must have the same measures.
+        '''
+        store = self.measures
+        former = None
+        if ctrl_names is not None and self._spans:
+            if self._dirty:
+                self._flush_dirty()
+            former = self._spans
+            ctrl_names = set(ctrl_names)
+        spans = dict()
+        handles = list()
+        names = list()
+        heads = list()
+        glues = list()
+        tails = list()
+        for ctrl in self.controllers:
+            ctrl_name = ctrl["name"]
+            first = len(handles)
+            if former is not None and ctrl_name not in ctrl_names and ctrl_name in former:
+                begin, end = former[ctrl_name]
+                handles.extend(self._handles[begin:end])
+                names.extend(self._names[begin:end])
+                heads.extend(self._heads[begin:end])
+                glues.extend(self._glues[begin:end])
+                tails.extend(self._tails[begin:end])
+                spans[ctrl_name] = (first, len(handles))
+                continue
+            mea_list = self.ctrl_measures.get(ctrl_name, ())
+            handles.append(None)
+            names.append(ctrl_name)
+            heads.append(encode_controller_head(self.codec, ctrl_name))
+            glues.append(b', "measures": [' if mea_list else b', "measures": []}, ')
+            for mea in mea_list:
+                handle = store.handle(ctrl_name, mea["name"])
+                handles.append(handle)
+                names.append(mea["name"])
+                heads.append(encode_measure_head(self.codec, mea["name"], store.health(handle)))
+                glues.append(b', ')
+            if mea_list:
+                glues[-1] = b']}, '
+            for slot in range(first, len(handles)):
+                if handles[slot] is None:
+                    tails.append(glues[slot])
+                else:
+                    tails.append(encode_measure_value(self.codec, store.value(handles[slot])) + glues[slot])
+            spans[ctrl_name] = (first, len(handles))
+
+        self._spans = spans
+        self._handle_slots = {handle: slot for slot, handle in enumerate(handles) if handle is not None}
+        self._handles = handles
+        self._names = names
+        self._heads = heads
+        self._glues = glues
+        self._tails = tails
+        self._dirty = set()
+        self._join_segments()
+
+    def fragments(self):
+        '''The encoded fragments, e.g. to save them with the config'''
+        if self._dirty:
+            self._flush_dirty()
+        return {"spans": self._spans, "handles": self._handles, "names": self._names,
+                "heads": self._heads, "glues": self._glues, "tails": self._tails}
+
+    def restore(self, fragments):
+        self._spans = fragments["spans"]
+        self._handles = fragments["handles"]
+        self._names = fragments["names"]
+        self._heads = fragments["heads"]
+        self._glues = fragments["glues"]
+        self._tails = fragments["tails"]
+        self._handle_slots = {handle: slot for slot, handle in enumerate(self._handles) if handle is not None}
+        self._dirty = set()
+        self._join_segments()
+
+    def handles(self):
+        '''The MeasureStore handles of the measures, in payload order'''
+        return [handle for handle in self._handles if handle is not None]
+
+    def _join_segments(self):
+        '''
+            Every fragment ends with ", ", the first one is prefixed with the
+            payload head and the last one closes the payload instead
+        '''
+        if not self._handles:
+            self._segments = [PAYLOAD_EMPTY]
+            return
+        heads = self._heads
+        tails = self._tails
+        segments = [PAYLOAD_HEAD + heads[0]]
+        for k in range(1, len(heads)):
+            segments.append(tails[k - 1] + heads[k])
+        segments.append(tails[-1][:-2] + PAYLOAD_TAIL)
+        self._segments = segments
+
+    def mark_dirty(self, ctrl_name, mea_name):
+        '''The value or health of this measure changed since the last encode'''
+        slot = self._handle_slots.get(self.measures.handle(ctrl_name, mea_name))
+        if slot is not None:
+            self._dirty.add(slot)
+
+    def mark_handles_dirty(self, handles):
+        '''mark_dirty() of the measures of the MeasureStore handles'''
+        slots = self._handle_slots
+        self._dirty.update(slots[handle] for handle in handles if handle in slots)
+
+    def _flush_dirty(self):
+        heads = self._heads
+        tails = self._tails
+        segments = self._segments
+        last = len(heads) - 1
+        store = self.measures
+        for slot in self._dirty:
+            handle = self._handles[slot]
+            heads[slot] = encode_measure_head(self.codec, self._names[slot], store.health(handle))
+            tails[slot] = encode_measure_value(self.codec, store.value(handle)) + self._glues[slot]
+        # The head of a slot and the tail of the previous one share a segment
+        for slot in self._dirty:
+            segments[slot] = tails[slot - 1] + heads[slot]
+            if slot < last:
+                segments[slot + 1] = tails[slot] + heads[slot + 1]
+            else:
+                segments[slot + 1] = tails[slot][:-2] + PAYLOAD_TAIL
+        self._dirty = set()
+
+    def encode(self, timestamp):
+        '''The whole payload as JSON bytes, stamped with timestamp'''
+        if self._dirty:
+            self._flush_dirty()
+        return str(timestamp).encode("utf-8").join(self._segments)
@@ -0,0 +1,95 @@
+# -*- coding:utf-8 -*-
+'''
+Bounded outbound queue of the MQ client.
+
+Messages wait here while the broker is not ready or paho's own queue is
+full, so publishing never blocks the event loop. When the queue is full the
+overflow policy decides which message is dropped. Messages put with a
+coalesce key replace the pending message with the same key, so only the
+latest snapshot of e.g. a publish group is sent after an outage.
+'''
+
+import collections
+import logging as logger
+
+# Drop the oldest pending message to make room for the new one
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+# Refuse the new message
+OVERFLOW_DROP_NEWEST = "drop_newest"
+
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
+
+
+class PendingMessage(object):
+    __slots__ = ("topic", "payload", "qos", "userdata", "key", "on_ack")
+
+    def __init__(self, topic, payload, qos, userdata, key, on_ack=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.userdata = userdata
+        self.key = key
+        self.on_ack = on_ack
+
+    def drop(self):
+        if self.on_ack is not None:
+            self.on_ack(False)
+
+
+class PublishQueue(object):
+    def __init__(self, max_size=1024, policy=OVERFLOW_DROP_OLDEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % policy)
+        self.max_size = max_size
+        self.policy = policy
+        self._queue = collections.deque()
+        self._keys = dict()
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, topic, payload, qos=0, userdata=None, key=None, on_ack=None):
+        '''
+            Returns False if the message was dropped. The on_ack of a message
+            dropped or replaced by a coalesced one is called with False.
+        '''
+        if key is not None and key in self._keys:
+            msg = self._keys[key]
+            msg.drop()
+            msg.topic = topic
+            msg.payload = payload
+            msg.qos = qos
+            msg.userdata = userdata
+            msg.on_ack = on_ack
+            self.coalesced += 1
+            return True
+
+        if len(self._queue) >= self.max_size:
+            self.dropped += 1
+            if self.policy == OVERFLOW_DROP_NEWEST:
+                logger.warn("publish queue full, drop message of topic %s" % topic)
+                if on_ack is not None:
+                    on_ack(False)
+                return False
+            old = self._queue.popleft()
+            if old.key is not None:
+                del self._keys[old.key]
+            logger.warn("publish queue full, drop message of topic %s" % old.topic)
+            old.drop()
+
+        msg = PendingMessage(topic, payload, qos, userdata, key, on_ack)
+        self._queue.append(msg)
+        if key is not None:
+            self._keys[key] = msg
+        return True
+
+    def peek(self):
+        return self._queue[0]
+
+    def pop(self):
+        msg = self._queue.popleft()
+        if msg.key is not None:
+            del self._keys[msg.key]
+        return msg
@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+'''
+Drift-free periodic scheduler on a libevent Base.
+
+Every job is armed against its absolute deadline, so the time spent in the
+callback does not push the next run. The jobs added with spread=True
+that share the same period are spread across it to avoid bursts, the
+others first run one period after they are armed. Late runs are measured
+as jitter, and deadlines that passed while a callback was still running
+are counted as missed and skipped.
+'''
+
+import time
+import logging
+from events import LibeventTimer
+import metrics
+
+
+class ScheduledJob(object):
+    __slots__ = ("name", "period", "spread", "offset", "callback", "userdata", "deadline", "timer",
+                 "runs", "missed", "last_jitter", "max_jitter", "total_jitter")
+
+    def __init__(self, name, period, callback, userdata=None, spread=False):
+        self.name = name
+        self.period = period
+        self.spread = spread
+        self.offset = period
+        self.callback = callback
+        self.userdata = userdata
+        self.deadline = None
+        self.timer = None
+        self.runs = 0
+        self.missed = 0
+        self.last_jitter = 0
+        self.max_jitter = 0
+        self.total_jitter = 0
+
+    def stats(self):
+        return {"name": self.name,
+                "period": self.period,
+                "runs": self.runs,
+                "missed": self.missed,
+                "last_jitter": self.last_jitter,
+                "max_jitter": self.max_jitter,
+                "mean_jitter": self.total_jitter / self.runs if self.runs else 0}
+
+
+class Scheduler(object):
+    def __init__(self, base, clock=time.monotonic, timer_factory=LibeventTimer):
+        self.base = base
+        self.clock = clock
+        self.timer_factory = timer_factory
+        self.jobs = list()
+        self.running = False
+
+    def add_job(self, name, period, callback, userdata=None, spread=False):
+        '''
+            callback is a function(job, userdata) called every period seconds,
+            jobs added after start() are armed right away. The first runs of
+            the spread jobs of the same period are spread across it.
+        '''
+        if period <= 0:
+            raise ValueError("The period of %s should be positive" % name)
+        job = ScheduledJob(name, period, callback, userdata, spread)
+        job.timer = self.timer_factory(self.base, self._on_timer, userdata=job)
+        self.jobs.append(job)
+        if self.running:
+            if spread:
+                self._spread()
+            self._arm(job, self.clock() + job.offset)
+        return job
+
+    def remove_job(self, job):
+        if job in self.jobs:
+            self.jobs.remove(job)
+            job.timer.delete()
+
+    def start(self):
+        self._spread()
+        now = self.clock()
+        for job in self.jobs:
+            self._arm(job, now + job.offset)
+        self.running = True
+
+    def stop(self):
+        for job in self.jobs:
+            job.timer.delete()
+        self.running = False
+
+    def stats(self):
+        return [job.stats() for job in self.jobs]
+
+    def report(self):
+        for stats in self.stats():
+            logging.info("Job %(name)s: period %(period)ss, runs %(runs)d, missed %(missed)d, "
+                         "jitter last %(last_jitter).3fs mean %(mean_jitter).3fs max %(max_jitter).3fs" % stats)
+
+    def _spread(self):
+        '''The first run of the n spread jobs of a period is at period * (i + 1) / n'''
+        by_period = dict()
+        for job in self.jobs:
+            if job.spread:
+                by_period.setdefault(job.period, list()).append(job)
+        for period, jobs in by_period.items():
+            for i, job in enumerate(jobs):
+                job.offset = period * (i + 1) / len(jobs)
+
+    def _arm(self, job, deadline):
+        job.deadline = deadline
+        job.timer.add(max(0, deadline - self.clock()))
+
+    def _on_timer(self, evt, job):
+        now = self.clock()
+        jitter = now - job.deadline
+        job.runs += 1
+        job.last_jitter = jitter
+        job.total_jitter += jitter
+        if jitter > job.max_jitter:
+            job.max_jitter = jitter
+        if metrics.REGISTRY.enabled:
+            metrics.LOOP_LAG_SECONDS.observe(jitter)
+
+        try:
+            job.callback(job, job.userdata)
+        except Exception as e:
+            logging.error("Scheduled job %s failed: %s" % (job.name, e.__str__()))
+
+        if job not in self.jobs:
+            return
+        deadline = job.deadline + job.period
+        now = self.clock()
+        if deadline <= now:
+            missed = int((now - deadline) // job.period) + 1
+            job.missed += missed
+            deadline += missed * job.period
+            logging.warning("Job %s missed %d deadline(s), period %ss" % (job.name, missed, job.period))
+        self._arm(job, deadline)
@@ -0,0 +1,171 @@
+# -*- coding:utf-8 -*-
+'''
+Simulated signals of the virtual measures, generated with NumPy.
+
+A measure with a "signal" in its config changes over time instead of
+keeping its default or last written value:
+
+    {"name": "temp", "ctrlName": "plc1", "dataType": "FLOAT",
+     "signal": {"type": "sine", "period": 60, "amplitude": 10, "offset": 20}}
+
+    "ramp":        min, max, period, phase, from min to max every period
+    "sine":        offset, amplitude, period, phase
+    "step":        low, high, period, phase, duty, high for duty of the period
+    "random_walk": start, step, min, max, a uniform move of at most step per tick
+
+The phase is a fraction of the period. The measures of a publish group
+with the same signal type and dataType are a SignalBatch: one NumPy step
+computes them all and writes them into the typed column of the
+MeasureStore in place. The values are clipped to the range of the
+dataType, and rounded for an integer one.
+
+NumPy is optional, the "signals" extra of setup.py, it is needed only by a
+config with signals.
+'''
+
+import math
+from measure_store import COLUMN_BITS, COLUMN_MASK, VALUE_RANGES
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SIGNAL_RAMP = "ramp"
+SIGNAL_SINE = "sine"
+SIGNAL_STEP = "step"
+SIGNAL_RANDOM_WALK = "random_walk"
+# type -> the parameters and their defaults
+SIGNALS = {
+    SIGNAL_RAMP: {"min": 0, "max": 100, "period": 60, "phase": 0},
+    SIGNAL_SINE: {"offset": 0, "amplitude": 1, "period": 60, "phase": 0},
+    SIGNAL_STEP: {"low": 0, "high": 1, "period": 10, "phase": 0, "duty": 0.5},
+    SIGNAL_RANDOM_WALK: {"start": 0, "step": 1, "min": -100, "max": 100},
+}
+
+
+class SignalsNotAvailableError(ValueError):
+    pass
+
+
+def signal_params(signal):
+    '''The parameters of a "signal" config with their defaults, checked'''
+    kind = signal.get("type")
+    if kind not in SIGNALS:
+        raise ValueError("Unknown signal type: %s" % kind)
+    params = dict(SIGNALS[kind])
+    for name in params:
+        if name in signal:
+            params[name] = float(signal[name])
+    if params.get("period", 1) <= 0:
+        raise ValueError("The period of a %s signal should be positive" % kind)
+    return kind, params
+
+
+class SignalBatch(object):
+    '''The measures of one column with the same type of signal'''
+
+    def __init__(self, column, kind, rows, params, rng):
+        self.column = column
+        self.kind = kind
+        self.dtype = numpy.dtype(column.typecode)
+        self.rows = numpy.array(rows, dtype=numpy.intp)
+        # the byte and the bit of every row in the bitmaps of the column
+        self.byte_rows = self.rows >> 3
+        self.bit_masks = (1 << (self.rows & 7)).astype(numpy.uint8)
+        # name -> the parameter of every row
+        self.params = {name: numpy.array(values, dtype=numpy.float64) for name, values in params.items()}
+        self.deadbands = numpy.array([column.deadbands.get(row, 0) for row in rows], dtype=numpy.float64)
+        self.rng = rng
+        self.state = self.params["start"].copy() if kind == SIGNAL_RANDOM_WALK else None
+        if column.data_type in VALUE_RANGES:
+            self.low, self.high = VALUE_RANGES[column.data_type]
+        else:
+            info = numpy.iinfo(self.dtype) if self.dtype.kind in "iu" else numpy.finfo(self.dtype)
+            self.low = float(info.min)
+            self.high = float(info.max)
+
+    def generate(self, t):
+        '''The values at t, seconds since the epoch'''
+        p = self.params
+        if self.kind == SIGNAL_RANDOM_WALK:
+            self.state += self.rng.uniform(-1, 1, len(self.rows)) * p["step"]
+            numpy.clip(self.state, p["min"], p["max"], out=self.state)
+            return self.state
+        cycle = numpy.mod(t / p["period"] + p["phase"], 1.0)
+        if self.kind == SIGNAL_RAMP:
+            return p["min"] + (p["max"] - p["min"]) * cycle
+        if self.kind == SIGNAL_SINE:
+            return p["offset"] + p["amplitude"] * numpy.sin(2 * math.pi * cycle)
+        return numpy.where(cycle < p["duty"], p["high"], p["low"])
+
+    def tick(self, t):
+        '''Write the values at t, returns the mask of the rows whose value moved'''
+        column = self.column
+        rows = self.rows
+        new = numpy.clip(self.generate(t), self.low, self.high)
+        if self.dtype.kind in "iu":
+            new = numpy.rint(new)
+        new = new.astype(self.dtype)
+
+        values = numpy.frombuffer(column.values, dtype=self.dtype)
+        moved = values[rows] != new
+        values[rows] = new
+        numpy.frombuffer(column.timestamps, dtype=numpy.uint32)[rows] = int(t)
+
+        # the changed bits, as Column.update_changed() sets them
+        pub_values = numpy.frombuffer(column.pub_values, dtype=self.dtype)[rows]
+        published = numpy.frombuffer(column.published, dtype=numpy.uint8)[self.byte_rows] & self.bit_masks
+        health = numpy.frombuffer(column.health, dtype=numpy.uint8)[rows]
+        pub_health = numpy.frombuffer(column.pub_health, dtype=numpy.uint8)[rows]
+        changed = new != pub_values
+        banded = self.deadbands > 0
+        if banded.any():
+            changed[banded] = numpy.abs(new[banded].astype(numpy.float64) -
+                                        pub_values[banded]) > self.deadbands[banded]
+        changed |= (published == 0) | (health != pub_health)
+        # only the bytes of the rows of the batch
+        bits = numpy.frombuffer(column.changed, dtype=numpy.uint8)
+        numpy.bitwise_and.at(bits, self.byte_rows[~changed], ~self.bit_masks[~changed])
+        numpy.bitwise_or.at(bits, self.byte_rows[changed], self.bit_masks[changed])
+        return moved
+
+
+class SignalEngine(object):
+    def __init__(self, store, measures, seed=None):
+        '''
+            measures is a list of (handle, signal config) of the measures of
+            store with a signal. seed makes the random walks repeatable.
+        '''
+        if numpy is None:
+            raise SignalsNotAvailableError("The measure signals need numpy")
+        rng = numpy.random.default_rng(seed)
+        # (column, type) -> handles and parameters
+        groups = dict()
+        for handle, signal in measures:
+            column = store.column(handle)
+            if column.typecode is None:
+                raise ValueError("A signal needs a numeric dataType, not %s" % column.data_type)
+            kind, params = signal_params(signal)
+            group = groups.setdefault((handle & COLUMN_MASK, kind), (column, list(), dict()))
+            group[1].append(handle)
+            for name, value in params.items():
+                group[2].setdefault(name, list()).append(value)
+        self.batches = list()
+        self.handles = list()
+        for (_, kind), (column, handles, params) in groups.items():
+            rows = [handle >> COLUMN_BITS for handle in handles]
+            self.batches.append(SignalBatch(column, kind, rows, params, rng))
+            self.handles.append(numpy.array(handles, dtype=numpy.int64))
+
+    def __len__(self):
+        return sum(len(batch.rows) for batch in self.batches)
+
+    def tick(self, t):
+        '''Generate every signal at t, returns the handles whose value moved'''
+        moved = list()
+        for batch, handles in zip(self.batches, self.handles):
+            mask = batch.tick(t)
+            if mask.any():
+                moved.extend(handles[mask].tolist())
+        return moved
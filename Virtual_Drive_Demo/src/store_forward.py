@@ -0,0 +1,248 @@
+# -*- coding:utf-8 -*-
+'''
+Disk-backed store-and-forward log of the MQ client.
+
+Messages that cannot be published while the broker is down are appended to
+a log of segment files in a directory. The log is bounded: when it grows
+over max_size the oldest segment is evicted, read or not. The read position
+is kept in a cursor file, so the messages survive a restart of the app.
+The cursor is saved at most every cursor_interval seconds, when the read
+moves to another segment and on close(), not on every commit: a crash
+delivers again the messages committed since the last save, at most
+cursor_interval seconds of the drain, rather than wearing the flash out.
+
+Each record is: crc32, topic length, payload length, qos, topic, payload.
+A torn record at the end of the last segment, e.g. after a power cut, is
+cut off when the log is opened.
+'''
+
+import os
+import time
+import zlib
+import struct
+import logging as logger
+
+RECORD_HEADER = struct.Struct("!IHIB")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+# Seconds between two saves of the cursor while the log is read
+DEFAULT_CURSOR_INTERVAL = 5
+
+
+class StoredMessage(object):
+    __slots__ = ("topic", "payload", "qos", "segment", "end", "index")
+
+    def __init__(self, topic, payload, qos, segment, end, index):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        # where the record ends, and how many records its segment has up to it
+        self.segment = segment
+        self.end = end
+        self.index = index
+
+
+class SegmentLog(object):
+    def __init__(self, path, max_size=64 * 1024 * 1024, segment_size=1024 * 1024, fsync=False,
+                 cursor_interval=DEFAULT_CURSOR_INTERVAL):
+        '''
+            path is the directory of the log, max_size the bytes kept on
+            disk. fsync forces every record to the flash, which is safer
+            but slow and wears it out. cursor_interval is the seconds
+            between two saves of the read position.
+        '''
+        if segment_size >= max_size:
+            raise ValueError("segment_size should be smaller than max_size")
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.cursor_interval = cursor_interval
+        self.evicted = 0
+        self._segments = list()
+        self._seg_counts = dict()
+        self._seg_sizes = dict()
+        self._count = 0
+        self._read_segment = 0
+        self._read_offset = 0
+        self._read_count = 0
+        # the monotonic time of the last save of the cursor, and whether
+        # the read moved since
+        self._cursor_saved = time.monotonic()
+        self._cursor_dirty = False
+        self._writer = None
+        self._open()
+
+    def __len__(self):
+        return self._count
+
+    def _segment_file(self, segment):
+        return os.path.join(self.path, "%020d%s" % (segment, SEGMENT_SUFFIX))
+
+    def _open(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                          if name.endswith(SEGMENT_SUFFIX))
+        read_segment, read_offset = self._load_cursor()
+        for segment in segments:
+            if segment < read_segment:
+                os.remove(self._segment_file(segment))
+                continue
+            count, size, consumed = self._scan(segment, read_offset if segment == read_segment else 0)
+            self._segments.append(segment)
+            self._seg_counts[segment] = count
+            self._seg_sizes[segment] = size
+            self._count += count - consumed
+            if segment == read_segment:
+                self._read_count = consumed
+
+        if not self._segments:
+            self._segments.append(read_segment)
+            self._seg_counts[read_segment] = 0
+            self._seg_sizes[read_segment] = 0
+            read_offset = 0
+        if read_segment not in self._seg_counts:
+            read_segment = self._segments[0]
+            read_offset = 0
+        self._read_segment = read_segment
+        self._read_offset = read_offset
+        self._writer = open(self._segment_file(self._segments[-1]), "ab")
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE), "r") as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except Exception:
+            return 0, 0
+
+    def _save_cursor(self):
+        cursor_file = os.path.join(self.path, CURSOR_FILE)
+        with open(cursor_file + ".tmp", "w") as f:
+            f.write("%d %d" % (self._read_segment, self._read_offset))
+        os.rename(cursor_file + ".tmp", cursor_file)
+        self._cursor_saved = time.monotonic()
+        self._cursor_dirty = False
+
+    def _scan(self, segment, read_offset):
+        '''Returns the records, the valid size and the records before read_offset'''
+        count = 0
+        consumed = 0
+        offset = 0
+        filename = self._segment_file(segment)
+        with open(filename, "rb") as f:
+            while True:
+                record = self._read_record(f)
+                if record is None:
+                    break
+                if offset < read_offset:
+                    consumed += 1
+                offset = f.tell()
+                count += 1
+        if offset < os.path.getsize(filename):
+            logger.warn("store %s: cut the torn record at %d" % (filename, offset))
+            with open(filename, "ab") as f:
+                f.truncate(offset)
+        return count, offset, consumed
+
+    def _read_record(self, f):
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        crc, topic_len, payload_len, qos = RECORD_HEADER.unpack(header)
+        data = f.read(topic_len + payload_len)
+        if len(data) < topic_len + payload_len or zlib.crc32(data) != crc:
+            return None
+        return data[:topic_len].decode("utf-8"), data[topic_len:], qos
+
+    def append(self, topic, payload, qos=0):
+        topic = topic.encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        data = topic + payload
+        record = RECORD_HEADER.pack(zlib.crc32(data), len(topic), len(payload), qos) + data
+
+        segment = self._segments[-1]
+        if self._seg_sizes[segment] and self._seg_sizes[segment] + len(record) > self.segment_size:
+            segment = self._roll()
+        self._writer.write(record)
+        self._writer.flush()
+        if self.fsync:
+            os.fsync(self._writer.fileno())
+        self._seg_sizes[segment] += len(record)
+        self._seg_counts[segment] += 1
+        self._count += 1
+
+        while len(self._segments) > 1 and sum(self._seg_sizes.values()) > self.max_size:
+            self._evict_oldest()
+
+    def _roll(self):
+        self._writer.close()
+        segment = self._segments[-1] + 1
+        self._segments.append(segment)
+        self._seg_counts[segment] = 0
+        self._seg_sizes[segment] = 0
+        self._writer = open(self._segment_file(segment), "ab")
+        return segment
+
+    def _evict_oldest(self):
+        segment = self._segments.pop(0)
+        dropped = self._seg_counts.pop(segment)
+        del self._seg_sizes[segment]
+        if segment == self._read_segment:
+            dropped -= self._read_count
+            self._read_segment = self._segments[0]
+            self._read_offset = 0
+            self._read_count = 0
+            self._save_cursor()
+        os.remove(self._segment_file(segment))
+        self._count -= dropped
+        self.evicted += dropped
+        logger.warn("store %s full, evicted %d message(s)" % (self.path, dropped))
+
+    def peek(self, n):
+        '''The n oldest messages, they stay in the log until commit()'''
+        messages = list()
+        offset = self._read_offset
+        index = self._read_count
+        for segment in self._segments[self._segments.index(self._read_segment):]:
+            with open(self._segment_file(segment), "rb") as f:
+                f.seek(offset)
+                while len(messages) < n and f.tell() < self._seg_sizes[segment]:
+                    record = self._read_record(f)
+                    if record is None:
+                        break
+                    index += 1
+                    messages.append(StoredMessage(record[0], record[1], record[2], segment, f.tell(), index))
+            if len(messages) >= n:
+                break
+            offset = 0
+            index = 0
+        return messages
+
+    def commit(self, message):
+        '''Remove every message up to this one, as returned by peek()'''
+        rolled = self._read_segment != message.segment
+        while self._read_segment != message.segment:
+            # fully read, and not the one being written
+            segment = self._segments.pop(0)
+            self._count -= self._seg_counts.pop(segment) - self._read_count
+            del self._seg_sizes[segment]
+            os.remove(self._segment_file(segment))
+            self._read_segment = self._segments[0]
+            self._read_count = 0
+        self._count -= message.index - self._read_count
+        self._read_count = message.index
+        self._read_offset = message.end
+        self._cursor_dirty = True
+        # the removed segments must not be looked for after a restart
+        if rolled or time.monotonic() - self._cursor_saved >= self.cursor_interval:
+            self._save_cursor()
+
+    def close(self):
+        if self._cursor_dirty:
+            self._save_cursor()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
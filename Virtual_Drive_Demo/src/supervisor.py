@@ -0,0 +1,318 @@
+# -*- coding:utf-8 -*-
+'''
+Supervisor of the worker processes sharing the controllers of the app.
+
+Every worker owns a shard of the controllers, see controller_shards(), and
+runs its own loop and MQ client. The supervisor subscribes to the write
+requests of DSA, sends the controllers of a request to the workers owning
+them over a pipe, and publishes one response once every part is answered.
+A worker that exits is restarted with backoff, the writes it did not
+answer fail. When the config file changes, the controllers keep their
+worker and the new ones go to the workers with the fewest measures, then
+every worker reloads its controllers from the owners it is sent.
+
+The supervisor and a worker talk over a socket pair through a
+MessageChannel: a message is its size then its pickle. The messages are
+queued and written as the socket takes them, and read into a buffer as
+they come, so neither end stalls its loop on the other.
+
+Messages on the channel of a worker:
+    ("write", request_id, controllers) both ways, the request part
+    and the controllers of its response
+    ("reload", owners) to the worker, the worker of every controller
+'''
+
+import time
+import pickle
+import socket
+import struct
+import logging
+import multiprocessing
+from multiprocessing.reduction import ForkingPickler
+from events import EV_READ, EV_WRITE, EV_PERSIST
+import logsink
+from connector import Backoff
+from parse_config import controller_shards, ConfigWatcher
+
+# Seconds between two checks of the workers and the writes
+CHECK_INTERVAL = 1
+# Seconds a write request waits for the workers
+WRITE_TIMEOUT = 10
+# A worker running this long is considered healthy, its backoff restarts
+HEALTHY_UPTIME = 60
+# The size of a message on a channel, then its pickle
+MESSAGE_HEADER = struct.Struct("!Q")
+# Bytes read from a channel at once
+READ_SIZE = 65536
+
+
+def failed_response(ctrls):
+    '''The response controllers of a write nobody answered'''
+    response_ctrls = list()
+    for ctrl in ctrls:
+        measures = list()
+        for measure in ctrl["measures"]:
+            table_dict = {k: v for k, v in measure.items() if k != "value"}
+            table_dict["error_code"] = 1
+            table_dict["error_reason"] = "Failed"
+            measures.append(table_dict)
+        table_dict = {k: v for k, v in ctrl.items() if k != "measures"}
+        table_dict["measures"] = measures
+        response_ctrls.append(table_dict)
+    return response_ctrls
+
+
+class MessageChannel(object):
+    def __init__(self, sock, base, event_factory, on_message, on_closed):
+        '''
+            One end of the socket pair between the supervisor and a worker,
+            on_message(message) is called for every message read and
+            on_closed() once the other end is gone
+        '''
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.on_message = on_message
+        self.on_closed = on_closed
+        # the bytes not read as a message yet, and not written yet
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.closed = False
+        self.read_evt = event_factory(base, sock.fileno(), EV_READ | EV_PERSIST, self._on_readable)
+        self.write_evt = event_factory(base, sock.fileno(), EV_WRITE | EV_PERSIST, self._on_writable)
+        self.read_evt.add()
+
+    def send(self, message):
+        '''Queue message and write what the socket takes, False if the channel is closed'''
+        if self.closed:
+            return False
+        data = ForkingPickler.dumps(message)
+        self.outbox += MESSAGE_HEADER.pack(len(data))
+        self.outbox += data
+        return self._flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.read_evt.delete()
+        self.write_evt.delete()
+        self.sock.close()
+        del self.inbox[:]
+        del self.outbox[:]
+
+    def _flush(self):
+        try:
+            while self.outbox:
+                del self.outbox[:self.sock.send(self.outbox)]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self._lost(e)
+            return False
+        if self.outbox:
+            self.write_evt.add()
+        else:
+            self.write_evt.delete()
+        return True
+
+    def _on_writable(self, evt, fd, what, userdata):
+        if not self.closed:
+            self._flush()
+
+    def _on_readable(self, evt, fd, what, userdata):
+        try:
+            data = self.sock.recv(READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._lost(e)
+            return
+        if not data:
+            self._lost(None)
+            return
+        self.inbox += data
+        while not self.closed and len(self.inbox) >= MESSAGE_HEADER.size:
+            end = MESSAGE_HEADER.size + MESSAGE_HEADER.unpack_from(self.inbox)[0]
+            if len(self.inbox) < end:
+                break
+            message = pickle.loads(memoryview(self.inbox)[MESSAGE_HEADER.size:end])
+            del self.inbox[:end]
+            self.on_message(message)
+
+    def _lost(self, error):
+        if error is not None:
+            logging.warn("Channel closed: %s" % error.__str__())
+        self.close()
+        self.on_closed()
+
+
+class Worker(object):
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.channel = None
+        self.started = 0
+        self.restart_at = 0
+        self.restarts = 0
+        self.backoff = Backoff(initial=1, maximum=30)
+        # the requests waiting for this worker
+        self.writes = set()
+
+    def is_alive(self):
+        return self.channel is not None
+
+
+class PendingWrite(object):
+    def __init__(self, topic, request, deadline):
+        self.topic = topic
+        self.request = request
+        self.deadline = deadline
+        self.response_ctrls = [None] * len(request["payload"])
+        # worker index -> the positions of its controllers in the request
+        self.positions = dict()
+
+    def answer(self, index, ctrls):
+        for position, ctrl in zip(self.positions.pop(index), ctrls):
+            self.response_ctrls[position] = ctrl
+
+    def part(self, index):
+        '''The controllers of the request sent to worker index'''
+        return [self.request["payload"][position] for position in self.positions[index]]
+
+    def is_complete(self):
+        return not self.positions
+
+
+class Supervisor(object):
+    def __init__(self, config, mq, target, respond, codec):
+        '''
+            target(shard, shards, sock, owners) runs a worker in its
+            process, sock is its end of the channel,
+            respond(topic, response) publishes the response of a write
+            request, mq is the MQ client of the supervisor
+        '''
+        self.config = config
+        self.mq = mq
+        self.base = mq.base
+        self.target = target
+        self.respond = respond
+        self.codec = codec
+        self.owners = controller_shards(config.cfg, config.workers)
+        self.workers = [Worker(i) for i in range(config.workers)]
+        self.writes = dict()
+        self._next_request_id = 0
+        # a fresh interpreter, the loop of the supervisor is not inherited
+        self.context = multiprocessing.get_context("spawn")
+        self.check_timer = mq.timer_factory(self.base, self._check, userdata=None)
+        self.config_watcher = ConfigWatcher(config.filename) if config.reload_interval else None
+
+    def start(self):
+        for worker in self.workers:
+            self._start_worker(worker)
+        self.check_timer.add(CHECK_INTERVAL)
+
+    def reload_config(self):
+        try:
+            self.config.reload()
+        except (ValueError, KeyError) as e:
+            logging.error("Reload config failed, the former one is kept: %s" % e.__str__())
+            return
+        # only the new controllers are given to a worker
+        self.owners = controller_shards(self.config.cfg, len(self.workers), self.owners)
+        logging.info("Config reloaded, %d controllers" % len(self.owners))
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.channel.send(("reload", self.owners))
+
+    def stop(self):
+        self.check_timer.delete()
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+
+    def _start_worker(self, worker):
+        sock, child_sock = socket.socketpair()
+        worker.process = self.context.Process(
+            target=self.target, args=(worker.index, len(self.workers), child_sock, self.owners),
+            name="worker-%d" % worker.index)
+        worker.process.start()
+        child_sock.close()
+        worker.started = time.monotonic()
+        worker.channel = MessageChannel(sock, self.base, self.mq.event_factory,
+                                        lambda message: self._on_worker_message(worker, message),
+                                        lambda: self._worker_exited(worker))
+        logging.info("Worker %d started, pid %d" % (worker.index, worker.process.pid))
+
+    def _worker_exited(self, worker):
+        worker.channel.close()
+        worker.channel = None
+        worker.process.join(1)
+        if time.monotonic() - worker.started > HEALTHY_UPTIME:
+            worker.backoff.reset()
+        delay = worker.backoff.next()
+        worker.restart_at = time.monotonic() + delay
+        worker.restarts += 1
+        logging.error("Worker %d exited with code %s, restart in %.1fs" % (
+            worker.index, worker.process.exitcode, delay))
+        for request_id in list(worker.writes):
+            self._fail(worker, request_id)
+
+    def _on_worker_message(self, worker, message):
+        if message[0] == "write":
+            self._answer(worker, message[1], message[2])
+
+    def on_write_request(self, topic, payload):
+        logsink.PAYLOAD_LOG("receive topic: %s , payload: %s", topic, payload)
+        request = self.codec.loads(payload) if isinstance(payload, (str, bytes)) else payload
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        write = PendingWrite(topic, request, time.monotonic() + WRITE_TIMEOUT)
+        for position, ctrl in enumerate(request["payload"]):
+            # the unknown controllers are answered by the first worker
+            index = self.owners.get(ctrl["name"], 0)
+            write.positions.setdefault(index, list()).append(position)
+        self.writes[request_id] = write
+        for index in list(write.positions.keys()):
+            worker = self.workers[index]
+            worker.writes.add(request_id)
+            if not worker.is_alive() or not worker.channel.send(("write", request_id, write.part(index))):
+                self._fail(worker, request_id)
+        if not request["payload"]:
+            self._complete(request_id)
+
+    def _fail(self, worker, request_id):
+        write = self.writes.get(request_id)
+        if write is not None and worker.index in write.positions:
+            self._answer(worker, request_id, failed_response(write.part(worker.index)))
+
+    def _answer(self, worker, request_id, ctrls):
+        worker.writes.discard(request_id)
+        write = self.writes.get(request_id)
+        if write is None or worker.index not in write.positions:
+            return
+        write.answer(worker.index, ctrls)
+        if write.is_complete():
+            self._complete(request_id)
+
+    def _complete(self, request_id):
+        write = self.writes.pop(request_id)
+        response = dict(write.request)
+        response["payload"] = write.response_ctrls
+        self.respond(write.topic, response)
+
+    def _check(self, evt, userdata):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.is_alive() and not worker.process.is_alive():
+                self._worker_exited(worker)
+            elif not worker.is_alive() and now >= worker.restart_at:
+                self._start_worker(worker)
+        for request_id, write in list(self.writes.items()):
+            if now < write.deadline:
+                continue
+            logging.warn("Write request %s timed out" % write.topic)
+            for index in list(write.positions.keys()):
+                self._fail(self.workers[index], request_id)
+        if self.config_watcher is not None and self.config_watcher.changed():
+            self.reload_config()
+        self.check_timer.add(CHECK_INTERVAL)
@@ -0,0 +1,103 @@
+# -*- coding:utf-8 -*-
+'''
+Subscription dispatcher of the MQ client.
+
+The subscriptions are kept in a trie of topic levels, with '+' and '#'
+wildcards as their own children, so resolving a topic costs its number of
+levels, not the number of subscriptions. Every matching subscription fires,
+and a subscription may have several callbacks. The callbacks resolved for
+the recent concrete topics are cached until the subscriptions change.
+'''
+
+import collections
+
+CACHE_SIZE = 1024
+
+
+class TopicNode(object):
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children = dict()
+        self.callbacks = list()
+
+
+class TopicTrie(object):
+    def __init__(self, cache_size=CACHE_SIZE):
+        self._root = TopicNode()
+        self._cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    def add(self, sub, callback):
+        node = self._root
+        for level in sub.split('/'):
+            if level not in node.children:
+                node.children[level] = TopicNode()
+            node = node.children[level]
+        if callback not in node.callbacks:
+            node.callbacks.append(callback)
+        self._cache.clear()
+
+    def remove(self, sub, callback=None):
+        '''
+            Remove a callback of sub, or all of them without callback.
+            Returns the callbacks left on sub.
+        '''
+        path = [self._root]
+        for level in sub.split('/'):
+            node = path[-1].children.get(level)
+            if node is None:
+                return 0
+            path.append(node)
+        node = path[-1]
+        if callback is None:
+            del node.callbacks[:]
+        elif callback in node.callbacks:
+            node.callbacks.remove(callback)
+        left = len(node.callbacks)
+        # prune the empty branch
+        levels = sub.split('/')
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.callbacks or node.children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+        self._cache.clear()
+        return left
+
+    def match(self, topic):
+        '''The callbacks of every subscription matching topic'''
+        callbacks = self._cache.get(topic)
+        if callbacks is not None:
+            self._cache.move_to_end(topic)
+            return callbacks
+
+        callbacks = list()
+        levels = topic.split('/')
+        nodes = [self._root]
+        for i, level in enumerate(levels):
+            next_nodes = list()
+            for node in nodes:
+                # wildcards do not match the topics starting with '$'
+                wildcard = not (i == 0 and level.startswith('$'))
+                if wildcard and '#' in node.children:
+                    callbacks.extend(node.children['#'].callbacks)
+                if level in node.children:
+                    next_nodes.append(node.children[level])
+                if wildcard and '+' in node.children:
+                    next_nodes.append(node.children['+'])
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            callbacks.extend(node.callbacks)
+            # 'a/#' matches 'a' too
+            if '#' in node.children:
+                callbacks.extend(node.children['#'].callbacks)
+
+        # a callback of overlapping subscriptions fires once
+        callbacks = tuple(collections.OrderedDict.fromkeys(callbacks))
+        self._cache[topic] = callbacks
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return callbacks
@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+'''
+Off-loop execution of slow subscription callbacks.
+
+An OffloadPool runs the callbacks on a thread or process pool executor, so
+they do not stall the libevent loop. The finished calls are handed back to
+the loop through a wakeup pipe watched by a libevent Event, and their
+result callback, e.g. publishing a response, runs on the loop thread.
+Every offloaded callback has its own limit of calls waiting or running;
+the messages over it are dropped.
+'''
+
+import os
+import collections
+import logging as logger
+from events import EV_READ, EV_PERSIST, LibeventEvent
+
+DEFAULT_MAX_PENDING = 100
+
+
+class OffloadedHandler(object):
+    '''A subscription callback run by an OffloadPool'''
+
+    def __init__(self, pool, callback, on_result, max_pending, on_error=None):
+        self.pool = pool
+        self.callback = callback
+        self.on_result = on_result
+        self.on_error = on_error
+        self.max_pending = max_pending
+        self.pending = 0
+        self.dropped = 0
+
+    def __call__(self, topic, payload):
+        if self.pending >= self.max_pending:
+            self.dropped += 1
+            logger.warn("%d calls of %s pending, drop message of topic %s" % (
+                self.pending, getattr(self.callback, "__name__", self.callback), topic))
+            return
+        self.pending += 1
+        self.pool.submit(self, topic, payload)
+
+
+class OffloadPool(object):
+    def __init__(self, base, executor, event_factory=LibeventEvent):
+        self.executor = executor
+        self._done = collections.deque()
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+        self._wakeup_evt = event_factory(
+            base, self._rfd, EV_READ | EV_PERSIST, self._on_wakeup)
+        self._wakeup_evt.add()
+
+    def handler(self, callback, on_result=None, max_pending=DEFAULT_MAX_PENDING, on_error=None):
+        '''
+            callback(topic, payload) runs on the executor, then
+            on_result(topic, result) on the loop thread, or
+            on_error(topic, exception) if it raised
+        '''
+        return OffloadedHandler(self, callback, on_result, max_pending, on_error)
+
+    def submit(self, handler, topic, payload):
+        future = self.executor.submit(handler.callback, topic, payload)
+        future.add_done_callback(lambda f: self._complete(handler, topic, f))
+
+    def _complete(self, handler, topic, future):
+        # called from a worker thread
+        self._done.append((handler, topic, future))
+        try:
+            os.write(self._wfd, b'\0')
+        except BlockingIOError:
+            # the pipe is full, the loop is waking up anyway
+            pass
+
+    def _on_wakeup(self, evt, fd, what, userdata):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._done:
+            handler, topic, future = self._done.popleft()
+            handler.pending -= 1
+            if future.cancelled():
+                continue
+            error = future.exception()
+            try:
+                if error is None:
+                    if handler.on_result is not None:
+                        handler.on_result(topic, future.result())
+                elif handler.on_error is not None:
+                    handler.on_error(topic, error)
+                else:
+                    logger.warn("offloaded handler of topic %s failed: %s" % (topic, error.__str__()))
+            except Exception as e:
+                logger.warn('%s' % e.__str__())
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self._wakeup_evt.delete()
+        os.close(self._rfd)
+        os.close(self._wfd)
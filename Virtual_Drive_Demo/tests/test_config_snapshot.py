@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+'''
+Snapshots of another interpreter or truncated are ignored, not trusted.
+
+usage:
+    python -m pytest tests
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import config_snapshot  # noqa: E402
+from config_snapshot import ConfigSnapshot, SNAPSHOT_HEADER  # noqa: E402
+
+STATE = {"config": {"workers": 1, "cfg": {"controllers": [{"name": "c0"}]}},
+         "measures": {"index": [("c0", "m0", 0)], "columns": [b"\x00\x01\x02\x03"]}}
+
+
+class ConfigSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, "config.ini")
+        with open(self.filename, "w") as f:
+            f.write("{}")
+        # the key stamps only this module, the others may not be installed
+        patcher = mock.patch.object(config_snapshot, "SNAPSHOT_MODULES", ("config_snapshot",))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def snapshot(self):
+        return ConfigSnapshot(self.filename, os.path.join(self.directory, "data"))
+
+    def test_load_saved(self):
+        self.assertTrue(self.snapshot().save(STATE))
+        self.assertEqual(self.snapshot().load(), STATE)
+
+    def test_other_interpreter_ignored(self):
+        for field, value in (("MAGIC_NUMBER", b"\x00\x00\r\n"), ("version", config_snapshot.marshal.version + 1)):
+            with self.subTest(field=field):
+                module = config_snapshot.importlib.util if field == "MAGIC_NUMBER" else config_snapshot.marshal
+                with mock.patch.object(module, field, value):
+                    self.assertTrue(self.snapshot().save(STATE))
+                # nothing of it is unmarshalled
+                with mock.patch.object(config_snapshot.marshal, "loads") as loads:
+                    self.assertIsNone(self.snapshot().load())
+                    loads.assert_not_called()
+
+    def test_truncated_ignored(self):
+        snapshot = self.snapshot()
+        self.assertTrue(snapshot.save(STATE))
+        with open(snapshot.path, "rb") as f:
+            data = f.read()
+        for size in (0, SNAPSHOT_HEADER.size - 1, SNAPSHOT_HEADER.size + 3, len(data) - 1):
+            with self.subTest(size=size):
+                with open(snapshot.path, "wb") as f:
+                    f.write(data[:size])
+                self.assertIsNone(self.snapshot().load())
+
+    def test_changed_config_ignored(self):
+        self.assertTrue(self.snapshot().save(STATE))
+        with open(self.filename, "w") as f:
+            f.write('{"workers": 2}')
+        self.assertIsNone(self.snapshot().load())
+
+    def test_remove(self):
+        snapshot = self.snapshot()
+        self.assertTrue(snapshot.save(STATE))
+        snapshot.remove()
+        snapshot.remove()
+        self.assertFalse(os.path.exists(snapshot.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
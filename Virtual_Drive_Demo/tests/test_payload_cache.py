@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+'''
+The PayloadCache payload against the codec encoding of the whole payload.
+
+usage:
+    python -m pytest tests
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from measure_store import MeasureStore  # noqa: E402
+from payload_cache import PayloadCache  # noqa: E402
+from codec import CODECS, get_codec  # noqa: E402
+
+DATA_TYPES = ("WORD", "DWORD", "FLOAT", "DOUBLE", "STRING", "BIT")
+TIMESTAMP = 1700000000
+
+
+def make_config(count, per_controller=7):
+    controllers = list()
+    ctrl_measures = dict()
+    measures = list()
+    for i in range(count):
+        ctrl_name = "controller%d" % (i // per_controller)
+        if ctrl_name not in ctrl_measures:
+            controllers.append({"protocol": "Virtual Controller", "name": ctrl_name})
+            ctrl_measures[ctrl_name] = list()
+        mea = {"name": "measure%d" % i, "ctrlName": ctrl_name, "dataType": DATA_TYPES[i % len(DATA_TYPES)]}
+        measures.append(mea)
+        ctrl_measures[ctrl_name].append(mea)
+    # a controller without measures
+    controllers.append({"protocol": "Virtual Controller", "name": "empty"})
+    ctrl_measures["empty"] = list()
+    return controllers, ctrl_measures, measures
+
+
+def build_payload(controllers, ctrl_measures, store, timestamp):
+    publish_payload = {"controllers": list()}
+    for ctrl in controllers:
+        measures = list()
+        for mea in ctrl_measures[ctrl["name"]]:
+            handle = store.handle(ctrl["name"], mea["name"])
+            measures.append({"name": mea["name"], "health": store.health(handle),
+                             "timestamp": timestamp, "value": store.value(handle)})
+        publish_payload["controllers"].append({"name": ctrl["name"], "version": "", "health": 1,
+                                               "timestamp": timestamp, "measures": measures})
+    return publish_payload
+
+
+def json_codecs():
+    return [get_codec(name) for name, (codec_class, module) in sorted(CODECS.items())
+            if codec_class.is_json and module is not None]
+
+
+class PayloadCacheTest(unittest.TestCase):
+    def check(self, cache, codec, controllers, ctrl_measures, store):
+        encoded = cache.encode(TIMESTAMP)
+        expected = build_payload(controllers, ctrl_measures, store, TIMESTAMP)
+        # the same document, the separators may differ from the codec ones
+        self.assertEqual(codec.loads(encoded), codec.loads(codec.dumps(expected)))
+
+    def test_equivalent_to_codec(self):
+        for codec in json_codecs():
+            with self.subTest(codec=codec.name):
+                controllers, ctrl_measures, measures = make_config(50)
+                store = MeasureStore(measures)
+                cache = PayloadCache(controllers, ctrl_measures, store, codec)
+                self.check(cache, codec, controllers, ctrl_measures, store)
+
+                for i, mea in enumerate(measures[::3]):
+                    value = "v%d" % i if mea["dataType"] == "STRING" else i % 2
+                    store.set_value(mea["ctrlName"], mea["name"], value)
+                    cache.mark_dirty(mea["ctrlName"], mea["name"])
+                store.set_health("controller1", "measure8", 0)
+                cache.mark_dirty("controller1", "measure8")
+                self.check(cache, codec, controllers, ctrl_measures, store)
+
+                restored = PayloadCache(controllers, ctrl_measures, store, codec, fragments=cache.fragments())
+                self.check(restored, codec, controllers, ctrl_measures, store)
+
+    def test_empty_payload(self):
+        for codec in json_codecs():
+            with self.subTest(codec=codec.name):
+                cache = PayloadCache([], dict(), MeasureStore(), codec)
+                self.assertEqual(codec.loads(cache.encode(TIMESTAMP)), {"controllers": []})
+
+
+if __name__ == '__main__':
+    unittest.main()
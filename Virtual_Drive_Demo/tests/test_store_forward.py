@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+'''
+Re-delivery of the store-and-forward log after a crash.
+
+usage:
+    python -m pytest tests
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import store_forward  # noqa: E402
+from store_forward import SegmentLog  # noqa: E402
+
+CURSOR_INTERVAL = 5
+# Messages drained every second
+BATCH = 10
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class SegmentLogCrashTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        patcher = mock.patch.object(store_forward.time, "monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def open_log(self):
+        return SegmentLog(self.path, max_size=1024 * 1024, segment_size=4096,
+                          cursor_interval=CURSOR_INTERVAL)
+
+    def drain(self, log, seconds):
+        '''Commit a batch every second, returns the payloads committed'''
+        committed = list()
+        for _ in range(seconds):
+            messages = log.peek(BATCH)
+            if not messages:
+                break
+            log.commit(messages[-1])
+            committed.extend(message.payload for message in messages)
+            self.clock.now += 1
+        return committed
+
+    def test_redelivery_after_crash_is_bounded(self):
+        log = self.open_log()
+        for i in range(300):
+            log.append("topic", b"%04d" % i)
+        cursor_file = os.path.join(self.path, store_forward.CURSOR_FILE)
+        saved = os.stat(cursor_file).st_mtime_ns if os.path.exists(cursor_file) else None
+        committed = self.drain(log, 12)
+        self.assertEqual(len(committed), 12 * BATCH)
+        self.assertNotEqual(saved, os.stat(cursor_file).st_mtime_ns)
+
+        # a crash: the log is opened again without close()
+        log = self.open_log()
+        left = log.peek(len(log))
+        redelivered = [message.payload for message in left if message.payload in committed]
+        self.assertLessEqual(len(redelivered), CURSOR_INTERVAL * BATCH)
+        # nothing is lost, the messages come in order
+        self.assertEqual([message.payload for message in left],
+                         [b"%04d" % i for i in range(300 - len(left), 300)])
+        self.assertGreaterEqual(300 - len(left), len(committed) - CURSOR_INTERVAL * BATCH)
+
+    def test_cursor_saved_on_rollover(self):
+        log = self.open_log()
+        for i in range(1000):
+            log.append("topic", b"%04d" % i)
+        # one batch reaching into the next segment
+        messages = log.peek(len(log))
+        first_segment = messages[0].segment
+        last = next(message for message in messages if message.segment != first_segment)
+        log.commit(last)
+
+        log = self.open_log()
+        self.assertEqual(log.peek(1)[0].payload, messages[messages.index(last) + 1].payload)
+
+    def test_close_saves_cursor(self):
+        log = self.open_log()
+        for i in range(50):
+            log.append("topic", b"%04d" % i)
+        log.commit(log.peek(3)[-1])
+        log.close()
+
+        log = self.open_log()
+        self.assertEqual(len(log), 47)
+        self.assertEqual(log.peek(1)[0].payload, b"0003")
+
+
+if __name__ == '__main__':
+    unittest.main()
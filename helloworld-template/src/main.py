@@ -27,13 +27,18 @@ def main(argv=sys.argv):
 
     #print("app config file:%s" % app_config_file)
     config = YamlConfig(app_config_file)
-    config_others = config.get_option_config('config', 'others')
+    # the options are looked up once, then again only when the file changes
+    description = config.getter('config.description')
+    debug = config.getter('config.others.LOG.debug', int, 0)
+    config.subscribe('config.others.LOG.debug',
+                     lambda path, old, new: logging.info("%s changed from %s to %s" % (path, old, new)), int)
     while True:
-        logging.info("decription:%s" % (config.get_option_config('config', 'description')))
-        print("decription:%s" % (config.get_option_config('config', 'description')))
+        config.reload()
+        logging.info("decription:%s" % (description()))
+        print("decription:%s" % (description()))
 
-        logging.info("debug:%s" % (config_others['LOG']['debug']))
-        print("debug:%s" % (config_others['LOG']['debug']))
+        logging.info("debug:%s" % (debug()))
+        print("debug:%s" % (debug()))
 
         time.sleep(10)
 
@@ -1,47 +1,142 @@
 # -*- coding:utf-8 -*-
 
+import os
+import functools
 import yaml
 
+try:
+    # LibYAML, when PyYAML was built with it
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# The value of an option that does not exist
+MISSING = object()
+
+
 class YamlConfig:
     """A class that Parses the yaml style configuration file of user app.
-    
+
     usage:
        file = './config.yaml'
        configs = YamlConfig(file)
-           file --> config file name 
+           file --> config file name
        configs.exist_config_option('config', 'description')
            examine if this configuration exists
        configs.get_option_config('config', 'description')
            get Specific configuration
+       configs.get('config.others.LOG.debug', int, 0)
+           get the configuration of a dotted path, converted by int,
+           0 if it does not exist
+       configs.getter('config.others.LOG.debug', int, 0)
+           a function returning the same, up to date after reload()
+       configs.subscribe('config.others.LOG.debug', callback, int)
+           callback(path, old, new) is called when reload() changes it
+       configs.reload()
+           load the config file again if it changed
        configs.get_configs()
            get all configurations from config file
-   
+
+    A value is looked up and converted once, then kept until the file
+    is loaded again.
     """
 
     def __init__(self, filename):
+        self.filename = filename
         self.configs = None
+        self.stamp = None
+        # (path, convert) -> the converted value, MISSING if it does not exist
+        self._values = dict()
+        # (path, convert) -> the callbacks of the subscribers
+        self._subscribers = dict()
+        self.load()
+
+    def load(self):
+        # taken before parsing, a broken file is reported once, not on
+        # every reload() until it is fixed
+        self.stamp = self._stamp()
+        with open(self.filename, "r") as f:
+            self.configs = yaml.load(f, Loader=SafeLoader)
+        self._values = dict()
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _lookup(self, path, convert):
+        keys = path.split(".") if isinstance(path, str) else path
+        node = self.configs
+        for key in keys:
+            if not isinstance(node, dict) or key not in node:
+                return MISSING
+            node = node[key]
+        if convert is not None:
+            try:
+                return convert(node)
+            except Exception as error:
+                print("can not convert config %s to %s. Error:%s" % (node, convert.__name__, error))
+                return MISSING
+        return node
+
+    def get(self, path, convert=None, default=None):
+        """path is dotted, e.g. 'config.others.LOG.debug', or a tuple of the keys"""
+        key = (path, convert)
+        try:
+            value = self._values[key]
+        except KeyError:
+            value = self._values[key] = self._lookup(path, convert)
+        return default if value is MISSING else value
+
+    def getter(self, path, convert=None, default=None):
+        return functools.partial(self.get, path, convert, default)
+
+    def subscribe(self, path, callback, convert=None):
+        self.get(path, convert)
+        self._subscribers.setdefault((path, convert), list()).append(callback)
+
+    def unsubscribe(self, path, callback, convert=None):
+        callbacks = self._subscribers.get((path, convert), list())
+        if callback in callbacks:
+            callbacks.remove(callback)
 
-        with open(filename, "r") as f:
-            self.configs = yaml.load(f)
+    def changed(self):
+        """If the config file changed since it was loaded, by its mtime and size"""
+        stamp = self._stamp()
+        return stamp is not None and stamp != self.stamp
+
+    def reload(self, force=False):
+        """Load the config file again if it changed, returns the paths of the subscribers that changed"""
+        if not force and not self.changed():
+            return list()
+        former = {key: self._values.get(key, MISSING) for key in self._subscribers}
+        try:
+            self.load()
+        except (OSError, yaml.YAMLError) as error:
+            print("can not reload config %s. Error:%s" % (self.filename, error))
+            return list()
+        changed = list()
+        for (path, convert), callbacks in list(self._subscribers.items()):
+            old = former[(path, convert)]
+            self.get(path, convert)
+            new = self._values[(path, convert)]
+            if old is new or old == new:
+                continue
+            changed.append(path)
+            for callback in list(callbacks):
+                callback(path, None if old is MISSING else old, None if new is MISSING else new)
+        return changed
 
     def exist_config_option(self, section, option):
-        state = False
-        if self.configs and section in self.configs and option in self.configs[section]:
-            state = True
-        return state
+        return self.get((section, option), default=MISSING) is not MISSING
 
     def get_option_config(self, section, option):
-        if self.exist_config_option(section, option):
-            return self.configs[section][option]
-        else:
-            return None
+        return self.get((section, option))
 
     def convert_config_to_integer(self, section, option):
-        if self.exist_config_option(section, option):
-            try:
-                return int(self.configs[section][option])
-            except Exception as error:
-                print("can not convert config %s to integer. Error:%s" % (self.configs[section][option], error))
+        return self.get((section, option), int)
 
     def get_configs(self):
         return self.configs
@@ -51,4 +146,3 @@ if __name__ == '__main__':
     filename = "./config.yaml"
     config_instance = YamlConfig(filename)
     yaml_configs = config_instance.get_configs()
-
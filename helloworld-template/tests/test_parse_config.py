@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+"""
+Reload of a YamlConfig when its file is broken, then fixed.
+
+usage:
+    python -m pytest tests
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from parse_config import YamlConfig  # noqa: E402
+
+
+class YamlConfigReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, "config.yaml")
+        self.mtime = 1000000000
+        self.write("config:\n  others:\n    LOG:\n      debug: 0\n")
+
+    def write(self, text):
+        with open(self.filename, "w") as f:
+            f.write(text)
+        # a new mtime, the writes of a test are within the same tick
+        self.mtime += 1
+        os.utime(self.filename, ns=(self.mtime * 10 ** 9, self.mtime * 10 ** 9))
+
+    def reload(self, config):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            changed = config.reload()
+        return changed, output.getvalue()
+
+    def test_broken_file_reported_once(self):
+        config = YamlConfig(self.filename)
+        changes = list()
+        config.subscribe('config.others.LOG.debug', lambda path, old, new: changes.append((old, new)), int)
+
+        self.write("config: [unclosed\n")
+        changed, output = self.reload(config)
+        self.assertEqual(changed, [])
+        self.assertIn("can not reload config", output)
+        # the former config is kept
+        self.assertEqual(config.get('config.others.LOG.debug', int), 0)
+        for _ in range(3):
+            self.assertFalse(config.changed())
+            changed, output = self.reload(config)
+            self.assertEqual((changed, output), ([], ""))
+
+        self.write("config:\n  others:\n    LOG:\n      debug: 1\n")
+        self.assertTrue(config.changed())
+        changed, output = self.reload(config)
+        self.assertEqual(changed, ['config.others.LOG.debug'])
+        self.assertEqual(changes, [(0, 1)])
+        self.assertEqual(config.get('config.others.LOG.debug', int), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()